@@ -0,0 +1,273 @@
+import argparse
+import json
+import os
+from pathlib import Path
+
+import duckdb
+from duckdb import DuckDBPyRelation, SQLExpression
+
+# 月別・年間の出力から全国・地域・都府県振興局ごとの集計と、観測所ごとの順位を作る
+# Webの各ページで全観測所を走査しなくて済むよう、値を引くだけの形で書き出す
+
+processed_dir = Path(
+    os.environ.get("JCD_DATA_DIR", Path(__file__).parents[1].joinpath("data"))
+).joinpath("processed")
+
+METRICS = ["temperature", "precipitation", "sunshine_duration", "wbgt"]
+PERCENTILES = [10, 25, 50, 75, 90]
+
+# 都府県振興局 -> 地域（web/pages/ranking/+data.tsと同じ対応）
+REGIONS = {
+    "宗谷": "北海道",
+    "上川": "北海道",
+    "留萌": "北海道",
+    "石狩": "北海道",
+    "空知": "北海道",
+    "後志": "北海道",
+    "ｵﾎｰﾂｸ": "北海道",
+    "根室": "北海道",
+    "釧路": "北海道",
+    "十勝": "北海道",
+    "胆振": "北海道",
+    "日高": "北海道",
+    "渡島": "北海道",
+    "檜山": "北海道",
+    "青森": "東北",
+    "岩手": "東北",
+    "宮城": "東北",
+    "秋田": "東北",
+    "山形": "東北",
+    "福島": "東北",
+    "茨城": "関東",
+    "栃木": "関東",
+    "群馬": "関東",
+    "埼玉": "関東",
+    "千葉": "関東",
+    "東京": "関東",
+    "神奈川": "関東",
+    "新潟": "中部",
+    "富山": "中部",
+    "石川": "中部",
+    "福井": "中部",
+    "山梨": "中部",
+    "長野": "中部",
+    "岐阜": "中部",
+    "静岡": "中部",
+    "愛知": "中部",
+    "三重": "近畿",
+    "滋賀": "近畿",
+    "京都": "近畿",
+    "大阪": "近畿",
+    "兵庫": "近畿",
+    "奈良": "近畿",
+    "和歌山": "近畿",
+    "鳥取": "中国",
+    "島根": "中国",
+    "岡山": "中国",
+    "広島": "中国",
+    "山口": "中国",
+    "徳島": "四国",
+    "香川": "四国",
+    "愛媛": "四国",
+    "高知": "四国",
+    "福岡": "九州",
+    "佐賀": "九州",
+    "長崎": "九州",
+    "熊本": "九州",
+    "大分": "九州",
+    "宮崎": "九州",
+    "鹿児島": "九州",
+    "沖縄": "九州",
+}
+UNKNOWN_PREFECTURE = "不明"
+UNKNOWN_REGION = "その他"
+
+
+def json_entries(name):
+    # 観測所番号をキーとするJSONオブジェクトを(key, value)の行に展開する
+    path = processed_dir.joinpath(f"{name}.json").as_posix()
+    return f"read_text('{path}') AS f, json_each(f.content) AS j"
+
+
+def query_stations():
+    regions = ", ".join(f"('{k}', '{v}')" for k, v in REGIONS.items())
+    return duckdb.sql(
+        f"""
+        WITH s AS (
+            SELECT
+                j.key AS station_number,
+                coalesce(
+                    j.value->>'prefecture_subprefecture', '{UNKNOWN_PREFECTURE}'
+                ) AS prefecture
+            FROM {json_entries("station_index")}
+        )
+        SELECT s.*, coalesce(r.region, '{UNKNOWN_REGION}') AS region
+        FROM s
+        LEFT JOIN (VALUES {regions}) AS r(prefecture, region) USING (prefecture)
+        """
+    )
+
+
+def query_values():
+    # 観測所・指標・月ごとに1行。month = 0 は年間の値
+    normal = " UNION ALL ".join(
+        f"""
+        SELECT j.key AS station_number, '{metric}' AS metric, 0 AS month,
+            (j.value->'yearly'->>'{metric}')::DOUBLE AS value
+        FROM {json_entries("monthly_yearly_normal")}
+        UNION ALL
+        SELECT j.key, '{metric}', m.i,
+            (j.value->'monthly'->'{metric}'->>(m.i - 1))::DOUBLE
+        FROM {json_entries("monthly_yearly_normal")}, range(1, 13) AS m(i)
+        """
+        for metric in METRICS
+        if metric != "wbgt"
+    )
+    wbgt = f"""
+        SELECT j.key, 'wbgt', 0, (j.value->>'yearly')::DOUBLE
+        FROM {json_entries("monthly_yearly_wbgt")}
+        UNION ALL
+        SELECT j.key, 'wbgt', m.i, (j.value->'monthly'->>m.i::VARCHAR)::DOUBLE
+        FROM {json_entries("monthly_yearly_wbgt")}, range(4, 11) AS m(i)
+    """
+
+    return duckdb.sql(f"{normal} UNION ALL {wbgt}").filter("value IS NOT NULL")
+
+
+def query_ranks(values: DuckDBPyRelation, stations: DuckDBPyRelation):
+    # 年間の値について、全国と地域・都府県振興局内での順位をウィンドウ関数で付ける
+    yearly = values.filter("month = 0").join(stations, "station_number", how="left")
+
+    def rank(*partition):
+        return SQLExpression(
+            f"rank() OVER (PARTITION BY {', '.join(partition)} ORDER BY value DESC)"
+        )
+
+    def count(*partition):
+        return SQLExpression(f"count(*) OVER (PARTITION BY {', '.join(partition)})")
+
+    return yearly.select(
+        "station_number",
+        "metric",
+        "value",
+        rank("metric").alias("rank"),
+        count("metric").alias("count"),
+        rank("metric", "region").alias("region_rank"),
+        count("metric", "region").alias("region_count"),
+        rank("metric", "prefecture").alias("prefecture_rank"),
+        count("metric", "prefecture").alias("prefecture_count"),
+        SQLExpression(
+            "round(100 * percent_rank() OVER (PARTITION BY metric ORDER BY value), 1)"
+        ).alias("percentile"),
+        SQLExpression("round(value - favg(value) OVER (PARTITION BY metric), 2)").alias(
+            "difference"
+        ),
+    ).order("station_number, metric")
+
+
+def query_summaries(values: DuckDBPyRelation, stations: DuckDBPyRelation):
+    quantiles = ", ".join(str(x / 100) for x in PERCENTILES)
+
+    # 全国・地域・都府県振興局ごとの集計をGROUPING SETSでまとめて計算する
+    # level: 3 = 全国, 1 = 地域, 2 = 都府県振興局
+    return (
+        values.join(stations, "station_number", how="left")
+        .aggregate(
+            aggr_expr=[
+                SQLExpression("grouping(region, prefecture)").alias("level"),
+                SQLExpression("coalesce(region, prefecture)").alias("area"),
+                "metric",
+                "month",
+                SQLExpression("count(*)").alias("count"),
+                SQLExpression("round(favg(value), 2)").alias("mean"),
+                SQLExpression("min(value)").alias("min"),
+                SQLExpression("max(value)").alias("max"),
+                # 同じ値の観測所がある場合は観測所番号の小さい方
+                SQLExpression(
+                    "first(station_number ORDER BY value, station_number)"
+                ).alias("min_station"),
+                SQLExpression(
+                    "first(station_number ORDER BY value DESC, station_number)"
+                ).alias("max_station"),
+                SQLExpression(
+                    f"list_transform(quantile_cont(value, [{quantiles}]), "
+                    "x -> round(x, 2))"
+                ).alias("percentiles"),
+            ],
+            group_expr=(
+                "GROUPING SETS ("
+                "(metric, month), (region, metric, month), (prefecture, metric, month)"
+                ")"
+            ),
+        )
+        .order("level DESC, area, metric, month")
+    )
+
+
+def create_aggregates_object():
+    stations = query_stations()
+    values = query_values()
+
+    levels = {3: "national", 1: "regions", 2: "prefectures"}
+    aggregates = {"national": {}, "regions": {}, "prefectures": {}, "stations": {}}
+
+    for row in query_summaries(values, stations).fetchall():
+        level, area, metric, month, count, mean, min, max, *rest = row
+        min_station, max_station, percentiles = rest
+
+        if levels[level] == "national":
+            target = aggregates["national"]
+        else:
+            target = aggregates[levels[level]].setdefault(area, {})
+
+        if month == 0:
+            target[metric] = {
+                "count": count,
+                "mean": mean,
+                "min": min,
+                "max": max,
+                "min_station": min_station,
+                "max_station": max_station,
+                "percentiles": dict(zip(map(str, PERCENTILES), percentiles)),
+                "monthly": {},
+            }
+        elif metric in target:
+            target[metric]["monthly"][str(month)] = mean
+
+    columns = [
+        "value",
+        "rank",
+        "count",
+        "region_rank",
+        "region_count",
+        "prefecture_rank",
+        "prefecture_count",
+        "percentile",
+        "difference",
+    ]
+    for station_number, metric, *row in query_ranks(values, stations).fetchall():
+        station = aggregates["stations"].setdefault(station_number, {})
+        station[metric] = dict(zip(columns, row))
+
+    return aggregates
+
+
+def write_aggregates():
+    aggregates = create_aggregates_object()
+
+    path = processed_dir.joinpath("aggregates.json")
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(aggregates, f, indent=2, ensure_ascii=False)
+    return path
+
+
+def main():
+    argparse.ArgumentParser(
+        description="Write national/regional aggregates and station ranks "
+        "from the monthly/yearly outputs"
+    ).parse_args()
+    write_aggregates()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,432 @@
+import argparse
+import itertools
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import duckdb
+
+import metrics
+import publish
+import synthetic
+import wbgt_layout
+
+# 合成データで処理時間とピークメモリを計測するベンチマーク
+# main.pyとstaging.pyはインポート時にデータディレクトリを決めるので、
+# 段階ごとに環境変数JCD_DATA_DIRを設定した子プロセスで実行する
+
+
+def run_staging():
+    import staging
+
+    for name in staging.staged_datasets:
+        staging.refresh(name)
+
+
+def run_create(name):
+    def run():
+        import main
+
+        return getattr(main, f"create_{name}_object")()
+
+    return run
+
+
+def run_write(compact=False):
+    def run():
+        import main
+
+        main.main(compact=compact)
+
+    return run
+
+
+def run_similarity():
+    import similarity
+
+    similarity.write_climate_similarity()
+
+
+# 段階名 -> 実行する関数
+# 作成系はステージング済みのParquetを使い、書き出しはmain.main()全体を計測する
+stages = {
+    "staging": run_staging,
+    "daily_normal": run_create("daily_normal"),
+    "monthly_yearly_normal": run_create("monthly_yearly_normal"),
+    "daily_wbgt": run_create("daily_wbgt"),
+    "monthly_yearly_wbgt": run_create("monthly_yearly_wbgt"),
+    "heat_risk": run_create("heat_risk"),
+    "station_index": run_create("station_index"),
+    "write": run_write(),
+    "write_compact": run_write(compact=True),
+    # 書き出した月別・年間の出力を読むので、書き出しの後に計測する
+    "climate_similarity": run_similarity,
+}
+
+
+# 列単位の取り出し（main.fetch_columns）と比べるための、行ごとのタプルを処理する実装
+def rowwise_daily_normal(result_rows, element_names):
+    result = {}
+    for station_number, rows in itertools.groupby(result_rows, key=lambda x: x[0]):
+        station = {key: {} for key in element_names.values()}
+        for row in rows:
+            values = row[3:]
+            station[element_names[row[1]]][row[2]] = (
+                None if set(values) == {None} else values
+            )
+        for key, element in station.items():
+            if set(element.values()) == {None}:
+                station[key] = None
+        result[station_number] = station
+    return result
+
+
+def rowwise_monthly_yearly_normal(result_rows, element_names):
+    result = {}
+    for station_number, rows in itertools.groupby(result_rows, key=lambda x: x[0]):
+        elements = {}
+        for row in rows:
+            elements.setdefault(element_names[row[1]], row[2:])
+        result[station_number] = {
+            "monthly": {
+                key: None if set(elements[key][:-1]) == {None} else elements[key][:-1]
+                for key in element_names.values()
+            },
+            "yearly": {key: elements[key][-1] for key in element_names.values()},
+        }
+    return result
+
+
+def rowwise_wbgt(result_rows):
+    result = {}
+    for station_number, rows in itertools.groupby(result_rows, key=lambda x: x[0]):
+        daily = {}
+        monthly_yearly = {"yearly": None, "monthly": {}}
+        for _, month, day, _, level, min_wbgt, max_wbgt, avg_wbgt, *_ in rows:
+            if level == 1:
+                daily[f"{month}/{day}"] = {
+                    "min": min_wbgt,
+                    "max": max_wbgt,
+                    "avg": avg_wbgt,
+                }
+            elif level == 3:
+                monthly_yearly["monthly"][month] = avg_wbgt
+            elif level == 7:
+                monthly_yearly["yearly"] = avg_wbgt
+        result[station_number] = (daily, monthly_yearly)
+    return result
+
+
+def run_extraction():
+    import main
+    import staging
+
+    staging.refresh_on_load = False
+    element_names = {int(v): k for k, v in main.NORMAL_ELEMENTS.items()}
+    cases = {
+        "daily_normal": (
+            lambda: main.query_daily(
+                staging.load("daily_normal"), main.NORMAL_ELEMENTS.values()
+            ),
+            lambda x: rowwise_daily_normal(x, element_names),
+            lambda x: dict(main.group_daily_normal(x)),
+        ),
+        "monthly_yearly_normal": (
+            lambda: main.query_monthly_yearly(
+                staging.load("monthly_normal"), main.NORMAL_ELEMENTS.values()
+            ),
+            lambda x: rowwise_monthly_yearly_normal(x, element_names),
+            lambda x: dict(main.group_monthly_yearly_normal(x)),
+        ),
+        "wbgt": (
+            main.query_wbgt_aggregates,
+            rowwise_wbgt,
+            # 暑さ指数は行ごとの実装がないので、日別と月別・年間だけを比べる
+            lambda x: {k: v[:2] for k, v in main.group_wbgt(x)},
+        ),
+    }
+
+    def timed(function, *args):
+        start = time.perf_counter()
+        result = function(*args)
+        return result, time.perf_counter() - start
+
+    results = {}
+    for name, (query, rowwise, columnar) in cases.items():
+        # クエリの結果を一度テーブルに保存し、取り出しと組み立てだけを計測する
+        query().create(f"extraction_{name}")
+        table = duckdb.table(f"extraction_{name}")
+
+        rows, rowwise_fetch = timed(table.fetchall)
+        expected, rowwise_build = timed(rowwise, rows)
+        columns, columnar_fetch = timed(table.fetchnumpy)
+        actual, columnar_build = timed(columnar, columns)
+
+        # タプルとリストの違いを無視して比べる
+        if json.dumps(actual) != json.dumps(expected):
+            raise AssertionError(f"{name}: columnar output differs from row-wise")
+
+        results[name] = {
+            "rows": len(rows),
+            "rowwise_fetch_seconds": rowwise_fetch,
+            "rowwise_build_seconds": rowwise_build,
+            "columnar_fetch_seconds": columnar_fetch,
+            "columnar_build_seconds": columnar_build,
+        }
+    print(json.dumps(results))
+
+
+def run_extraction_scale(station_count, seed=0):
+    with tempfile.TemporaryDirectory() as data_dir:
+        synthetic.generate(data_dir, station_count, seed=seed)
+        measure(data_dir, "staging")
+        results = measure(data_dir, "all", option="--extraction-run")
+
+    for name, x in results.items():
+        # 1行あたりの取り出しと組み立ての時間
+        rowwise = (x["rowwise_fetch_seconds"] + x["rowwise_build_seconds"]) / x["rows"]
+        columnar = (x["columnar_fetch_seconds"] + x["columnar_build_seconds"]) / x[
+            "rows"
+        ]
+        print(
+            f"[{station_count}] {name}: {x['rows']} rows, "
+            f"row-wise fetch {x['rowwise_fetch_seconds']:.3f}s "
+            f"+ build {x['rowwise_build_seconds']:.3f}s, "
+            f"columnar fetch {x['columnar_fetch_seconds']:.3f}s "
+            f"+ build {x['columnar_build_seconds']:.3f}s "
+            f"({rowwise * 1e6:.2f} -> {columnar * 1e6:.2f} us/row)"
+        )
+    return results
+
+
+# main.pyを実行し、公開する出力（processed/直下のJSON）の内容を返す
+def run_main(data_dir, *options):
+    subprocess.run(
+        [sys.executable, "main.py", *options],
+        env=dict(os.environ, JCD_DATA_DIR=str(data_dir)),
+        cwd=Path(__file__).parent,
+        stdout=subprocess.DEVNULL,
+        check=True,
+    )
+    processed_dir = Path(data_dir).joinpath("processed")
+    return {
+        x.name: x.read_bytes()
+        for x in sorted(processed_dir.glob("*.json"))
+        if x.name not in publish.EXCLUDED
+    }
+
+
+def compare_outputs(label, expected, actual):
+    mismatches = sorted(
+        x for x in expected.keys() | actual.keys() if expected.get(x) != actual.get(x)
+    )
+    print(f"{label}: {'identical' if not mismatches else 'differs'}")
+    for name in mismatches:
+        print(f"  {name}")
+    return mismatches
+
+
+# WBGTの地点の元ファイルを、別の値で書き直す
+def change_wbgt_point(data_dir, point):
+    wbgt_dir = Path(data_dir).joinpath("raw", "moe-wbgt")
+    for path in wbgt_layout.list_files(wbgt_dir.joinpath(f"point={point}")):
+        year = int(path.parents[1].name.removeprefix("year="))
+        month = int(path.parents[0].name.removeprefix("month="))
+        path.write_text(synthetic.build_wbgt_csv(point, year, month, base=25.0))
+
+
+# 逐次実行、--workers、--incrementalの出力が全体の作り直しと一致するかを確かめる
+def run_consistency(station_count, workers=3, seed=0):
+    mismatches = []
+    with tempfile.TemporaryDirectory() as data_dir:
+        synthetic.generate(data_dir, station_count, seed=seed)
+        wbgt_dir = Path(data_dir).joinpath("raw", "moe-wbgt")
+        points = sorted({x.parents[2].name for x in wbgt_layout.list_files(wbgt_dir)})
+
+        serial = run_main(data_dir)
+        mismatches += compare_outputs(
+            f"[{station_count}] --workers {workers}",
+            serial,
+            run_main(data_dir, "--workers", str(workers)),
+        )
+
+        change_wbgt_point(data_dir, points[0].removeprefix("point="))
+        incremental = run_main(data_dir, "--incremental")
+        mismatches += compare_outputs(
+            f"[{station_count}] --incremental (changed WBGT point)",
+            run_main(data_dir),
+            incremental,
+        )
+
+        # 元ファイルを消した観測所だけが変わった場合も、空の入力で作り直せること
+        # （WBGTの地点ごと消した観測所と、月別の平年値だけを消した観測所）
+        removed = points[-1].removeprefix("point=")
+        normal_dir = Path(data_dir).joinpath("raw", "jma-normal")
+        normal_dir.joinpath("daily", f"nml_amd_d_{removed}.csv").unlink()
+        normal_dir.joinpath("monthly", f"nml_amd_m_{removed}.csv").unlink()
+        shutil.rmtree(wbgt_dir.joinpath(f"point={removed}"))
+        max(normal_dir.joinpath("monthly").glob("nml_amd_m_*.csv")).unlink()
+        incremental = run_main(data_dir, "--incremental")
+        mismatches += compare_outputs(
+            f"[{station_count}] --incremental (removed stations)",
+            run_main(data_dir),
+            incremental,
+        )
+
+    return mismatches
+
+
+def run_stage(name):
+    start = time.perf_counter()
+    stages[name]()
+    elapsed = time.perf_counter() - start
+    print(json.dumps({"seconds": elapsed, "peak_rss": metrics.peak_rss_bytes()}))
+
+
+def measure(data_dir, name, option="--stage"):
+    env = dict(os.environ, JCD_DATA_DIR=str(data_dir))
+    result = subprocess.run(
+        [sys.executable, __file__, option, name],
+        env=env,
+        cwd=Path(__file__).parent,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def output_size(data_dir):
+    processed_dir = Path(data_dir).joinpath("processed")
+    return sum(x.stat().st_size for x in processed_dir.glob("*.json"))
+
+
+def run_scale(station_count, repeat=1, seed=0):
+    results = {}
+    with tempfile.TemporaryDirectory() as data_dir:
+        start = time.perf_counter()
+        synthetic.generate(data_dir, station_count, seed=seed)
+        print(f"[{station_count}] generated in {time.perf_counter() - start:.2f}s")
+
+        for name in stages:
+            # 複数回実行した場合は最も速い結果を使う
+            runs = [measure(data_dir, name) for _ in range(repeat)]
+            results[name] = {
+                "seconds": min(x["seconds"] for x in runs),
+                "peak_rss": max(x["peak_rss"] for x in runs),
+            }
+            print(
+                f"[{station_count}] {name}: {results[name]['seconds']:.2f}s, "
+                f"peak RSS {results[name]['peak_rss'] / 2**20:.0f} MiB"
+            )
+
+        results["output_bytes"] = output_size(data_dir)
+
+    return results
+
+
+def find_regressions(results, baseline, tolerance):
+    regressions = []
+    for scale, stage_results in results.items():
+        for name, current in stage_results.items():
+            previous = baseline.get(scale, {}).get(name)
+            if not isinstance(previous, dict):
+                continue
+
+            for metric in ("seconds", "peak_rss"):
+                if current[metric] > previous[metric] * (1 + tolerance):
+                    regressions.append(
+                        f"{scale} stations, {name}: {metric} "
+                        f"{previous[metric]:.2f} -> {current[metric]:.2f}"
+                    )
+
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark the pipeline stages on synthetic data"
+    )
+    parser.add_argument(
+        "--scales",
+        default="100,1300",
+        help="comma-separated station counts (e.g. 100,1300,10000)",
+    )
+    parser.add_argument("--repeat", type=int, default=1)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--output", type=Path, help="write the results to this JSON file"
+    )
+    parser.add_argument(
+        "--baseline",
+        type=Path,
+        help="fail if any stage is slower or larger than in this results file",
+    )
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.2,
+        help="allowed relative increase over the baseline (default: 0.2)",
+    )
+    parser.add_argument(
+        "--extraction",
+        action="store_true",
+        help="compare row-wise tuple processing with the columnar extraction",
+    )
+    parser.add_argument(
+        "--consistency",
+        action="store_true",
+        help="check that --workers and --incremental match a full serial build",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=3,
+        help="worker processes for --consistency (default: 3)",
+    )
+    parser.add_argument("--stage", choices=stages, help=argparse.SUPPRESS)
+    parser.add_argument("--extraction-run", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.stage:
+        run_stage(args.stage)
+        return
+    if args.extraction_run:
+        run_extraction()
+        return
+
+    if args.consistency:
+        mismatches = []
+        for scale in args.scales.split(","):
+            mismatches += run_consistency(int(scale), args.workers, seed=args.seed)
+        sys.exit(1 if mismatches else 0)
+
+    results = {}
+    for scale in args.scales.split(","):
+        if args.extraction:
+            results[scale] = run_extraction_scale(int(scale), seed=args.seed)
+        else:
+            results[scale] = run_scale(int(scale), repeat=args.repeat, seed=args.seed)
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+
+        regressions = find_regressions(results, baseline, args.tolerance)
+        for regression in regressions:
+            print(f"Regression: {regression}")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
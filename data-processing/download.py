@@ -1,20 +1,40 @@
+import argparse
+import hashlib
 import itertools
 import json
 import os
 import re
 import shutil
+import threading
 import time
 import zipfile
-from pathlib import Path
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path, PurePosixPath
+from urllib.parse import urlsplit
 
 import requests
 from requests.adapters import HTTPAdapter, Retry
 
-raw_dir = Path(__file__).parents[1].joinpath("data", "raw")
+import wbgt_layout
+
+raw_dir = Path(
+    os.environ.get("JCD_DATA_DIR", Path(__file__).parents[1].joinpath("data"))
+).joinpath("raw")
 moe_wbgt_dir = raw_dir.joinpath("moe-wbgt")
 jma_normal_dir = raw_dir.joinpath("jma-normal")
 jma_station_dir = raw_dir.joinpath("jma-station")
 
+cache_manifest_path = raw_dir.joinpath("download_manifest.json")
+
+moe_wbgt_base_url = "https://www.wbgt.env.go.jp"
+
+# 環境省のサイトへの同時接続数とリクエストの頻度の既定値
+# 頻度は以前の実装（1ファイルごとに3秒待機）と同じに抑える
+MOE_WBGT_WORKERS = 4
+MOE_WBGT_REQUESTS_PER_SECOND = 1 / 3
+MOE_WBGT_BURST = 1
+
 
 def prepare_directory():
     moe_wbgt_dir.mkdir(parents=True, exist_ok=True)
@@ -24,29 +44,126 @@ def prepare_directory():
     jma_station_dir.mkdir(parents=True, exist_ok=True)
 
 
-def flatten_directory(source_dir, target_dir=None):
-    source_dir = Path(source_dir)
-
-    if target_dir is None:
-        target_dir = source_dir
-    else:
-        target_dir = Path(target_dir)
-        target_dir.mkdir(parents=True, exist_ok=True)
-
-    file_list = [x for x in source_dir.glob("**/*") if x.is_file()]
-    for file in file_list:
-        # 同名ファイルが存在する場合は上書き
-        shutil.move(file, target_dir.joinpath(file.name))
-
-    # 階層の深いディレクトリから削除していく
-    dir_list = sorted(list(source_dir.glob("**")), reverse=True)
-    for dir in dir_list:
-        if len([x for x in dir.glob("**/*") if x.is_file()]) == 0:
-            dir.rmdir()
+def extract_flat(zip_file, target_dir):
+    target_dir = Path(target_dir)
+    target_dir.mkdir(parents=True, exist_ok=True)
 
+    # ディレクトリ階層は再現せず、各ファイルをtarget_dir直下に直接書き出す
+    with zipfile.ZipFile(zip_file) as zf:
+        for info in zf.infolist():
+            if info.is_dir():
+                continue
 
-def download_jma_normal():
+            # 同名ファイルが存在する場合は上書き
+            target = target_dir.joinpath(PurePosixPath(info.filename).name)
+            with zf.open(info) as src, target.open("wb") as dst:
+                shutil.copyfileobj(src, dst, 1 << 20)
+
+
+class DownloadCache:
+    def __init__(self, path=cache_manifest_path):
+        # URLごとにETag, Last-Modified, サイズ, SHA-256を記録するマニフェスト
+        self.path = Path(path)
+        # JMAとMOEのダウンロードを別スレッドで同時に実行するので、記録の更新と保存は
+        # 同じロックの中で行う（保存は更新の中からも呼ぶのでRLock）
+        self._lock = threading.RLock()
+
+        if self.path.is_file():
+            with self.path.open(encoding="utf-8") as f:
+                self.entries = json.load(f)
+        else:
+            self.entries = {}
+
+    def save(self):
+        with self._lock:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            tmp = self.path.with_name(f"{self.path.name}.tmp")
+            with tmp.open("w", encoding="utf-8") as f:
+                json.dump(self.entries, f, indent=2, sort_keys=True)
+            os.replace(tmp, self.path)
+
+    # 変更がなければFalse、ダウンロードしてdestを更新した場合はTrueを返す
+    def fetch(self, session, url, dest):
+        dest = Path(dest)
+        part = dest.with_name(f"{dest.name}.part")
+        entry = self.entries.get(url, {})
+        headers = {}
+
+        # 手元のファイルが記録と一致する場合のみ条件付きリクエストにする
+        if dest.is_file() and dest.stat().st_size == entry.get("size"):
+            if entry.get("etag"):
+                headers["If-None-Match"] = entry["etag"]
+            if entry.get("last_modified"):
+                headers["If-Modified-Since"] = entry["last_modified"]
+
+        # 中断されたダウンロードは同じバージョンである場合のみ続きから取得する
+        partial = entry.get("partial", {})
+        validator = partial.get("etag") or partial.get("last_modified")
+        offset = part.stat().st_size if part.is_file() else 0
+        if offset > 0 and validator:
+            headers["Range"] = f"bytes={offset}-"
+            headers["If-Range"] = validator
+
+        with session.get(url, headers=headers, stream=True, timeout=5) as r:
+            if r.status_code == 304:
+                return False
+
+            # 途中まで取得したファイルが既に完全な場合は最初から取り直す
+            if r.status_code == 416:
+                part.unlink()
+                with self._lock:
+                    entry.pop("partial", None)
+                return self.fetch(session, url, dest)
+
+            r.raise_for_status()
+
+            etag = r.headers.get("ETag")
+            last_modified = r.headers.get("Last-Modified")
+
+            if r.status_code != 206:
+                with self._lock:
+                    entry["partial"] = {"etag": etag, "last_modified": last_modified}
+                    self.entries[url] = entry
+                    self.save()
+
+            mode = "ab" if r.status_code == 206 else "wb"
+            with part.open(mode) as f:
+                for chunk in r.iter_content(chunk_size=1 << 16):
+                    f.write(chunk)
+
+        sha256 = hashlib.sha256()
+        with part.open("rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                sha256.update(chunk)
+        digest = sha256.hexdigest()
+
+        # サーバーが条件付きリクエストに対応していなくても、内容が同じなら変更なし
+        changed = not (dest.is_file() and entry.get("sha256") == digest)
+        if changed:
+            os.replace(part, dest)
+        else:
+            os.remove(part)
+
+        with self._lock:
+            entry.pop("partial", None)
+            entry.update(
+                {
+                    "etag": etag or entry.get("etag"),
+                    "last_modified": last_modified or entry.get("last_modified"),
+                    "content_type": r.headers.get("Content-Type"),
+                    "size": dest.stat().st_size,
+                    "sha256": digest,
+                }
+            )
+            self.entries[url] = entry
+            self.save()
+
+        return changed
+
+
+def download_jma_normal(cache=None):
     save_dir = jma_normal_dir
+    cache = cache or DownloadCache()
 
     jma_normal_url = {
         "daily": "https://www.data.jma.go.jp/stats/data/mdrr/normal/2020/data/normal_amedas_daily.zip",
@@ -54,24 +171,24 @@ def download_jma_normal():
         "station": "https://www.data.jma.go.jp/stats/data/mdrr/normal/2020/data/amedas_station_index.zip",
     }
 
-    for key, url in jma_normal_url.items():
-        r = requests.get(url, timeout=5)
+    session = requests.Session()
 
+    for key, url in jma_normal_url.items():
+        # 条件付きリクエストで変更を確認するため、ZIPファイルは削除せず残しておく
         zip_filename = os.path.basename(url)
         zip_file = save_dir.joinpath(zip_filename)
-        with zip_file.open("wb") as f:
-            f.write(r.content)
 
-        with zipfile.ZipFile(zip_file) as zf:
-            zf.extractall(save_dir.joinpath(key))
+        changed = cache.fetch(session, url, zip_file)
+        if not changed and any(save_dir.joinpath(key).iterdir()):
+            print(f"Not modified: {url}")
+            continue
 
-        os.remove(zip_file)
+        extract_flat(zip_file, save_dir.joinpath(key))
 
-        flatten_directory(save_dir.joinpath(key))
 
-
-def download_jma_station():
+def download_jma_station(cache=None):
     save_dir = jma_station_dir
+    cache = cache or DownloadCache()
 
     latest_index_url = "https://www.jma.go.jp/jma/kishou/know/amedas/ame_master.zip"
     history_index_url = (
@@ -80,44 +197,154 @@ def download_jma_station():
 
     session = requests.Session()
 
-    latest_index_r = session.get(latest_index_url, timeout=5)
-
     latest_index = save_dir.joinpath(os.path.basename(latest_index_url))
-    with latest_index.open("wb") as f:
-        f.write(latest_index_r.content)
-
-    with zipfile.ZipFile(latest_index) as zf:
-        csv_list = [x for x in zf.namelist() if x.endswith(".csv")]
-        # CSVファイルが1つだけ含まれているはず
-        csv = csv_list[0]
+    changed = cache.fetch(session, latest_index_url, latest_index)
 
-        zf.extract(csv, save_dir)
+    if not changed and any(save_dir.glob("ame_master_*.csv")):
+        print(f"Not modified: {latest_index_url}")
+    else:
+        with zipfile.ZipFile(latest_index) as zf:
+            csv_list = [x for x in zf.namelist() if x.endswith(".csv")]
+            # CSVファイルが1つだけ含まれているはず
+            csv = csv_list[0]
 
-    os.remove(latest_index)
+            zf.extract(csv, save_dir)
 
-    # Shift_JISからUTF-8に変換
-    with open(save_dir.joinpath(csv), "r", encoding="cp932") as f:
-        content = f.read()
-    with open(save_dir.joinpath(csv), "w", encoding="utf-8") as f:
-        f.write(content)
+        # Shift_JISからUTF-8に変換
+        with open(save_dir.joinpath(csv), "r", encoding="cp932") as f:
+            content = f.read()
+        with open(save_dir.joinpath(csv), "w", encoding="utf-8") as f:
+            f.write(content)
 
-    history_index_r = session.get(history_index_url, timeout=5)
+    history_index_raw = save_dir.joinpath(os.path.basename(history_index_url))
+    changed = cache.fetch(session, history_index_url, history_index_raw)
 
     history_index = save_dir.joinpath(f"{os.path.basename(history_index_url)}.csv")
+    if not changed and history_index.is_file():
+        print(f"Not modified: {history_index_url}")
+        return
+
+    # レスポンスヘッダーの文字コードでデコードする
+    content_type = cache.entries[history_index_url].get("content_type") or ""
+    encoding = (
+        requests.utils.get_encoding_from_headers({"content-type": content_type})
+        or "utf-8"
+    )
     with history_index.open("w", encoding="utf-8") as f:
-        f.write(history_index_r.text)
-
-
-def download_moe_wbgt(start_year=2020, end_year=2024):
-    save_dir = moe_wbgt_dir
-    # 連続アクセスを避けるための待機時間（秒）
-    download_delay = 3
-
-    point_url = "https://www.wbgt.env.go.jp/js/point.js"
-    r = requests.get(point_url, timeout=5)
+        f.write(history_index_raw.read_bytes().decode(encoding))
+
+    # 元データが更新されたので、main.pyが作る整形済みファイルは作り直させる
+    history_index.with_name("amdmaster.index4.cleaned.csv").unlink(missing_ok=True)
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity=1):
+        # rate: 1秒あたりに補充されるトークン数, capacity: バースト上限
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(
+                self.capacity, self._tokens + (now - self._last) * self.rate
+            )
+            self._last = now
+            # トークンを先に予約し、不足分だけ待機する
+            self._tokens -= 1
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0
+
+        if wait > 0:
+            time.sleep(wait)
+
+
+class HostRateLimiter:
+    def __init__(self, rate, capacity=1):
+        self.rate = rate
+        self.capacity = capacity
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def wait(self, url):
+        host = urlsplit(url).netloc
+        with self._lock:
+            if host not in self._buckets:
+                self._buckets[host] = TokenBucket(self.rate, self.capacity)
+            bucket = self._buckets[host]
+        bucket.acquire()
+
+
+def create_retry_session():
+    session = requests.Session()
+    retry = Retry(
+        total=3,
+        connect=3,
+        read=3,
+        backoff_factor=1,
+        status_forcelist=[429, 500, 502, 503, 504],
+    )
+    adapter = HTTPAdapter(max_retries=retry)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+def fetch_moe_wbgt_file(session, limiter, url, save_path):
+    limiter.wait(url)
+
+    try:
+        r = session.get(url, timeout=5)
+    except requests.exceptions.RetryError:
+        print(f"Failed to download after retries: {url}")
+        return "failed"
+
+    if r.status_code == 404:
+        print(f"Not found: {url}")
+        return "not_found"
+
+    if r.status_code == 403:
+        print(f"Access forbidden: {url}")
+        return "forbidden"
+
+    if r.text.startswith('<?xml version="1.0" encoding="UTF-8"?>'):
+        print(f"Invalid file: {url}")
+        return "invalid"
+
+    with save_path.open("wb") as f:
+        f.write(r.content)
+
+    print(f"Downloaded: {save_path}")
+    return "downloaded"
+
+
+def download_moe_wbgt(
+    start_year=2020,
+    end_year=2024,
+    base_url=moe_wbgt_base_url,
+    save_dir=moe_wbgt_dir,
+    max_workers=MOE_WBGT_WORKERS,
+    requests_per_second=MOE_WBGT_REQUESTS_PER_SECOND,
+    burst=MOE_WBGT_BURST,
+    cache=None,
+):
+    save_dir = Path(save_dir)
+    cache = cache or DownloadCache()
+    # 同一ホストへの連続アクセスを避けるためのレート制限
+    limiter = HostRateLimiter(requests_per_second, burst)
+
+    point_url = f"{base_url}/js/point.js"
+    point_file = save_dir.joinpath("point.js")
+    limiter.wait(point_url)
+    if not cache.fetch(requests.Session(), point_url, point_file):
+        print(f"Not modified: {point_url}")
 
     point_raw = re.search(
-        r"^var point = ({.*^});", r.text, flags=re.MULTILINE | re.DOTALL
+        r"^var point = ({.*^});",
+        point_file.read_text(encoding="utf-8"),
+        flags=re.MULTILINE | re.DOTALL,
     ).group(1)
     point_json = json.loads(point_raw)
 
@@ -130,62 +357,98 @@ def download_moe_wbgt(start_year=2020, end_year=2024):
         (y, m) for y in range(start_year, end_year + 1) for m in range(4, 11)
     ]
 
-    session = requests.Session()
-    retry = Retry(
-        total=3,
-        connect=3,
-        read=3,
-        backoff_factor=1,
-        status_forcelist=[429, 500, 502, 503, 504],
-    )
-    session.mount("https://", HTTPAdapter(max_retries=retry))
+    # 以前の配置で保存済みのファイルは、取得し直さずに移動する
+    wbgt_layout.convert_flat_layout(save_dir)
 
+    tasks = []
     for point in point_list:
-        save_dir.joinpath(point).mkdir(parents=True, exist_ok=True)
-
         for year, month in year_month_pairs:
-            url = f"https://www.wbgt.env.go.jp/mntr/final/{year}/wbgt_{year}/final_wbgt_{point}_{year}{month:02d}.csv"
-            filename = os.path.basename(url)
-            save_path = save_dir.joinpath(point, filename)
+            filename = wbgt_layout.file_name(point, year, month)
+            url = f"{base_url}/mntr/final/{year}/wbgt_{year}/{filename}"
+            save_path = wbgt_layout.raw_path(save_dir, point, year, month)
 
+            # 既存ファイルはリクエストを送らないので待機も不要
             if save_path.is_file():
                 print(f"Already exists: {save_path}")
                 continue
 
-            try:
-                r = session.get(url, timeout=5)
-            except requests.exceptions.RetryError:
-                print(f"Failed to download after retries: {url}")
-                time.sleep(download_delay)
-                continue
-
-            if r.status_code == 404:
-                print(f"Not found: {url}")
-                time.sleep(download_delay)
-                continue
+            save_path.parent.mkdir(parents=True, exist_ok=True)
+            tasks.append((url, save_path))
 
-            if r.status_code == 403:
-                print(f"Access forbidden: {url}")
-                time.sleep(download_delay)
-                continue
+    # セッションはスレッドごとに作る
+    local = threading.local()
 
-            if r.text.startswith('<?xml version="1.0" encoding="UTF-8"?>'):
-                print(f"Invalid file: {url}")
-                time.sleep(download_delay)
-                continue
+    def worker(url, save_path):
+        if not hasattr(local, "session"):
+            local.session = create_retry_session()
+        return fetch_moe_wbgt_file(local.session, limiter, url, save_path)
 
-            with save_path.open("wb") as f:
-                f.write(r.content)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        results = list(executor.map(lambda task: worker(*task), tasks))
 
-            print(f"Downloaded: {save_path}")
-            time.sleep(download_delay)
+    return Counter(results)
 
 
 def main():
+    parser = argparse.ArgumentParser(description="Download the JMA and MOE source data")
+    parser.add_argument(
+        "--wbgt-start-year",
+        type=int,
+        default=2020,
+        help="first year of MOE WBGT files to download (default: 2020)",
+    )
+    parser.add_argument(
+        "--wbgt-end-year",
+        type=int,
+        default=2024,
+        help="last year of MOE WBGT files to download (default: 2024)",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=MOE_WBGT_WORKERS,
+        help=f"concurrent MOE WBGT downloads (default: {MOE_WBGT_WORKERS})",
+    )
+    parser.add_argument(
+        "--rate",
+        type=float,
+        default=MOE_WBGT_REQUESTS_PER_SECOND,
+        help="MOE WBGT requests per second (default: 1/3, one request every 3s)",
+    )
+    parser.add_argument(
+        "--burst",
+        type=int,
+        default=MOE_WBGT_BURST,
+        help=f"MOE WBGT requests allowed at once (default: {MOE_WBGT_BURST})",
+    )
+    args = parser.parse_args()
+    if args.workers < 1 or args.rate <= 0 or args.burst < 1:
+        parser.error("--workers and --burst must be at least 1 and --rate positive")
+
     prepare_directory()
-    download_jma_normal()
-    download_jma_station()
-    download_moe_wbgt()
+    cache = DownloadCache()
+
+    # JMAとMOEは別のホストなので同時に取得する
+    # JMAの2つは同じホストなので順番に取得する
+    def download_jma():
+        download_jma_normal(cache)
+        download_jma_station(cache)
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        futures = [
+            executor.submit(download_jma),
+            executor.submit(
+                download_moe_wbgt,
+                args.wbgt_start_year,
+                args.wbgt_end_year,
+                max_workers=args.workers,
+                requests_per_second=args.rate,
+                burst=args.burst,
+                cache=cache,
+            ),
+        ]
+        for future in futures:
+            future.result()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,70 @@
+import json
+import os
+from pathlib import Path
+
+# 観測所番号をキーとするJSONオブジェクトを1観測所ずつ書き出すライター
+# 全観測所分のdictをメモリに持たずに済み、
+# indent=2の場合はjson.dump(dict, f, indent=2)と同じバイト列になる
+
+
+class StationJsonWriter:
+    def __init__(self, path, compact=False, ensure_ascii=True):
+        self.path = Path(path)
+        # 書き込み中は一時ファイルに出力し、完了後にリネームする
+        self.tmp_path = self.path.with_name(f"{self.path.name}.tmp")
+        self.compact = compact
+        self.ensure_ascii = ensure_ascii
+        self._file = None
+        self._count = 0
+        # 観測所ごとの出力バイト数
+        self.sizes = {}
+
+    def __enter__(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._file = self.tmp_path.open("w", encoding="utf-8")
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        try:
+            if exc_type is None:
+                self._file.write(self._closing())
+        finally:
+            self._file.close()
+
+        if exc_type is None:
+            os.replace(self.tmp_path, self.path)
+        else:
+            self.tmp_path.unlink(missing_ok=True)
+
+    def write(self, station_number, payload):
+        if self.compact:
+            entry = json.dumps(
+                {station_number: payload},
+                ensure_ascii=self.ensure_ascii,
+                separators=(",", ":"),
+            )[1:-1]
+            separator = "," if self._count else "{"
+        else:
+            # 1要素のオブジェクトとして整形し、外側の括弧を外すとインデントが揃う
+            entry = json.dumps(
+                {station_number: payload}, ensure_ascii=self.ensure_ascii, indent=2
+            )[2:-2]
+            separator = ",\n" if self._count else "{\n"
+
+        self._file.write(separator)
+        self._file.write(entry)
+        self._count += 1
+        self.sizes[station_number] = len(entry.encode("utf-8"))
+
+    def _closing(self):
+        if self._count == 0:
+            return "{}"
+        return "}" if self.compact else "\n}"
+
+
+def write_station_json(path, items, compact=False, ensure_ascii=True):
+    with StationJsonWriter(path, compact=compact, ensure_ascii=ensure_ascii) as w:
+        for station_number, payload in items:
+            w.write(station_number, payload)
+
+    return w.sizes
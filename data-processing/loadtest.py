@@ -0,0 +1,222 @@
+import argparse
+import asyncio
+import json
+import os
+import random
+import statistics
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+import store
+
+# server.pyに対してローカルで負荷をかけ、スループットと応答時間を計測する
+# ダッシュボードのポーリングを想定し、一部の観測所に偏ったリクエストを
+# keep-aliveの接続で送り、前回のETagでの再検証（304）も混ぜる
+
+
+def build_targets(station_numbers, count, seed=0):
+    rng = random.Random(seed)
+    hot = station_numbers[: max(1, len(station_numbers) // 10)]
+
+    targets = []
+    for _ in range(count):
+        station_number = rng.choice(hot if rng.random() < 0.8 else station_numbers)
+        kind = rng.random()
+        if kind < 0.3:
+            element = rng.choice(list(store.DAILY_ELEMENTS))
+            targets.append(f"/stations/{station_number}/daily/{element}")
+        elif kind < 0.6:
+            element = rng.choice(list(store.MONTHLY_ELEMENTS))
+            targets.append(f"/stations/{station_number}/monthly/{element}")
+        elif kind < 0.75:
+            targets.append(f"/stations/{station_number}")
+        elif kind < 0.9:
+            element = rng.choice(list(store.MONTHLY_ELEMENTS))
+            targets.append(f"/ranking/{element}?month={rng.randint(0, 12)}&n=20")
+        elif kind < 0.99:
+            south = rng.randint(24, 44)
+            west = rng.randint(123, 144)
+            targets.append(
+                f"/bbox?south={south}&west={west}&north={south + 1}&east={west + 1}"
+            )
+        else:
+            targets.append("/stations")
+    return targets
+
+
+async def read_response(reader):
+    status_line = await reader.readline()
+    if not status_line:
+        raise ConnectionError("connection closed")
+
+    status = int(status_line.split()[1])
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b""):
+            break
+        name, _, value = line.decode("latin-1").partition(":")
+        headers[name.strip().lower()] = value.strip()
+
+    body = await reader.readexactly(int(headers.get("content-length", 0)))
+    return status, headers, body
+
+
+async def run_connection(host, port, queue, results, encoding, revalidate):
+    reader, writer = await asyncio.open_connection(host, port)
+    etags = {}
+    try:
+        while True:
+            try:
+                target = queue.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+
+            headers = [f"GET {target} HTTP/1.1", f"Host: {host}"]
+            if encoding:
+                headers.append(f"Accept-Encoding: {encoding}")
+            if revalidate and target in etags:
+                headers.append(f"If-None-Match: {etags[target]}")
+
+            start = time.perf_counter()
+            writer.write(("\r\n".join(headers) + "\r\n\r\n").encode("latin-1"))
+            await writer.drain()
+            status, response_headers, body = await read_response(reader)
+            results.append((time.perf_counter() - start, status, len(body)))
+
+            if "etag" in response_headers:
+                etags[target] = response_headers["etag"]
+    finally:
+        writer.close()
+
+
+async def run_load(host, port, targets, connections, encoding, revalidate):
+    queue = asyncio.Queue()
+    for target in targets:
+        queue.put_nowait(target)
+
+    results = []
+    start = time.perf_counter()
+    await asyncio.gather(
+        *(
+            run_connection(host, port, queue, results, encoding, revalidate)
+            for _ in range(connections)
+        )
+    )
+    return time.perf_counter() - start, results
+
+
+def summarize(elapsed, results):
+    latencies = sorted(x[0] for x in results)
+    statuses = {}
+    for _, status, _ in results:
+        statuses[status] = statuses.get(status, 0) + 1
+    quantiles = statistics.quantiles(latencies, n=100)
+
+    return {
+        "requests": len(results),
+        "seconds": round(elapsed, 3),
+        "requests_per_second": round(len(results) / elapsed, 1),
+        "latency_ms": {
+            "p50": round(quantiles[49] * 1e3, 3),
+            "p90": round(quantiles[89] * 1e3, 3),
+            "p99": round(quantiles[98] * 1e3, 3),
+            "max": round(latencies[-1] * 1e3, 3),
+        },
+        "statuses": statuses,
+        "body_bytes": sum(x[2] for x in results),
+    }
+
+
+async def fetch_json(host, port, target):
+    reader, writer = await asyncio.open_connection(host, port)
+    writer.write(f"GET {target} HTTP/1.1\r\nHost: {host}\r\n\r\n".encode("latin-1"))
+    await writer.drain()
+    _, _, body = await read_response(reader)
+    writer.close()
+    return json.loads(body)
+
+
+async def wait_for_server(host, port, timeout=30):
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            _, writer = await asyncio.open_connection(host, port)
+            writer.close()
+            return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            await asyncio.sleep(0.1)
+
+
+async def run(args):
+    await wait_for_server(args.host, args.port)
+    station_numbers = sorted(await fetch_json(args.host, args.port, "/stations"))
+    targets = build_targets(station_numbers, args.requests, args.seed)
+
+    for encoding in args.encodings.split(","):
+        elapsed, results = await run_load(
+            args.host,
+            args.port,
+            targets,
+            args.connections,
+            "" if encoding == "identity" else encoding,
+            args.revalidate,
+        )
+        print(json.dumps({"encoding": encoding} | summarize(elapsed, results)))
+
+    print(json.dumps({"server": await fetch_json(args.host, args.port, "/stats")}))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load-test server.py locally")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--requests", type=int, default=20000)
+    parser.add_argument("--connections", type=int, default=32)
+    parser.add_argument(
+        "--encodings",
+        default="identity,gzip,br",
+        help="comma-separated Accept-Encoding values, one run each",
+    )
+    parser.add_argument(
+        "--revalidate",
+        action="store_true",
+        help="send If-None-Match with the last ETag seen for each URL",
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--spawn",
+        action="store_true",
+        help="start server.py in a subprocess for the duration of the test",
+    )
+    args = parser.parse_args()
+
+    server = None
+    if args.spawn:
+        server = subprocess.Popen(
+            [
+                sys.executable,
+                Path(__file__).with_name("server.py"),
+                "--host",
+                args.host,
+                "--port",
+                str(args.port),
+            ],
+            env=os.environ,
+            stdout=subprocess.DEVNULL,
+        )
+
+    try:
+        asyncio.run(run(args))
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+
+if __name__ == "__main__":
+    main()
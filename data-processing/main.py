@@ -1,7 +1,18 @@
+import argparse
+import contextlib
+import datetime
+import functools
+import itertools
 import json
+import math
+import multiprocessing
+import os
+import statistics
+import time
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 
-import duckdb
+import numpy as np
 from duckdb import (
     CaseExpression,
     ColumnExpression,
@@ -10,11 +21,69 @@ from duckdb import (
     SQLExpression,
 )
 
-data_dir = Path(__file__).parents[1].joinpath("data")
+import aggregates
+import map_tiles
+import metrics
+import pipeline
+import publish
+import series_binary
+import similarity
+import spatial
+import staging
+import store
+import surface
+from json_writer import StationJsonWriter, write_station_json
+
+# 環境変数JCD_DATA_DIRでデータディレクトリを差し替えられる（ベンチマーク用）
+data_dir = Path(
+    os.environ.get("JCD_DATA_DIR", Path(__file__).parents[1].joinpath("data"))
+)
 processed_dir = data_dir.joinpath("processed")
-moe_wbgt_dir = data_dir.joinpath("raw", "moe-wbgt")
-jma_normal_dir = data_dir.joinpath("raw", "jma-normal")
-jma_station_dir = data_dir.joinpath("raw", "jma-station")
+build_manifest_path = processed_dir.joinpath("build_manifest.json")
+# 段階ごとの前回の実行時の設定（出力が新しくても設定が変われば作り直す）
+stage_state_path = processed_dir.joinpath("build_stages.json")
+metrics_dir = data_dir.joinpath("metrics")
+
+# 平年値CSVの要素番号
+NORMAL_ELEMENTS = {
+    "temperature": "0500",
+    "precipitation": "4000",
+    "sunshine_duration": "3500",
+}
+
+# 観測所ごとのデータを持つ出力
+station_datasets = [
+    "daily_normal",
+    "monthly_yearly_normal",
+    "daily_wbgt",
+    "monthly_yearly_wbgt",
+    "heat_risk",
+]
+
+# 月 * 32 + 日 -> "月/日"
+DAY_KEYS = np.array([f"{m}/{d}" for m in range(13) for d in range(32)], dtype=object)
+
+# WBGTを集計する年の範囲（両端を含む）
+WBGT_YEARS = (2020, 2024)
+# 暑さ指数が公表される月（4〜10月）。1年に7ファイルある
+WBGT_MONTHS = range(4, 11)
+# 年の範囲で公表されるはずのファイルのうち、この割合以上がそろっている地点だけを集計する
+# 1.0の場合は範囲内のすべての月のファイルが必要（2020〜2024年なら35ファイル）
+WBGT_MIN_COVERAGE = 1.0
+
+
+# 暑さ指数の基準（25以上は警戒、28以上は厳重警戒、31以上は危険）
+HEAT_RISK_THRESHOLDS = [25, 28, 31]
+# 日最高WBGTの分位点（線形補間した厳密な分位点）
+HEAT_RISK_QUANTILES = {"p50": 0.5, "p90": 0.9, "p99": 0.99}
+# 初めて・最後に基準に達した日は4月1日からの日数で集計し、閏年のない年で日付に戻す
+SEASON_START = datetime.date(2021, 4, 1)
+
+
+def wbgt_required_files(years, min_coverage):
+    expected = (years[1] - years[0] + 1) * len(WBGT_MONTHS)
+    # 浮動小数点の誤差で1ファイル多く要求しないよう、小数点以下を丸めてから切り上げる
+    return max(1, math.ceil(round(expected * min_coverage, 6)))
 
 
 def build_case_expression(prefix, index=None, alias=None, scale=10):
@@ -30,276 +99,380 @@ def build_case_expression(prefix, index=None, alias=None, scale=10):
     )
 
 
-def query_daily(relation: DuckDBPyRelation, element_number):
+def query_daily(relation: DuckDBPyRelation, element_numbers):
     case_list = [build_case_expression("day", i) for i in range(1, 32)]
+    element_list = ", ".join(str(int(x)) for x in element_numbers)
 
-    return relation.select(
-        "element_number",
-        "month",
-        *case_list,
-    ).filter(f"element_number == {element_number}")
+    return (
+        relation.select(
+            "station_number",
+            SQLExpression("cast(element_number as int)").alias("element_number"),
+            "month",
+            *case_list,
+        )
+        .filter(f"element_number in ({element_list})")
+        .order("station_number, element_number, month")
+    )
 
 
-def query_monthly_yearly(relation: DuckDBPyRelation, element_number):
+def query_monthly_yearly(relation: DuckDBPyRelation, element_numbers):
     case_list = [build_case_expression("month", i) for i in range(1, 13)]
     case_list.append(build_case_expression("year"))
+    element_list = ", ".join(str(int(x)) for x in element_numbers)
 
-    return relation.select(
-        "element_number",
-        *case_list,
-    ).filter(f"element_number == {element_number}")
-
-
-def convert_all_none_to_none(x: tuple | list):
-    if set(x) == {None}:
-        return None
-    else:
-        return x
+    return (
+        relation.select(
+            "station_number",
+            SQLExpression("cast(element_number as int)").alias("element_number"),
+            *case_list,
+        )
+        .filter(f"element_number in ({element_list})")
+        .order("station_number, element_number")
+    )
 
 
-def create_daily_normal_object():
-    csv_files = jma_normal_dir.joinpath("daily").glob("nml_amd_d_*.csv")
+def fetch_columns(relation: DuckDBPyRelation):
+    # 結果をPythonのタプルにせず、列ごとのNumPy配列で取り出す
+    # NULLを含む列はマスク付き配列になり、tolist()でマスクされた値がNoneになる
+    start = time.perf_counter()
+    columns = relation.fetchnumpy()
+    row_count = len(next(iter(columns.values()), []))
+    metrics.record_query(time.perf_counter() - start, row_count)
+    return columns
 
-    column_names = [
-        "period_type",
-        "station_number",
-        "element_number",
-        "data_years",
-        "start_year",
-        "end_year",
-        "month",
-    ]
 
-    for day in range(1, 32):
-        column_names.append(f"day{day}_value")
-        column_names.append(f"day{day}_remark")
-
-    normal_data = {}
-
-    for csv in csv_files:
-        daily = duckdb.read_csv(csv, names=column_names).set_alias("daily")
-
-        temperature = {}
-        result = query_daily(daily, "0500").fetchall()
-        for month in result:
-            temperature[month[1]] = convert_all_none_to_none(month[2:])
-        if set(temperature.values()) == {None}:
-            temperature = None
-
-        precipitation = {}
-        result = query_daily(daily, "4000").fetchall()
-        for month in result:
-            precipitation[month[1]] = convert_all_none_to_none(month[2:])
-        if set(precipitation.values()) == {None}:
-            precipitation = None
-
-        sunshine_duration = {}
-        result = query_daily(daily, "3500").fetchall()
-        for month in result:
-            sunshine_duration[month[1]] = convert_all_none_to_none(month[2:])
-        if set(sunshine_duration.values()) == {None}:
-            sunshine_duration = None
-
-        station_number = csv.stem.split("_")[-1]
-        normal_data[station_number] = {
-            "temperature": temperature,
-            "precipitation": precipitation,
-            "sunshine_duration": sunshine_duration,
-        }
-        print(f"Loaded station {station_number}")
+def stack_columns(columns, names):
+    # 複数の列を (行数, 列数) のマスク付き配列にまとめる
+    return np.ma.column_stack([columns[x] for x in names])
 
-    return normal_data
 
+def rows_to_lists(values: np.ma.MaskedArray):
+    # 行ごとのリストにし、すべての値がNULLの行はNoneにする
+    rows = values.tolist()
+    for i in np.flatnonzero(np.ma.getmaskarray(values).all(axis=1)).tolist():
+        rows[i] = None
+    return rows
 
-def create_monthly_yearly_normal_object():
-    csv_files = jma_normal_dir.joinpath("monthly").glob("nml_amd_m_*.csv")
 
-    column_names = [
-        "period_type",
-        "station_number",
-        "element_number",
-        "data_years",
-        "start_year",
-        "end_year",
-    ]
+def iter_groups(*keys):
+    # 並んだキーが同じ行の範囲 (開始, 終了) を順に返す
+    row_count = len(keys[0])
+    if row_count == 0:
+        return []
 
-    for month in range(1, 13):
-        column_names.append(f"month{month}_value")
-        column_names.append(f"month{month}_remark")
+    changed = np.zeros(row_count, dtype=bool)
+    changed[0] = True
+    for key in keys:
+        changed[1:] |= key[1:] != key[:-1]
 
-    column_names.append("year_value")
-    column_names.append("year_remark")
+    starts = np.flatnonzero(changed).tolist()
+    return list(zip(starts, starts[1:] + [row_count]))
 
-    normal_data = {}
 
-    for csv in csv_files:
-        monthly = duckdb.read_csv(csv, names=column_names).set_alias("monthly")
+def iter_daily_normal(stations=None):
+    with metrics.batch("query_daily_normal"):
+        daily = staging.load("daily_normal", stations).set_alias("daily")
+        columns = fetch_columns(query_daily(daily, NORMAL_ELEMENTS.values()))
 
-        raw_temperature = query_monthly_yearly(monthly, "0500").fetchall()
-        raw_precipitation = query_monthly_yearly(monthly, "4000").fetchall()
-        raw_sunshine_duration = query_monthly_yearly(monthly, "3500").fetchall()
+    return group_daily_normal(columns)
 
-        station_number = csv.stem.split("_")[-1]
-        normal_data[station_number] = {
-            "monthly": {
-                "temperature": convert_all_none_to_none(raw_temperature[0][1:-1]),
-                "precipitation": convert_all_none_to_none(raw_precipitation[0][1:-1]),
-                "sunshine_duration": convert_all_none_to_none(
-                    raw_sunshine_duration[0][1:-1]
-                ),
-            },
-            "yearly": {
-                "temperature": raw_temperature[0][-1],
-                "precipitation": raw_precipitation[0][-1],
-                "sunshine_duration": raw_sunshine_duration[0][-1],
-            },
-        }
-        print(f"Loaded station {station_number}")
 
-    return normal_data
+def group_daily_normal(columns):
+    element_names = {int(v): k for k, v in NORMAL_ELEMENTS.items()}
 
+    with metrics.batch("group_daily_normal"):
+        days = stack_columns(columns, [f"day{i}" for i in range(1, 32)])
+        values = rows_to_lists(days)
+        months = columns["month"].tolist()
+        station_numbers = columns["station_number"].tolist()
+        element_numbers = columns["element_number"].tolist()
 
-def create_daily_wbgt_object():
-    dirs = [x for x in moe_wbgt_dir.glob("*") if x.is_dir()]
+        # 観測所・要素ごとに、すべての月がNULLかどうかを列方向にまとめて判定する
+        groups = iter_groups(columns["station_number"], columns["element_number"])
+        all_none = np.ma.getmaskarray(days).all(axis=1)
+        if groups:
+            element_all_none = np.logical_and.reduceat(
+                all_none, [start for start, _ in groups]
+            ).tolist()
+        else:
+            element_all_none = []
 
-    wbgt_data = {}
-    for dir in dirs:
-        # 5年 * 7ヶ月 = 35ファイルあるはず
-        if len(list(dir.glob("final_wbgt_*.csv"))) != 35:
-            continue
+    for station_number, element_groups in itertools.groupby(
+        zip(groups, element_all_none), key=lambda x: station_numbers[x[0][0]]
+    ):
+        station = {key: {} for key in NORMAL_ELEMENTS}
+        row_count = 0
 
-        hourly = duckdb.read_csv(dir.joinpath("final_wbgt_*.csv")).set_alias("hourly")
+        for (start, end), is_none in element_groups:
+            key = element_names[element_numbers[start]]
+            if is_none:
+                station[key] = None
+            else:
+                station[key] = dict(zip(months[start:end], values[start:end]))
+            row_count += end - start
 
-        min_max_by_date = (
-            hourly.select(
-                "Date",
-                "WBGT",
-            )
-            .aggregate(
-                aggr_expr=[
-                    "Date",
-                    SQLExpression("min(WBGT)").alias("min_wbgt"),
-                    SQLExpression("max(WBGT)").alias("max_wbgt"),
-                ],
-                group_expr="Date",
-            )
-            .order("Date")
-            .set_alias("min_max_by_date")
-        )
+        metrics.add_rows(row_count)
+        yield station_number, station
 
-        daily = (
-            hourly.join(min_max_by_date, condition="Date")
-            .select(
-                SQLExpression("month(Date)").alias("month"),
-                SQLExpression("day(Date)").alias("day"),
-                "WBGT",
-                "min_wbgt",
-                "max_wbgt",
-            )
-            .aggregate(
-                aggr_expr=[
-                    "month",
-                    "day",
-                    SQLExpression("round_even(avg(min_wbgt), 1)").alias("min_wbgt"),
-                    SQLExpression("round_even(avg(max_wbgt), 1)").alias("max_wbgt"),
-                    SQLExpression("round_even(avg(WBGT), 1)").alias("avg_wbgt"),
-                ],
-                group_expr="month, day",
-            )
-            .order("month, day")
-            .fetchall()
-        )
 
-        station_number = dir.stem
-        wbgt_data[station_number] = {
-            f"{d[0]}/{d[1]}": {
-                "min": d[2],
-                "max": d[3],
-                "avg": d[4],
-            }
-            for d in daily
-        }
-        print(f"Loaded station {station_number}")
+def create_daily_normal_object(stations=None):
+    return dict(iter_daily_normal(stations))
 
-    return wbgt_data
 
+def iter_monthly_yearly_normal(stations=None):
+    with metrics.batch("query_monthly_yearly_normal"):
+        monthly = staging.load("monthly_normal", stations).set_alias("monthly")
+        columns = fetch_columns(query_monthly_yearly(monthly, NORMAL_ELEMENTS.values()))
 
-def create_monthly_yearly_wbgt_object():
-    dirs = [x for x in moe_wbgt_dir.glob("*") if x.is_dir()]
+    return group_monthly_yearly_normal(columns)
 
-    wbgt_data = {}
-    for dir in dirs:
-        # 5年 * 7ヶ月 = 35ファイルあるはず
-        if len(list(dir.glob("final_wbgt_*.csv"))) != 35:
-            continue
 
-        hourly = duckdb.read_csv(dir.joinpath("final_wbgt_*.csv")).set_alias("hourly")
+def group_monthly_yearly_normal(columns):
+    element_names = {int(v): k for k, v in NORMAL_ELEMENTS.items()}
 
-        yearly = (
-            hourly.select("WBGT")
-            .aggregate([SQLExpression("round_even(avg(WBGT), 1)").alias("avg_wbgt")])
-            .fetchone()
+    with metrics.batch("group_monthly_yearly_normal"):
+        monthly_values = rows_to_lists(
+            stack_columns(columns, [f"month{i}" for i in range(1, 13)])
         )
-
-        monthly = (
-            hourly.select(
-                SQLExpression("month(Date)").alias("month"),
-                "WBGT",
-            )
-            .aggregate(
-                aggr_expr=[
-                    "month",
-                    SQLExpression("round_even(avg(WBGT), 1)").alias("avg_wbgt"),
-                ],
-                group_expr="month",
-            )
-            .order("month")
-            .fetchall()
+        yearly_values = columns["year"].tolist()
+        station_numbers = columns["station_number"].tolist()
+        element_numbers = columns["element_number"].tolist()
+
+        groups = iter_groups(columns["station_number"], columns["element_number"])
+    for station_number, element_groups in itertools.groupby(
+        groups, key=lambda x: station_numbers[x[0]]
+    ):
+        # 要素ごとに最初の行だけを使う
+        rows = {}
+        row_count = 0
+        for start, end in element_groups:
+            rows[element_names[element_numbers[start]]] = start
+            row_count += end - start
+
+        metrics.add_rows(row_count)
+        yield (
+            station_number,
+            {
+                "monthly": {key: monthly_values[rows[key]] for key in NORMAL_ELEMENTS},
+                "yearly": {key: yearly_values[rows[key]] for key in NORMAL_ELEMENTS},
+            },
         )
 
-        station_number = dir.stem
-        wbgt_data[station_number] = {
-            "yearly": yearly[0],
-            "monthly": {m[0]: m[1] for m in monthly},
-        }
-        print(f"Loaded station {station_number}")
-
-    return wbgt_data
-
 
-# amdmaster.index4.csvの2行目が列の単位を示す行になっており、
-# DuckDBで読み込むときに邪魔になるので削除する。
-def ensure_cleaned_amdmaster_index():
-    src = jma_station_dir.joinpath("amdmaster.index4.csv")
-    dst = jma_station_dir.joinpath("amdmaster.index4.cleaned.csv")
+def create_monthly_yearly_normal_object(stations=None):
+    return dict(iter_monthly_yearly_normal(stations))
 
-    if dst.exists():
-        return dst
 
-    with open(src, encoding="utf-8") as old, open(dst, "w", encoding="utf-8") as new:
-        for i, line in enumerate(old):
-            if i == 1:
-                continue
-            new.write(line)
-
-    return dst
-
-
-def get_latest_ame_master_index():
-    dir = jma_station_dir
-    files = list(dir.glob("ame_master_*.csv"))
-    files.sort()
-    return files[-1]
+def query_wbgt_aggregates(
+    stations=None, years=WBGT_YEARS, min_coverage=WBGT_MIN_COVERAGE
+):
+    # 全地点の毎時データを1回のスキャンで読み込む
+    # yearはステージングのディレクトリ名なので、範囲外の年のParquetは読まれない
+    hourly = (
+        staging.load("wbgt", stations)
+        .filter(f"year BETWEEN {int(years[0])} AND {int(years[1])}")
+        .set_alias("hourly")
+    )
 
+    # 日別の最小・最大はウィンドウ関数で各行に付与し、結合せずに集計する
+    # first_hourは日ごとに1行だけ真になり、日数や日最高WBGTの分布を数えるのに使う
+    by_hour = (
+        hourly.select(
+            "station_number",
+            "year",
+            SQLExpression("month(Date)").alias("month"),
+            SQLExpression("day(Date)").alias("day"),
+            SQLExpression("date_diff('day', make_date(year, 4, 1), Date)").alias(
+                "season_day"
+            ),
+            "WBGT",
+            SQLExpression("min(WBGT) OVER (PARTITION BY station_number, Date)").alias(
+                "min_wbgt"
+            ),
+            SQLExpression("max(WBGT) OVER (PARTITION BY station_number, Date)").alias(
+                "max_wbgt"
+            ),
+            SQLExpression(
+                "row_number() OVER (PARTITION BY station_number, Date) = 1"
+            ).alias("first_hour"),
+            SQLExpression(
+                "count(DISTINCT filename) OVER (PARTITION BY station_number)"
+            ).alias("file_count"),
+        )
+        .filter(f"file_count >= {wbgt_required_files(years, min_coverage)}")
+        .set_alias("by_hour")
+    )
 
-def create_station_index_object():
-    history_index = ensure_cleaned_amdmaster_index()
-    history_index = duckdb.read_csv(history_index, normalize_names=True).set_alias(
-        "history_index"
+    # 暑さ指数の基準ごとの日数・時間数（1年あたり）と、年ごとの最初と最後の日
+    heat_risk = []
+    for threshold in HEAT_RISK_THRESHOLDS:
+        exceeded = f"max_wbgt >= {threshold}"
+        heat_risk += [
+            SQLExpression(
+                f"round_even(count(*) FILTER (WHERE first_hour AND {exceeded})"
+                " / count(DISTINCT year), 1)"
+            ).alias(f"days_{threshold}"),
+            SQLExpression(
+                f"round_even(count(*) FILTER (WHERE WBGT >= {threshold})"
+                " / count(DISTINCT year), 1)"
+            ).alias(f"hours_{threshold}"),
+            SQLExpression(f"min(season_day) FILTER (WHERE {exceeded})").alias(
+                f"first_{threshold}"
+            ),
+            SQLExpression(f"max(season_day) FILTER (WHERE {exceeded})").alias(
+                f"last_{threshold}"
+            ),
+        ]
+    # 分位点は1つの集計関数でまとめて求め、グループごとの状態を1つにする
+    # 近似分位点は同じクエリに含まれる観測所によって値が変わり、--workersや
+    # --incrementalの結果が全体の作り直しと一致しなくなるので、厳密に求める
+    quantiles = ", ".join(str(x) for x in HEAT_RISK_QUANTILES.values())
+    heat_risk.append(
+        SQLExpression(
+            f"list_transform(quantile_cont(max_wbgt, [{quantiles}])"
+            " FILTER (WHERE first_hour), x -> round_even(x, 1))"
+        ).alias("daily_max_quantiles")
     )
 
-    latest_index = get_latest_ame_master_index()
-    latest_index = duckdb.read_csv(latest_index).set_alias("latest_index")
+    # 月日別・月別・年間・年ごとの集計をGROUPING SETSでまとめて計算する
+    # level: 1 = 月日別, 3 = 月別, 7 = 年間, 6 = 年ごと（最初と最後の日の集計用）
+    return by_hour.aggregate(
+        aggr_expr=[
+            "station_number",
+            "month",
+            "day",
+            "year",
+            SQLExpression("grouping(month, day, year)").alias("level"),
+            SQLExpression("round_even(favg(min_wbgt), 1)").alias("min_wbgt"),
+            SQLExpression("round_even(favg(max_wbgt), 1)").alias("max_wbgt"),
+            SQLExpression("round_even(favg(WBGT), 1)").alias("avg_wbgt"),
+            *heat_risk,
+        ],
+        group_expr=(
+            "GROUPING SETS ("
+            "(station_number, month, day), (station_number, month), (station_number), "
+            "(station_number, year)"
+            ")"
+        ),
+    ).order("station_number, level, month, day, year")
+
+
+# 日別と月別・年間のWBGT、暑さ指数の基準の超過を1回の集計結果から観測所ごとに作る
+def iter_wbgt(stations=None, years=WBGT_YEARS, min_coverage=WBGT_MIN_COVERAGE):
+    with metrics.batch("query_wbgt"):
+        columns = fetch_columns(query_wbgt_aggregates(stations, years, min_coverage))
+
+    return group_wbgt(columns)
+
+
+def season_date(season_day):
+    day = SEASON_START + datetime.timedelta(days=round(season_day))
+    return f"{day.month}/{day.day}"
+
+
+def heat_risk_record(values, row):
+    return {
+        "days": {x: values[f"days_{x}"][row] for x in HEAT_RISK_THRESHOLDS},
+        "hours": {x: values[f"hours_{x}"][row] for x in HEAT_RISK_THRESHOLDS},
+        "daily_max": dict(zip(HEAT_RISK_QUANTILES, values["daily_max_quantiles"][row])),
+    }
+
+
+# 年ごとの最初と最後の日の中央値を、平年の最初と最後の日とする
+# yearsは基準に達した年の数
+def typical_dates(values, rows):
+    record = {"first": {}, "last": {}, "years": {}}
+    for threshold in HEAT_RISK_THRESHOLDS:
+        for key in ("first", "last"):
+            column = values[f"{key}_{threshold}"]
+            days = [column[x] for x in rows if column[x] is not None]
+            record[key][threshold] = (
+                season_date(statistics.median(days)) if days else None
+            )
+        record["years"][threshold] = len(days)
+    return record
+
+
+def group_wbgt(columns):
+    with metrics.batch("group_wbgt"):
+        # 月日別の行のキー "月/日" は、月・日の組み合わせごとの文字列の表から列全体をまとめて引く
+        month, day = (np.ma.filled(columns[x], 0) for x in ("month", "day"))
+        day_keys = DAY_KEYS[month * 32 + day].tolist()
+
+        station_numbers = columns["station_number"].tolist()
+        levels = columns["level"].tolist()
+        months = columns["month"].tolist()
+        min_wbgt = columns["min_wbgt"].tolist()
+        max_wbgt = columns["max_wbgt"].tolist()
+        avg_wbgt = columns["avg_wbgt"].tolist()
+
+        # 暑さ指数の列は月別・年間・年ごとの行でしか使わないので、その行だけ取り出す
+        heat_rows = np.flatnonzero(np.asarray(columns["level"]) != 1)
+        heat_values = {
+            x: dict(zip(heat_rows.tolist(), columns[x][heat_rows].tolist()))
+            for x in columns
+            if x.startswith(("days_", "hours_", "first_", "last_", "daily_max_"))
+        }
+
+        # 行は観測所・level順に並んでいるので、levelごとの範囲をまとめて処理する
+        groups = iter_groups(columns["station_number"], columns["level"])
+    for station_number, level_groups in itertools.groupby(
+        groups, key=lambda x: station_numbers[x[0]]
+    ):
+        daily = {}
+        monthly_yearly = {"yearly": None, "monthly": {}}
+        heat_risk = {"yearly": None, "monthly": {}}
+        dates = None
+        row_count = 0
+
+        for start, end in level_groups:
+            level = levels[start]
+            if level == 1:
+                daily = {
+                    key: {"min": a, "max": b, "avg": c}
+                    for key, a, b, c in zip(
+                        day_keys[start:end],
+                        min_wbgt[start:end],
+                        max_wbgt[start:end],
+                        avg_wbgt[start:end],
+                    )
+                }
+            elif level == 3:
+                monthly_yearly["monthly"] = dict(
+                    zip(months[start:end], avg_wbgt[start:end])
+                )
+                heat_risk["monthly"] = {
+                    months[x]: heat_risk_record(heat_values, x)
+                    for x in range(start, end)
+                }
+            elif level == 6:
+                # 年ごとの行は年間の行より前に並ぶ
+                dates = typical_dates(heat_values, range(start, end))
+            else:
+                monthly_yearly["yearly"] = avg_wbgt[start]
+                heat_risk["yearly"] = heat_risk_record(heat_values, start) | dates
+            row_count += end - start
+
+        metrics.add_rows(row_count)
+        yield station_number, (daily, monthly_yearly, heat_risk)
+
+
+def create_daily_wbgt_object(stations=None):
+    return {k: v[0] for k, v in iter_wbgt(stations)}
+
+
+def create_monthly_yearly_wbgt_object(stations=None):
+    return {k: v[1] for k, v in iter_wbgt(stations)}
+
+
+def create_heat_risk_object(stations=None):
+    return {k: v[2] for k, v in iter_wbgt(stations)}
+
+
+def iter_station_index():
+    with metrics.batch("load_station_index"):
+        history_index = staging.load("station_history").set_alias("history_index")
+        latest_index = staging.load("station_latest").set_alias("latest_index")
 
     latest_index = latest_index.select(
         SQLExpression("都府県振興局").alias("prefecture_subprefecture"),
@@ -397,40 +570,786 @@ def create_station_index_object():
             "address",
         )
         .order("station_number")
-        .fetchall()
-    )
-
-    station_index = {}
-    for station in station_list:
-        station_index[station[0]] = {
-            "station_name": station[1],
-            "latitude": station[2],
-            "longitude": station[3],
-            "altitude": station[4],
-            "prefecture_subprefecture": station[5],
-            "long_name": station[6],
-            "address": station[7],
+    )
+
+    with metrics.batch("query_station_index"):
+        columns = fetch_columns(station_list)
+    names = [
+        "station_name",
+        "latitude",
+        "longitude",
+        "altitude",
+        "prefecture_subprefecture",
+        "long_name",
+        "address",
+    ]
+    for station_number, *values in zip(
+        columns["station_number"].tolist(), *(columns[x].tolist() for x in names)
+    ):
+        yield station_number, dict(zip(names, values))
+
+
+def create_station_index_object():
+    return dict(iter_station_index())
+
+
+def read_build_manifest():
+    if not build_manifest_path.is_file():
+        return {}
+
+    with build_manifest_path.open(encoding="utf-8") as f:
+        return json.load(f)
+
+
+# 別プロセスで同時に実行した段階の記録を消さないよう、書き込む直前に読み直して
+# 指定した出力の分だけ反映する
+def update_build_manifest(entries):
+    manifest = read_build_manifest()
+    manifest.update(entries)
+
+    processed_dir.mkdir(parents=True, exist_ok=True)
+    tmp = build_manifest_path.with_name(f"{build_manifest_path.name}.{os.getpid()}.tmp")
+    with tmp.open("w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(tmp, build_manifest_path)
+
+
+# 前回の出力時から元ファイルが変わった観測所の一覧を返す
+# Noneの場合は全観測所を作り直す必要がある
+def find_dirty_stations(name, keys, manifest):
+    built = manifest.get(name)
+    if built is None or not processed_dir.joinpath(f"{name}.json").is_file():
+        return None
+
+    return sorted(x for x in keys.keys() | built.keys() if keys.get(x) != built.get(x))
+
+
+def merge_stations(name, updated, dirty):
+    with open(processed_dir.joinpath(f"{name}.json"), encoding="utf-8") as f:
+        data = json.load(f)
+
+    # 作り直した結果に含まれない観測所は出力から消す
+    for station_number in dirty:
+        data.pop(station_number, None)
+    data.update(updated)
+
+    # 全体を作り直した場合と同じく観測所番号順に並べる
+    return {k: data[k] for k in sorted(data)}
+
+
+# 同じ集計結果から作る出力をまとめて書き出す
+# iterateは(観測所番号, 出力ごとの値のタプル)を返すジェネレーター
+def build_outputs(names, iterate, keys, manifest, dirty, compact=False, **json_kwargs):
+    paths = [processed_dir.joinpath(f"{name}.json") for name in names]
+
+    if any(x is None for x in dirty):
+        # 全観測所を作り直す場合は、計算した観測所から順に書き出す
+        with contextlib.ExitStack() as stack:
+            writers = [
+                stack.enter_context(StationJsonWriter(path, compact, **json_kwargs))
+                for path in paths
+            ]
+            for station_number, payloads in iterate(None):
+                for writer, payload in zip(writers, payloads):
+                    writer.write(station_number, payload)
+
+        for name, path, writer in zip(names, paths, writers):
+            metrics.record_output(name, path, writer.sizes)
+    else:
+        dirty = sorted(set().union(*dirty))
+        if not dirty:
+            # 元ファイルの更新時刻だけが変わった場合も、次回は段階ごと省略できるようにする
+            for name, path in zip(names, paths):
+                path.touch()
+                print(f"Up to date: {name}.json")
+            return
+
+        updated = [{} for _ in names]
+        for station_number, payloads in iterate(dirty):
+            for data, payload in zip(updated, payloads):
+                data[station_number] = payload
+
+        for name, path, data in zip(names, paths, updated):
+            merged = merge_stations(name, data, dirty)
+            sizes = write_station_json(path, merged.items(), compact, **json_kwargs)
+            metrics.record_output(name, path, sizes)
+
+    for name in names:
+        manifest[name] = keys
+    update_build_manifest({name: keys for name in names})
+
+
+def iter_single_output(iterate, stations):
+    for station_number, payload in iterate(stations):
+        yield station_number, (payload,)
+
+
+# 並列実行のワーカーに渡せるよう、クロージャではなくpartialで包む
+def single_output(iterate):
+    return functools.partial(iter_single_output, iterate)
+
+
+def write_station_shards(compact=False):
+    data = {}
+    for name in station_datasets + ["station_index"]:
+        with open(processed_dir.joinpath(f"{name}.json"), encoding="utf-8") as f:
+            data[name] = json.load(f)
+
+    station_index = data.pop("station_index")
+    stations = sorted(set().union(*data.values()))
+
+    shard_dir = processed_dir.joinpath("station")
+    shard_dir.mkdir(exist_ok=True)
+
+    index = {"datasets": station_datasets, "stations": {}}
+    for station_number in stations:
+        shard = {"station": station_index.get(station_number)}
+        for name in station_datasets:
+            shard[name] = data[name].get(station_number)
+
+        index["stations"][station_number] = [
+            name for name in station_datasets if station_number in data[name]
+        ]
+
+        # 内容が変わっていない観測所のファイルは書き換えない
+        path = shard_dir.joinpath(f"{station_number}.json")
+        if compact:
+            text = json.dumps(shard, ensure_ascii=False, separators=(",", ":"))
+        else:
+            text = json.dumps(shard, indent=2, ensure_ascii=False)
+        if not path.is_file() or path.read_text(encoding="utf-8") != text:
+            path.write_text(text, encoding="utf-8")
+
+    # 出力から消えた観測所のファイルを削除する
+    for path in shard_dir.glob("*.json"):
+        if path.stem != "index" and path.stem not in index["stations"]:
+            path.unlink()
+
+    with open(shard_dir.joinpath("index.json"), "w", encoding="utf-8") as f:
+        json.dump(index, f, indent=2, ensure_ascii=False)
+
+
+def init_worker(threads, memory_limit=None, profile_dir=None):
+    # プロセスごとのDuckDBのスレッド数とメモリを制限し、全体で上限を超えないようにする
+    pipeline.apply_duckdb_budget(threads, memory_limit)
+    # ステージングはメインプロセスで更新済みなので、ワーカーでは確認しない
+    staging.refresh_on_load = False
+    if profile_dir is not None:
+        metrics.enable_duckdb_profiling(profile_dir)
+
+
+# ワーカーで記録した計測値も結果と一緒にメインプロセスへ返す
+def collect(iterate, stations):
+    return list(metrics.timed_stations(iterate(stations))), metrics.drain()
+
+
+def run_per_station(iterate, stations, workers):
+    if workers <= 1:
+        yield from metrics.timed_stations(iterate(stations))
+        return
+
+    # 観測所番号順の連続した塊に分けて各プロセスで処理し、
+    # 結果を塊の順番通りに結合することで逐次実行と同じ順序にする
+    batch_count = min(len(stations), workers * 4)
+    batches = [
+        stations[
+            i * len(stations) // batch_count : (i + 1) * len(stations) // batch_count
+        ]
+        for i in range(batch_count)
+    ]
+    # このプロセスに割り当てられたスレッド数とメモリをワーカーで等分する
+    threads, memory_limit = pipeline.duckdb_budget()
+    profile_dir = (
+        metrics.duckdb_profile_path.parent if metrics.duckdb_profile_path else None
+    )
+
+    with ProcessPoolExecutor(
+        max_workers=workers,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=init_worker,
+        initargs=(max(1, threads // workers), memory_limit // workers, profile_dir),
+    ) as executor:
+        for result, records in executor.map(
+            functools.partial(collect, iterate), batches
+        ):
+            metrics.merge(records)
+            yield from result
+
+
+# 全観測所が対象の場合も、並列実行では観測所の一覧を分割する
+def per_station(iterate, keys, workers):
+    return lambda stations: run_per_station(
+        iterate,
+        sorted(keys) if stations is None and workers > 1 else stations,
+        workers,
+    )
+
+
+# 以下の段階の関数は、別プロセスでも実行できるようモジュールの関数にし、
+# 設定はoptions（incremental, workers, compact, wbgt_years, wbgt_min_coverage）で受け取る
+def build_manifest_for(options):
+    # 全体を作り直す場合も、次回の差分更新のためにマニフェストは記録する
+    return read_build_manifest() if options["incremental"] else {}
+
+
+def build_daily_normal(options):
+    manifest = build_manifest_for(options)
+    with metrics.stage("staging.daily_normal"):
+        normal_keys = staging.refresh("daily_normal")
+    with metrics.stage("daily_normal"):
+        build_outputs(
+            ["daily_normal"],
+            per_station(
+                single_output(iter_daily_normal), normal_keys, options["workers"]
+            ),
+            normal_keys,
+            manifest,
+            [find_dirty_stations("daily_normal", normal_keys, manifest)],
+            options["compact"],
+        )
+
+
+def build_monthly_yearly_normal(options):
+    manifest = build_manifest_for(options)
+    with metrics.stage("staging.monthly_normal"):
+        normal_keys = staging.refresh("monthly_normal")
+    with metrics.stage("monthly_yearly_normal"):
+        build_outputs(
+            ["monthly_yearly_normal"],
+            per_station(
+                single_output(iter_monthly_yearly_normal),
+                normal_keys,
+                options["workers"],
+            ),
+            normal_keys,
+            manifest,
+            [find_dirty_stations("monthly_yearly_normal", normal_keys, manifest)],
+            options["compact"],
+        )
+
+
+# 日別・月別・年間のWBGTと暑さ指数の基準の超過は1回の集計結果から作る
+def build_wbgt(options):
+    manifest = build_manifest_for(options)
+    years = tuple(options["wbgt_years"])
+    min_coverage = options["wbgt_min_coverage"]
+
+    # ステージングは地点・年ごとなので、年の範囲内のキーを地点ごとにまとめる
+    with metrics.stage("staging.wbgt"):
+        wbgt_keys = staging.station_keys(
+            staging.refresh("wbgt"),
+            years,
+            {"years": list(years), "min_coverage": min_coverage},
+        )
+    with metrics.stage("wbgt"):
+        build_outputs(
+            ["daily_wbgt", "monthly_yearly_wbgt", "heat_risk"],
+            per_station(
+                functools.partial(iter_wbgt, years=years, min_coverage=min_coverage),
+                wbgt_keys,
+                options["workers"],
+            ),
+            wbgt_keys,
+            manifest,
+            [
+                find_dirty_stations("daily_wbgt", wbgt_keys, manifest),
+                find_dirty_stations("monthly_yearly_wbgt", wbgt_keys, manifest),
+                find_dirty_stations("heat_risk", wbgt_keys, manifest),
+            ],
+            options["compact"],
+        )
+
+
+# 観測所一覧は1つのファイルから作るので、変更があれば全体を作り直す
+def build_station_index(options):
+    manifest = build_manifest_for(options)
+    with metrics.stage("staging.station_index"):
+        index_keys = {
+            "station_history": staging.refresh("station_history")["all"],
+            "station_latest": staging.refresh("station_latest")["all"],
         }
+    with metrics.stage("station_index"):
+        index_dirty = find_dirty_stations("station_index", index_keys, manifest)
+        build_outputs(
+            ["station_index"],
+            single_output(lambda _: iter_station_index()),
+            index_keys,
+            manifest,
+            [None if index_dirty else index_dirty],
+            options["compact"],
+            ensure_ascii=False,
+        )
+
 
-    return station_index
+# 全国・地域ごとの集計と順位は、月別・年間の出力全体から毎回作り直す
+def build_aggregates(options):
+    with metrics.stage("aggregates"):
+        metrics.record_output("aggregates", aggregates.write_aggregates(), {})
 
 
-def main():
-    with open(processed_dir.joinpath("daily_normal.json"), "w") as f:
-        json.dump(create_daily_normal_object(), f, indent=2)
+def build_station_neighbors(options):
+    with metrics.stage("station_neighbors"):
+        metrics.record_output(
+            "station_neighbors", spatial.write_station_neighbors(), {}
+        )
+
+
+# 全観測所の組を行列演算でまとめて比べ、気候が似ている観測所を書き出す
+def build_climate_similarity(options):
+    with metrics.stage("climate_similarity"):
+        metrics.record_output(
+            "climate_similarity", similarity.write_climate_similarity(), {}
+        )
+
+
+# 地図ページが表示範囲のタイルだけを取得できるよう、ズームごとに分けて書き出す
+def build_map_tiles(options):
+    with metrics.stage("map_tiles"):
+        metrics.record_output(
+            "map_tiles", map_tiles.write_map_tiles().joinpath("index.json"), {}
+        )
+
+
+def build_shards(options):
+    with metrics.stage("shards"):
+        write_station_shards(options["compact"])
+
+
+def build_binary(options):
+    with metrics.stage("binary"):
+        series_binary.write_series_files()
 
-    with open(processed_dir.joinpath("monthly_yearly_normal.json"), "w") as f:
-        json.dump(create_monthly_yearly_normal_object(), f, indent=2)
 
-    with open(processed_dir.joinpath("daily_wbgt.json"), "w") as f:
-        json.dump(create_daily_wbgt_object(), f, indent=2)
+def build_surface(options):
+    with metrics.stage("surface"):
+        surface.write_surfaces(workers=options["workers"])
 
-    with open(processed_dir.joinpath("monthly_yearly_wbgt.json"), "w") as f:
-        json.dump(create_monthly_yearly_wbgt_object(), f, indent=2)
 
-    with open(processed_dir.joinpath("station_index.json"), "w") as f:
-        json.dump(create_station_index_object(), f, indent=2, ensure_ascii=False)
+def build_store(options):
+    with metrics.stage("store"):
+        metrics.record_output("store", store.build_store(), {})
+
+
+# 他の出力をすべて書き終えてから、ハッシュ付きのコピーを作る
+def build_publish(options):
+    with metrics.stage("publish"):
+        metrics.record_output("publish", publish.publish(), {})
+
+
+# main.pyが常に作る段階（残りはフラグか名前を指定した場合だけ）
+DEFAULT_STAGES = [
+    "daily_normal",
+    "monthly_yearly_normal",
+    "wbgt",
+    "station_index",
+    "aggregates",
+    "station_neighbors",
+    "climate_similarity",
+    "map_tiles",
+]
+
+
+# 段階名 -> 段階（実行する関数、元ファイル、出力、出力を読み込む段階）
+def build_stages(options):
+    def output(name):
+        return processed_dir.joinpath(name)
+
+    def stage(name, run, **kwargs):
+        return pipeline.Stage(name, functools.partial(run, options), **kwargs)
+
+    years = tuple(options["wbgt_years"])
+    series = ["daily_normal", "monthly_yearly_normal", "wbgt"]
+    return {
+        x.name: x
+        for x in [
+            stage(
+                "daily_normal",
+                build_daily_normal,
+                inputs=lambda: staging.source_files("daily_normal"),
+                outputs=[output("daily_normal.json")],
+            ),
+            stage(
+                "monthly_yearly_normal",
+                build_monthly_yearly_normal,
+                inputs=lambda: staging.source_files("monthly_normal"),
+                outputs=[output("monthly_yearly_normal.json")],
+            ),
+            stage(
+                "wbgt",
+                build_wbgt,
+                # 年の範囲外のファイルが増えても作り直さない
+                inputs=lambda: staging.source_files("wbgt", years),
+                outputs=[
+                    output("daily_wbgt.json"),
+                    output("monthly_yearly_wbgt.json"),
+                    output("heat_risk.json"),
+                ],
+            ),
+            stage(
+                "station_index",
+                build_station_index,
+                inputs=lambda: (
+                    staging.source_files("station_history")
+                    + staging.source_files("station_latest")
+                ),
+                outputs=[output("station_index.json")],
+            ),
+            stage(
+                "aggregates",
+                build_aggregates,
+                outputs=[output("aggregates.json")],
+                after=["monthly_yearly_normal", "wbgt", "station_index"],
+            ),
+            stage(
+                "station_neighbors",
+                build_station_neighbors,
+                outputs=[output("station_neighbors.json")],
+                after=["station_index"],
+            ),
+            stage(
+                "climate_similarity",
+                build_climate_similarity,
+                outputs=[output("climate_similarity.json")],
+                after=["monthly_yearly_normal", "wbgt"],
+            ),
+            stage(
+                "map_tiles",
+                build_map_tiles,
+                outputs=[map_tiles.map_tiles_dir.joinpath("index.json")],
+                after=["monthly_yearly_normal", "wbgt", "station_index"],
+            ),
+            stage(
+                "shards",
+                build_shards,
+                outputs=[output("station").joinpath("index.json")],
+                after=[*series, "station_index"],
+                optional=True,
+            ),
+            stage(
+                "binary",
+                build_binary,
+                outputs=[output(f"{x}.bin") for x in series_binary.layouts],
+                after=series,
+                optional=True,
+            ),
+            stage(
+                "surface",
+                build_surface,
+                outputs=[surface.surface_dir.joinpath("index.json")],
+                after=["monthly_yearly_normal", "wbgt", "station_index"],
+                optional=True,
+            ),
+            stage(
+                "store",
+                build_store,
+                outputs=[store.store_path],
+                after=[*series, "station_index"],
+                optional=True,
+            ),
+            stage(
+                "publish",
+                build_publish,
+                outputs=[publish.manifest_path],
+                after=[
+                    *DEFAULT_STAGES,
+                    "shards",
+                    "binary",
+                    "surface",
+                    "store",
+                ],
+                optional=True,
+            ),
+        ]
+    }
+
+
+# 出力の内容に影響する設定。変わった段階は出力が新しくても作り直す
+def output_options(options):
+    return {
+        "compact": options["compact"],
+        "wbgt_years": list(options["wbgt_years"]),
+        "wbgt_min_coverage": options["wbgt_min_coverage"],
+    }
+
+
+# 公開用のコピーに必要なbrotliがなければ、時間のかかる処理の前に止める
+def check_publish(parser):
+    try:
+        publish.compressors()
+    except RuntimeError as e:
+        parser.error(str(e))
+
+
+# "2021-2025" -> (2021, 2025)、"2024" -> (2024, 2024)
+def parse_year_range(value):
+    start, _, end = value.partition("-")
+    years = (int(start), int(end or start))
+    if years[0] > years[1]:
+        raise argparse.ArgumentTypeError(f"invalid year range: {value}")
+    return years
+
+
+# 指定した段階と、それが依存する段階のうち出力が古いものだけを実行する
+# targetsには段階名のほか、出力のファイル名（daily_wbgtなど）も指定できる
+def build(
+    targets,
+    options,
+    jobs=1,
+    threads=None,
+    memory_limit=None,
+    force=False,
+    metrics_path=None,
+    profile_duckdb=False,
+):
+    stages = build_stages(options)
+    setup = None
+    if profile_duckdb:
+        metrics.enable_duckdb_profiling(metrics_dir)
+        setup = functools.partial(metrics.enable_duckdb_profiling, metrics_dir)
+
+    results = pipeline.run_stages(
+        stages,
+        pipeline.resolve(stages, targets),
+        jobs=jobs,
+        threads=threads,
+        memory_limit=memory_limit,
+        force=force,
+        options=output_options(options),
+        state_path=stage_state_path,
+        setup=setup,
+    )
+
+    metrics.write(metrics_path or metrics_dir.joinpath("build_metrics.json"))
+    metrics.print_summary()
+    print()
+    pipeline.print_timings(results)
+
+
+def main(
+    incremental=False,
+    workers=1,
+    shards=False,
+    compact=False,
+    binary=False,
+    surfaces=False,
+    climate_store=False,
+    publish_outputs=False,
+    metrics_path=None,
+    profile_duckdb=False,
+    wbgt_years=WBGT_YEARS,
+    wbgt_min_coverage=WBGT_MIN_COVERAGE,
+):
+    options = {
+        "incremental": incremental,
+        "workers": workers,
+        "compact": compact,
+        "wbgt_years": wbgt_years,
+        "wbgt_min_coverage": wbgt_min_coverage,
+    }
+    optional = {
+        "shards": shards,
+        "binary": binary,
+        "surface": surfaces,
+        "store": climate_store,
+        "publish": publish_outputs,
+    }
+
+    if profile_duckdb:
+        metrics.enable_duckdb_profiling(metrics_dir)
+
+    # 段階を指定しない場合は、出力の更新時刻にかかわらずすべて作り直す
+    pipeline.run_stages(
+        build_stages(options),
+        DEFAULT_STAGES + [k for k, v in optional.items() if v],
+        force=True,
+        options=output_options(options),
+        state_path=stage_state_path,
+    )
+
+    metrics.write(metrics_path or metrics_dir.joinpath("build_metrics.json"))
+    metrics.print_summary()
 
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(description="Build processed JSON files")
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="rebuild only stations whose raw input files changed",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="number of processes used for per-station processing",
+    )
+    parser.add_argument(
+        "--shards",
+        action="store_true",
+        help="also write one file per station under processed/station/",
+    )
+    parser.add_argument(
+        "--compact",
+        action="store_true",
+        help="write minified JSON instead of indented JSON",
+    )
+    parser.add_argument(
+        "--binary",
+        action="store_true",
+        help="also write the series as fixed-width scaled integers (*.bin)",
+    )
+    parser.add_argument(
+        "--surface",
+        action="store_true",
+        help="also write interpolated climate surfaces under processed/surface/",
+    )
+    parser.add_argument(
+        "--store",
+        action="store_true",
+        help="also load the outputs into typed tables in processed/climate.duckdb",
+    )
+    parser.add_argument(
+        "--publish",
+        action="store_true",
+        help="also write content-hashed, precompressed copies under processed/publish/",
+    )
+    parser.add_argument(
+        "--wbgt-years",
+        type=parse_year_range,
+        default=WBGT_YEARS,
+        help="years of WBGT data to aggregate, e.g. 2021-2025 (default: 2020-2024)",
+    )
+    parser.add_argument(
+        "--wbgt-min-coverage",
+        type=float,
+        default=WBGT_MIN_COVERAGE,
+        help="fraction of the monthly WBGT files in the year range a point "
+        "must have to be included (default: 1.0)",
+    )
+    parser.add_argument(
+        "--metrics",
+        type=Path,
+        help="path of the JSON metrics file (default: ../data/metrics/build_metrics.json)",
+    )
+    parser.add_argument(
+        "--profile-duckdb",
+        action="store_true",
+        help="record DuckDB's query profile (latency, CPU time, rows scanned)",
+    )
+    parser.add_argument(
+        "--cprofile",
+        type=Path,
+        help="run under cProfile and write the stats to this file",
+    )
+
+    subparsers = parser.add_subparsers(dest="command")
+    build_parser = subparsers.add_parser(
+        "build",
+        help="build only the given stages and the stages they depend on, "
+        "skipping stages whose outputs are newer than their inputs",
+    )
+    build_parser.add_argument(
+        "stages",
+        nargs="*",
+        help="stage or output names, e.g. daily_wbgt station_index "
+        "(default: the stages main.py builds with the same flags)",
+    )
+    build_parser.add_argument(
+        "--jobs",
+        type=int,
+        default=1,
+        help="number of independent stages run at the same time",
+    )
+    build_parser.add_argument(
+        "--threads",
+        type=int,
+        help="DuckDB threads shared by all running stages (default: CPU count)",
+    )
+    build_parser.add_argument(
+        "--memory-limit",
+        help="DuckDB memory shared by all running stages, e.g. 8GB",
+    )
+    build_parser.add_argument(
+        "--force",
+        action="store_true",
+        help="rebuild the stages even if their outputs are up to date",
+    )
+    build_parser.add_argument(
+        "--list",
+        action="store_true",
+        help="list the stages with their dependencies and outputs, and exit",
+    )
+    args = parser.parse_args()
+
+    options = {
+        "incremental": args.incremental,
+        "workers": args.workers,
+        "compact": args.compact,
+        "wbgt_years": args.wbgt_years,
+        "wbgt_min_coverage": args.wbgt_min_coverage,
+    }
+
+    if args.command == "build":
+        stages = build_stages(options)
+        if args.list:
+            for stage in stages.values():
+                after = ", ".join(stage.after) or "-"
+                outputs = ", ".join(
+                    x.relative_to(processed_dir).as_posix() for x in stage.outputs
+                )
+                suffix = " (optional)" if stage.optional else ""
+                print(f"{stage.name}{suffix}\n  after: {after}\n  outputs: {outputs}")
+            raise SystemExit
+
+        targets = args.stages or DEFAULT_STAGES + [
+            name
+            for name, enabled in [
+                ("shards", args.shards),
+                ("binary", args.binary),
+                ("surface", args.surface),
+                ("store", args.store),
+                ("publish", args.publish),
+            ]
+            if enabled
+        ]
+        unknown = [x for x in pipeline.resolve(stages, targets) if x not in stages]
+        if unknown:
+            parser.error(f"unknown stages: {', '.join(unknown)}")
+        if args.memory_limit is not None:
+            try:
+                pipeline.parse_size(args.memory_limit)
+            except ValueError as e:
+                parser.error(str(e))
+        if "publish" in pipeline.resolve(stages, targets):
+            check_publish(parser)
+
+        with metrics.cprofile(args.cprofile):
+            build(
+                targets,
+                options,
+                jobs=args.jobs,
+                threads=args.threads,
+                memory_limit=args.memory_limit,
+                force=args.force,
+                metrics_path=args.metrics,
+                profile_duckdb=args.profile_duckdb,
+            )
+        raise SystemExit
+
+    if args.publish:
+        check_publish(parser)
+    with metrics.cprofile(args.cprofile):
+        main(
+            incremental=args.incremental,
+            workers=args.workers,
+            shards=args.shards,
+            compact=args.compact,
+            binary=args.binary,
+            surfaces=args.surface,
+            climate_store=args.store,
+            publish_outputs=args.publish,
+            metrics_path=args.metrics,
+            profile_duckdb=args.profile_duckdb,
+            wbgt_years=args.wbgt_years,
+            wbgt_min_coverage=args.wbgt_min_coverage,
+        )
@@ -0,0 +1,195 @@
+import argparse
+import itertools
+import json
+import os
+import shutil
+from pathlib import Path
+
+import duckdb
+from duckdb import SQLExpression
+
+from aggregates import json_entries
+
+# 地図表示用に、観測所をWebメルカトルのタイル（z/x/y）に分けて書き出す
+# 縮尺の小さいズームではタイルごとの集計だけを持たせ、
+# 大きいズームでは地図ページと同じ形式の観測所データを持たせる。
+
+processed_dir = Path(
+    os.environ.get("JCD_DATA_DIR", Path(__file__).parents[1].joinpath("data"))
+).joinpath("processed")
+map_tiles_dir = processed_dir.joinpath("map_tiles")
+
+MIN_ZOOM = 4
+MAX_ZOOM = 10
+# このズームまではタイルごとの集計、それより大きいズームでは観測所データ
+SUMMARY_MAX_ZOOM = 7
+
+ELEMENTS = ["temperature", "precipitation", "sunshine_duration", "wbgt"]
+
+
+def query_map_stations():
+    # web/pages/map/+data.tsと同じく、平年値かWBGTのどちらかがある観測所
+    normal = ", ".join(
+        f"(j.value->'yearly'->>'{x}')::DOUBLE AS {x}" for x in ELEMENTS if x != "wbgt"
+    )
+    return duckdb.sql(
+        f"""
+        WITH normal AS (
+            SELECT j.key AS station_number, {normal}
+            FROM {json_entries("monthly_yearly_normal")}
+        ),
+        wbgt AS (
+            SELECT j.key AS station_number, (j.value->>'yearly')::DOUBLE AS wbgt
+            FROM {json_entries("monthly_yearly_wbgt")}
+        ),
+        station AS (
+            SELECT
+                j.key AS station_number,
+                j.value->>'station_name' AS station_name,
+                (j.value->>'latitude')::DOUBLE AS latitude,
+                (j.value->>'longitude')::DOUBLE AS longitude
+            FROM {json_entries("station_index")}
+        )
+        SELECT *
+        FROM normal
+        FULL JOIN wbgt USING (station_number)
+        JOIN station USING (station_number)
+        WHERE latitude IS NOT NULL AND longitude IS NOT NULL
+        """
+    )
+
+
+def query_tiles(stations, min_zoom=MIN_ZOOM, max_zoom=MAX_ZOOM):
+    # 観測所ごと・ズームごとのタイル番号
+    zooms = duckdb.sql(f"SELECT range AS zoom FROM range({min_zoom}, {max_zoom} + 1)")
+    return stations.cross(zooms).select(
+        "*",
+        SQLExpression("floor((longitude + 180) / 360 * (1 << zoom))::INTEGER").alias(
+            "x"
+        ),
+        SQLExpression(
+            "floor((1 - ln(tan(radians(latitude)) + 1 / cos(radians(latitude))) / pi())"
+            " / 2 * (1 << zoom))::INTEGER"
+        ).alias("y"),
+    )
+
+
+def query_summaries(tiles):
+    aggr_expr = [
+        "zoom",
+        "x",
+        "y",
+        SQLExpression("count(*)").alias("count"),
+        SQLExpression("round(favg(latitude), 4)").alias("latitude"),
+        SQLExpression("round(favg(longitude), 4)").alias("longitude"),
+    ]
+    for element in ELEMENTS:
+        aggr_expr += [
+            SQLExpression(f"count({element})").alias(f"{element}_count"),
+            SQLExpression(f"round(favg({element}), 1)").alias(f"{element}_mean"),
+            SQLExpression(f"min({element})").alias(f"{element}_min"),
+            SQLExpression(f"max({element})").alias(f"{element}_max"),
+        ]
+
+    return (
+        tiles.filter(f"zoom <= {SUMMARY_MAX_ZOOM}")
+        .aggregate(aggr_expr=aggr_expr, group_expr="zoom, x, y")
+        .order("zoom, x, y")
+    )
+
+
+def station_record(row):
+    return {
+        "station_number": row["station_number"],
+        "station_name": row["station_name"],
+        "coordinates": {"latitude": row["latitude"], "longitude": row["longitude"]},
+        "normal": {
+            "yearly": {x: row[x] for x in ELEMENTS if x != "wbgt"},
+        },
+        "wbgt": {"yearly": row["wbgt"]},
+    }
+
+
+def summary_record(row):
+    return {
+        "count": row["count"],
+        "centroid": {"latitude": row["latitude"], "longitude": row["longitude"]},
+        "elements": {
+            x: {
+                "count": row[f"{x}_count"],
+                "mean": row[f"{x}_mean"],
+                "min": row[f"{x}_min"],
+                "max": row[f"{x}_max"],
+            }
+            for x in ELEMENTS
+        },
+    }
+
+
+def iter_dicts(relation):
+    columns = relation.columns
+    for row in relation.fetchall():
+        yield dict(zip(columns, row))
+
+
+def write_tile(zoom, x, y, payload):
+    path = map_tiles_dir.joinpath(str(zoom), str(x), f"{y}.json")
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(payload, f, ensure_ascii=False, separators=(",", ":"))
+
+
+def write_map_tiles(min_zoom=MIN_ZOOM, max_zoom=MAX_ZOOM):
+    tiles = query_tiles(query_map_stations(), min_zoom, max_zoom)
+
+    shutil.rmtree(map_tiles_dir, ignore_errors=True)
+    index = {
+        "min_zoom": min_zoom,
+        "max_zoom": max_zoom,
+        "summary_max_zoom": SUMMARY_MAX_ZOOM,
+        "elements": ELEMENTS,
+        "tiles": {},
+    }
+
+    for row in iter_dicts(query_summaries(tiles)):
+        write_tile(
+            row["zoom"],
+            row["x"],
+            row["y"],
+            {"zoom": row["zoom"], "x": row["x"], "y": row["y"]} | summary_record(row),
+        )
+        index["tiles"].setdefault(str(row["zoom"]), {})[f"{row['x']}/{row['y']}"] = row[
+            "count"
+        ]
+
+    # 観測所データのタイルは、タイルごとに観測所番号順でまとめる
+    stations = tiles.filter(f"zoom > {SUMMARY_MAX_ZOOM}").order(
+        "zoom, x, y, station_number"
+    )
+    for (zoom, x, y), rows in itertools.groupby(
+        iter_dicts(stations), key=lambda row: (row["zoom"], row["x"], row["y"])
+    ):
+        records = [station_record(row) for row in rows]
+        write_tile(zoom, x, y, {"zoom": zoom, "x": x, "y": y, "stations": records})
+        index["tiles"].setdefault(str(zoom), {})[f"{x}/{y}"] = len(records)
+
+    map_tiles_dir.mkdir(parents=True, exist_ok=True)
+    with open(map_tiles_dir.joinpath("index.json"), "w", encoding="utf-8") as f:
+        json.dump(index, f, indent=2)
+
+    return map_tiles_dir
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Write quadtile map payloads under processed/map_tiles/"
+    )
+    parser.add_argument("--min-zoom", type=int, default=MIN_ZOOM)
+    parser.add_argument("--max-zoom", type=int, default=MAX_ZOOM)
+    args = parser.parse_args()
+
+    write_map_tiles(args.min_zoom, args.max_zoom)
+
+
+if __name__ == "__main__":
+    main()
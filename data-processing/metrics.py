@@ -0,0 +1,252 @@
+import contextlib
+import cProfile
+import json
+import os
+import pstats
+import resource
+import sys
+import time
+from pathlib import Path
+
+import duckdb
+
+# main.pyの段階ごと・観測所ごとの処理時間、読み込んだ行数、出力バイト数を記録する
+# ワーカープロセスでも同じ関数で記録し、drain()で取り出してメインプロセスでmerge()する
+# 段階ごとの記録も、段階を別プロセスで実行した場合は同じように戻す
+
+stages = []
+stations = []
+queries = []
+batches = []
+outputs = []
+
+# 記録中の段階名（ワーカーでは常にNone。merge()のときに付ける）
+current_stage = None
+# 次の観測所が返されるまでに読み込んだ行数
+pending_rows = 0
+# 次の観測所が返されるまでに、全観測所分をまとめて行った処理（batch()）の時間
+# 観測所ごとの時間には含めず、batchesに別に記録する
+pending_batch_seconds = 0.0
+# DuckDBのプロファイルの出力先（有効な場合のみ）
+duckdb_profile_path = None
+
+
+def enable_duckdb_profiling(dir):
+    global duckdb_profile_path
+
+    # プロセスごとに別のファイルにし、並列実行でも上書きし合わないようにする
+    Path(dir).mkdir(parents=True, exist_ok=True)
+    duckdb_profile_path = Path(dir).joinpath(f"duckdb_profile_{os.getpid()}.json")
+    duckdb.execute("SET enable_profiling = 'json'")
+    duckdb.execute(f"SET profiling_output = '{duckdb_profile_path.as_posix()}'")
+
+
+def read_duckdb_profile():
+    # 直前に完了したクエリのプロファイルから主な値だけを取り出す
+    if duckdb_profile_path is None or not duckdb_profile_path.is_file():
+        return None
+
+    with duckdb_profile_path.open(encoding="utf-8") as f:
+        profile = json.load(f)
+
+    return {
+        "latency": profile.get("latency"),
+        "cpu_time": profile.get("cpu_time"),
+        "rows_scanned": profile.get("cumulative_rows_scanned"),
+        "peak_buffer_memory": profile.get("system_peak_buffer_memory"),
+    }
+
+
+@contextlib.contextmanager
+def stage(name):
+    global current_stage
+
+    current_stage = name
+    record = {"stage": name}
+    start = time.perf_counter()
+    try:
+        yield record
+    finally:
+        record["seconds"] = time.perf_counter() - start
+        stage_queries = [x for x in queries if x["stage"] == name]
+        record["rows"] = sum(x["rows"] for x in stage_queries)
+        record["batch_seconds"] = sum(
+            x["seconds"] for x in batches if x["stage"] == name
+        )
+        if duckdb_profile_path is not None:
+            record["rows_scanned"] = sum(
+                x["duckdb"]["rows_scanned"] for x in stage_queries if x["duckdb"]
+            )
+        stages.append(record)
+        current_stage = None
+
+
+def add_rows(count):
+    global pending_rows
+    pending_rows += count
+
+
+def record_query(seconds, rows):
+    queries.append(
+        {
+            "stage": current_stage,
+            "seconds": seconds,
+            "rows": rows,
+            "duckdb": read_duckdb_profile(),
+        }
+    )
+
+
+# 全観測所分をまとめて行う処理（クエリや列の変換など）の時間を記録する
+# 最初の観測所を返す前に行われても、その観測所の時間には含めない
+@contextlib.contextmanager
+def batch(name):
+    global pending_batch_seconds
+
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - start
+        pending_batch_seconds += seconds
+        batches.append({"stage": current_stage, "name": name, "seconds": seconds})
+
+
+# (観測所番号, 内容)のイテレーターを包み、観測所ごとの処理時間と行数を記録する
+# 呼び出し側が書き出している時間と、クエリや全観測所分の処理の時間は含めない
+def timed_stations(items):
+    global pending_rows, pending_batch_seconds
+
+    iterator = iter(items)
+    while True:
+        pending_rows = 0
+        pending_batch_seconds = 0.0
+        start = time.perf_counter()
+        try:
+            station_number, payload = next(iterator)
+        except StopIteration:
+            return
+
+        stations.append(
+            {
+                "stage": current_stage,
+                "station_number": station_number,
+                "seconds": time.perf_counter() - start - pending_batch_seconds,
+                "rows": pending_rows,
+                "output_bytes": {},
+            }
+        )
+        yield station_number, payload
+
+
+def record_output(name, path, station_bytes):
+    outputs.append(
+        {"stage": current_stage, "output": name, "bytes": Path(path).stat().st_size}
+    )
+
+    records = {x["station_number"]: x for x in stations if x["stage"] == current_stage}
+    for station_number, size in station_bytes.items():
+        if station_number in records:
+            records[station_number]["output_bytes"][name] = size
+
+
+def drain():
+    records = {
+        "stations": stations[:],
+        "queries": queries[:],
+        "batches": batches[:],
+        "stages": stages[:],
+        "outputs": outputs[:],
+    }
+    for target in (stations, queries, batches, stages, outputs):
+        target.clear()
+    return records
+
+
+def merge(records):
+    for key, target in (
+        ("stations", stations),
+        ("queries", queries),
+        ("batches", batches),
+        ("stages", stages),
+        ("outputs", outputs),
+    ):
+        for record in records.get(key, []):
+            target.append(dict(record, stage=record["stage"] or current_stage))
+
+
+def peak_rss_bytes(who=resource.RUSAGE_SELF):
+    peak = resource.getrusage(who).ru_maxrss
+    # Linuxではキロバイト、macOSではバイト単位
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def write(path):
+    Path(path).parent.mkdir(parents=True, exist_ok=True)
+
+    # 各プロセスのプロファイルは読み込み済みなので削除する
+    if duckdb_profile_path is not None:
+        for profile in duckdb_profile_path.parent.glob("duckdb_profile_*.json"):
+            profile.unlink()
+
+    for record in stages:
+        record["output_bytes"] = sum(
+            x["bytes"] for x in outputs if x["stage"] == record["stage"]
+        )
+
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(
+            {
+                "peak_rss": peak_rss_bytes(),
+                # 並列実行のワーカーのうち最大のもの
+                "peak_rss_children": peak_rss_bytes(resource.RUSAGE_CHILDREN),
+                "stages": stages,
+                "outputs": outputs,
+                "queries": queries,
+                "batches": batches,
+                "stations": stations,
+            },
+            f,
+            indent=2,
+        )
+
+
+def print_summary(slowest=5):
+    # batchはクエリなど全観測所分をまとめて行った処理の時間
+    print(
+        f"{'stage':<32} {'seconds':>9} {'batch':>9} {'rows':>12} {'output bytes':>14}"
+    )
+    for record in stages:
+        print(
+            f"{record['stage']:<32} {record['seconds']:>9.2f} "
+            f"{record.get('batch_seconds', 0):>9.2f} "
+            f"{record['rows']:>12,} {record.get('output_bytes', 0):>14,}"
+        )
+
+    if stations:
+        print(f"\nSlowest stations (of {len(stations)}):")
+        for record in sorted(stations, key=lambda x: x["seconds"], reverse=True)[
+            :slowest
+        ]:
+            print(
+                f"  {record['stage']:<30} {record['station_number']:<8} "
+                f"{record['seconds']:>8.3f}s {record['rows']:>8,} rows"
+            )
+
+    print(f"\nPeak RSS: {peak_rss_bytes() / 2**20:.0f} MiB")
+
+
+@contextlib.contextmanager
+def cprofile(path):
+    if path is None:
+        yield
+        return
+
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        profiler.dump_stats(path)
+        pstats.Stats(profiler).sort_stats("cumulative").print_stats(20)
@@ -0,0 +1,161 @@
+import argparse
+import hashlib
+import json
+import random
+import re
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+from download import DownloadCache, download_moe_wbgt
+from synthetic import build_wbgt_csv
+
+# 環境省WBGTサイトの代わりにローカルで合成データを返すHTTPサーバー
+# ダウンローダーのスループット計測用で、本番サーバーにはアクセスしない
+
+csv_path_pattern = re.compile(
+    r"^/mntr/final/(\d{4})/wbgt_\d{4}/final_wbgt_(\w+)_(\d{4})(\d{2})\.csv$"
+)
+
+invalid_xml = (
+    '<?xml version="1.0" encoding="UTF-8"?>\n<Error><Code>NoSuchKey</Code></Error>\n'
+)
+
+
+def build_point_list(point_count):
+    return [str(11001 + i * 10) for i in range(point_count)]
+
+
+def build_point_js(point_list):
+    # download.pyの正規表現に合わせ、閉じ括弧を行頭に置く
+    point_json = {"synthetic": [[point, f"Point {point}"] for point in point_list]}
+    return f"var point = {json.dumps(point_json)[:-1]}\n}};\n"
+
+
+class MockWbgtHandler(BaseHTTPRequestHandler):
+    # server属性に設定を持たせる: point_js, latency, not_found_rate, invalid_rate
+
+    def do_GET(self):
+        time.sleep(self.server.latency)
+
+        if self.path == "/js/point.js":
+            etag = f'"{hashlib.sha256(self.server.point_js.encode()).hexdigest()}"'
+            if self.headers.get("If-None-Match") == etag:
+                self.send_response(304)
+                self.send_header("ETag", etag)
+                self.end_headers()
+                return
+
+            self.send_body(
+                200, self.server.point_js, "application/javascript", {"ETag": etag}
+            )
+            return
+
+        match = csv_path_pattern.match(self.path)
+        if match is None:
+            self.send_body(404, "Not Found", "text/plain")
+            return
+
+        _, point, year, month = match.groups()
+        rng = random.Random(self.path)
+        roll = rng.random()
+
+        if roll < self.server.not_found_rate:
+            self.send_body(404, "Not Found", "text/plain")
+        elif roll < self.server.not_found_rate + self.server.invalid_rate:
+            # 存在しないファイルに対して本番サーバーが返すXMLを模倣する
+            self.send_body(200, invalid_xml, "application/xml")
+        else:
+            self.send_body(
+                200, build_wbgt_csv(point, int(year), int(month)), "text/csv"
+            )
+
+    def send_body(self, status, text, content_type, headers=None):
+        body = text.encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_server(point_count=10, latency=0.05, not_found_rate=0.05, invalid_rate=0.02):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), MockWbgtHandler)
+    server.point_js = build_point_js(build_point_list(point_count))
+    server.latency = latency
+    server.not_found_rate = not_found_rate
+    server.invalid_rate = invalid_rate
+
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Measure download_moe_wbgt throughput against a local mock server"
+    )
+    parser.add_argument("--points", type=int, default=10)
+    parser.add_argument("--start-year", type=int, default=2020)
+    parser.add_argument("--end-year", type=int, default=2024)
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--rate", type=float, default=50.0)
+    parser.add_argument("--burst", type=int, default=4)
+    parser.add_argument("--latency", type=float, default=0.05)
+    args = parser.parse_args()
+
+    server = start_server(point_count=args.points, latency=args.latency)
+    base_url = f"http://{server.server_address[0]}:{server.server_address[1]}"
+
+    with tempfile.TemporaryDirectory() as save_dir:
+        # 本番のマニフェストを汚さないよう、一時ディレクトリに置く
+        cache = DownloadCache(Path(save_dir).joinpath("download_manifest.json"))
+
+        start = time.perf_counter()
+        results = download_moe_wbgt(
+            start_year=args.start_year,
+            end_year=args.end_year,
+            base_url=base_url,
+            save_dir=save_dir,
+            max_workers=args.workers,
+            requests_per_second=args.rate,
+            burst=args.burst,
+            cache=cache,
+        )
+        elapsed = time.perf_counter() - start
+
+        # 2回目は全ファイルが既存なのでリクエストは発生しない
+        start = time.perf_counter()
+        download_moe_wbgt(
+            start_year=args.start_year,
+            end_year=args.end_year,
+            base_url=base_url,
+            save_dir=save_dir,
+            max_workers=args.workers,
+            requests_per_second=args.rate,
+            burst=args.burst,
+            cache=cache,
+        )
+        rerun_elapsed = time.perf_counter() - start
+
+    server.shutdown()
+
+    request_count = sum(results.values())
+    print(f"Results: {dict(results)}")
+    print(
+        f"First run: {request_count} requests in {elapsed:.2f}s "
+        f"({request_count / elapsed:.1f} req/s)"
+    )
+    print(f"Rerun with existing files: {rerun_elapsed:.2f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,251 @@
+import json
+import multiprocessing
+import os
+import re
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from pathlib import Path
+
+import duckdb
+
+import metrics
+
+# 出力を作る段階を入力・出力・依存する段階つきで宣言し、依存関係の順に実行する
+# 互いに依存しない段階は別プロセスで同時に実行し、DuckDBのスレッド数とメモリの
+# 上限は同時に実行する段階で等分する
+# makeと同じく、出力がすべての入力より新しい段階は実行しない
+
+SIZE_UNITS = {
+    "B": 1,
+    "KB": 10**3,
+    "MB": 10**6,
+    "GB": 10**9,
+    "TB": 10**12,
+    "PB": 10**15,
+    "KIB": 2**10,
+    "MIB": 2**20,
+    "GIB": 2**30,
+    "TIB": 2**40,
+    "PIB": 2**50,
+}
+
+
+class Stage:
+    def __init__(self, name, run, inputs=None, outputs=(), after=(), optional=False):
+        self.name = name
+        # 引数なしで呼び出す関数。別プロセスに渡せるよう、モジュールの関数かpartialにする
+        self.run = run
+        # 元ファイルのパスの一覧を返す関数。依存する段階の出力は自動で入力に含める
+        self.inputs = inputs or list
+        self.outputs = [Path(x) for x in outputs]
+        # 出力を読み込む段階の名前
+        self.after = list(after)
+        # 依存する段階に含まれていても、名前を指定しない限り実行しない
+        self.optional = optional
+
+
+# "8GB"や"1.5 GiB"をバイト数にする
+def parse_size(value):
+    match = re.fullmatch(r"\s*([\d.]+)\s*([A-Za-z]*)\s*", str(value))
+    if match is None or match.group(2).upper() not in SIZE_UNITS | {"": 1}:
+        raise ValueError(f"invalid size: {value}")
+    return int(float(match.group(1)) * SIZE_UNITS.get(match.group(2).upper(), 1))
+
+
+# 現在のプロセスのDuckDBのスレッド数とメモリの上限（バイト）
+def duckdb_budget():
+    threads, memory_limit = duckdb.execute(
+        "SELECT current_setting('threads'), current_setting('memory_limit')"
+    ).fetchone()
+    return int(threads), parse_size(memory_limit)
+
+
+def apply_duckdb_budget(threads=None, memory_limit=None):
+    if threads is not None:
+        duckdb.execute(f"SET threads = {max(1, int(threads))}")
+    if memory_limit is not None:
+        duckdb.execute(f"SET memory_limit = '{max(1, int(memory_limit))}B'")
+
+
+# 段階名の代わりに出力のファイル名（拡張子なし）でも指定できるようにする
+# 見つからない名前はそのまま返す
+def resolve(stages, names):
+    resolved = []
+    for name in names:
+        if name not in stages:
+            name = next(
+                (
+                    x.name
+                    for x in stages.values()
+                    if name in (y.stem for y in x.outputs)
+                ),
+                name,
+            )
+        if name not in resolved:
+            resolved.append(name)
+    return resolved
+
+
+# 指定した段階と、それが依存する段階を依存関係の順に並べる
+def plan(stages, targets):
+    ordered = []
+    visiting = set()
+
+    def visit(name, explicit):
+        if name not in stages:
+            raise KeyError(f"unknown stage: {name}")
+        stage = stages[name]
+        if name in ordered or (stage.optional and not explicit):
+            return
+        if name in visiting:
+            raise ValueError(f"dependency cycle at stage: {name}")
+
+        visiting.add(name)
+        for dependency in stage.after:
+            visit(dependency, dependency in targets)
+        visiting.discard(name)
+        ordered.append(name)
+
+    for name in targets:
+        visit(name, True)
+    return ordered
+
+
+def newest_mtime(paths):
+    return max((x.stat().st_mtime_ns for x in paths if x.is_file()), default=0)
+
+
+def is_up_to_date(stage, stages, state, options):
+    if state.get(stage.name) != options:
+        return False
+    if not stage.outputs or not all(x.is_file() for x in stage.outputs):
+        return False
+
+    inputs = list(stage.inputs())
+    for dependency in stage.after:
+        inputs.extend(stages[dependency].outputs)
+
+    oldest_output = min(x.stat().st_mtime_ns for x in stage.outputs)
+    return newest_mtime(inputs) <= oldest_output
+
+
+def read_state(path):
+    if path is None or not Path(path).is_file():
+        return {}
+
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def write_state(path, state):
+    if path is None:
+        return
+
+    Path(path).parent.mkdir(parents=True, exist_ok=True)
+    temporary_path = Path(path).with_name(f"{Path(path).name}.tmp")
+    with open(temporary_path, "w", encoding="utf-8") as f:
+        json.dump(state, f, indent=2, sort_keys=True)
+    os.replace(temporary_path, path)
+
+
+def init_stage_worker(threads, memory_limit, setup=None):
+    apply_duckdb_budget(threads, memory_limit)
+    if setup is not None:
+        setup()
+
+
+# 別プロセスで段階を実行し、記録した計測値も一緒に返す
+def run_stage_worker(run):
+    start = time.perf_counter()
+    run()
+    return time.perf_counter() - start, metrics.drain()
+
+
+def run_inline(run):
+    start = time.perf_counter()
+    run()
+    return time.perf_counter() - start
+
+
+# 段階を実行し、段階ごとの結果（実行したか、かかった時間）を返す
+# stateには段階ごとに前回の実行時のoptionsを記録し、変わっていれば作り直す
+def run_stages(
+    stages,
+    targets,
+    jobs=1,
+    threads=None,
+    memory_limit=None,
+    force=False,
+    options=None,
+    state_path=None,
+    setup=None,
+):
+    ordered = plan(stages, targets)
+    state = read_state(state_path)
+
+    # 依存する段階を作り直す場合は、この段階も作り直す
+    stale = set()
+    for name in ordered:
+        stage = stages[name]
+        if (
+            force
+            or any(x in stale for x in stage.after)
+            or not is_up_to_date(stage, stages, state, options)
+        ):
+            stale.add(name)
+
+    results = {
+        name: {"stage": name, "status": "up to date", "seconds": 0.0}
+        for name in ordered
+        if name not in stale
+    }
+    for name in results:
+        print(f"Up to date: {name}")
+
+    def finish(name, seconds):
+        results[name] = {"stage": name, "status": "built", "seconds": seconds}
+        state[name] = options
+        write_state(state_path, state)
+        print(f"Built: {name} ({seconds:.2f}s)")
+
+    pending = [x for x in ordered if x in stale]
+    if jobs <= 1 or len(pending) <= 1:
+        apply_duckdb_budget(threads, memory_limit)
+        for name in pending:
+            finish(name, run_inline(stages[name].run))
+        return [results[x] for x in ordered]
+
+    # 全体の上限を同時に実行する段階の数で等分する
+    total_threads, total_memory = duckdb_budget()
+    jobs = min(jobs, len(pending))
+    threads_per_job = max(1, (threads or total_threads) // jobs)
+    memory_per_job = parse_size(memory_limit or total_memory) // jobs
+
+    running = {}
+    with ProcessPoolExecutor(
+        max_workers=jobs,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=init_stage_worker,
+        initargs=(threads_per_job, memory_per_job, setup),
+    ) as executor:
+        while pending or running:
+            # 依存する段階がすべて終わった段階から投入する
+            for name in [x for x in pending if not stale & set(stages[x].after)]:
+                pending.remove(name)
+                running[executor.submit(run_stage_worker, stages[name].run)] = name
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                seconds, records = future.result()
+                metrics.merge(records)
+                stale.discard(name)
+                finish(name, seconds)
+
+    return [results[x] for x in ordered]
+
+
+def print_timings(results):
+    print(f"{'stage':<32} {'status':<12} {'seconds':>9}")
+    for record in results:
+        print(f"{record['stage']:<32} {record['status']:<12} {record['seconds']:>9.2f}")
@@ -0,0 +1,219 @@
+import argparse
+import gzip
+import hashlib
+import json
+import os
+from pathlib import Path
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# 処理済みの出力を内容のハッシュを含むファイル名でコピーし、
+# 圧縮済みの.gzと.brも作って、論理名 -> ファイル名のマニフェストを書き出す
+# 同じ内容なら同じファイル名になるので、CDNやブラウザで無期限にキャッシュでき、
+# 変わっていないデータセットは作り直しても再取得されない
+
+processed_dir = Path(
+    os.environ.get("JCD_DATA_DIR", Path(__file__).parents[1].joinpath("data"))
+).joinpath("processed")
+publish_dir = processed_dir.joinpath("publish")
+assets_dir = publish_dir.joinpath("assets")
+manifest_path = publish_dir.joinpath("manifest.json")
+# 以前のマニフェストが参照していたファイルの一覧（新しい順）
+history_path = publish_dir.joinpath("history.json")
+
+HASH_LENGTH = 16
+GZIP_LEVEL = 9
+BROTLI_QUALITY = 11
+
+# 公開する出力（processed_dirからの相対パスのパターン）
+# build_manifest.jsonとbuild_stages.jsonは差分更新用の内部ファイルなので含めない
+PUBLISHED_PATTERNS = [
+    "*.json",
+    "*.bin",
+    "station/*.json",
+    "map_tiles/index.json",
+    "map_tiles/*/*/*.json",
+    "surface/index.json",
+    "surface/*/*.npz",
+]
+EXCLUDED = {"build_manifest.json", "build_stages.json"}
+
+
+def find_outputs():
+    paths = set()
+    for pattern in PUBLISHED_PATTERNS:
+        paths.update(x for x in processed_dir.glob(pattern) if x.name not in EXCLUDED)
+    return sorted(x.relative_to(processed_dir).as_posix() for x in paths)
+
+
+def hashed_name(name, digest):
+    # station/44132.json -> station/44132.<hash>.json
+    path = Path(name)
+    return path.with_name(f"{path.stem}.{digest[:HASH_LENGTH]}{path.suffix}").as_posix()
+
+
+def write_if_missing(path, data):
+    # 内容がファイル名で決まるので、既にあれば書き直さない
+    if path.is_file():
+        return False
+
+    path.parent.mkdir(parents=True, exist_ok=True)
+    temporary_path = path.with_name(f"{path.name}.tmp")
+    temporary_path.write_bytes(data)
+    os.replace(temporary_path, path)
+    return True
+
+
+def publish_file(name, encoders):
+    data = processed_dir.joinpath(name).read_bytes()
+    digest = hashlib.sha256(data).hexdigest()
+    path = hashed_name(name, digest)
+
+    entry = {"path": f"assets/{path}", "sha256": digest, "bytes": len(data)}
+    written = write_if_missing(assets_dir.joinpath(path), data)
+
+    entry["encodings"] = {}
+    for encoding, (suffix, compress) in encoders.items():
+        encoded_path = assets_dir.joinpath(path + suffix)
+        if not encoded_path.is_file():
+            write_if_missing(encoded_path, compress(data))
+            written = True
+        entry["encodings"][encoding] = {
+            "path": f"assets/{path}{suffix}",
+            "bytes": encoded_path.stat().st_size,
+        }
+
+    return entry, written
+
+
+# 圧縮の種類 -> (拡張子, 圧縮する関数)
+def compressors(include_brotli=True):
+    encoders = {"gzip": (".gz", lambda x: gzip.compress(x, GZIP_LEVEL, mtime=0))}
+    if not include_brotli:
+        return encoders
+
+    # .brがないまま公開すると、_headersやマニフェストが揃っているように見えて
+    # brotliを受け付けるクライアントにも.gzしか返せないので、明示しない限り止める
+    if brotli is None:
+        raise RuntimeError(
+            "brotli is not installed, so the .br variants cannot be written. "
+            "Install it with `uv sync --extra brotli`, "
+            "or publish without them with `publish.py --no-brotli`."
+        )
+    encoders["br"] = (".br", lambda x: brotli.compress(x, quality=BROTLI_QUALITY))
+    return encoders
+
+
+def read_json(path, default):
+    if not path.is_file():
+        return default
+
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def write_json(path, data):
+    temporary_path = path.with_name(f"{path.name}.tmp")
+    with open(temporary_path, "w", encoding="utf-8") as f:
+        json.dump(data, f, indent=2)
+    os.replace(temporary_path, path)
+
+
+def manifest_paths(files):
+    paths = []
+    for entry in files.values():
+        paths.append(entry["path"])
+        paths.extend(x["path"] for x in entry["encodings"].values())
+    return sorted(paths)
+
+
+def prune_assets(keep):
+    # マニフェストから参照されていない古いファイルを削除する
+    kept = set(keep)
+    removed = 0
+    for path in assets_dir.rglob("*"):
+        if path.is_file() and path.relative_to(publish_dir).as_posix() not in kept:
+            path.unlink()
+            removed += 1
+    return removed
+
+
+def write_headers_file(base_path):
+    # Cloudflareの静的アセットの_headers形式。ハッシュ付きのファイルは無期限、
+    # マニフェストは毎回再検証させる
+    base_path = base_path.rstrip("/")
+    with open(publish_dir.joinpath("_headers"), "w", encoding="utf-8") as f:
+        f.write(
+            f"{base_path}/assets/*\n"
+            "  Cache-Control: public, max-age=31536000, immutable\n"
+            f"{base_path}/manifest.json\n"
+            "  Cache-Control: public, max-age=0, must-revalidate\n"
+        )
+
+
+def publish(keep_generations=1, base_path="/data", include_brotli=True):
+    encoders = compressors(include_brotli)
+    previous = read_json(manifest_path, {"files": {}})["files"]
+    history = read_json(history_path, [])
+
+    files = {}
+    written = 0
+    for name in find_outputs():
+        files[name], changed = publish_file(name, encoders)
+        written += changed
+
+    # 切り替え中のクライアントが古いマニフェストのファイルを取得できるよう、
+    # 直前の世代のファイルは残す
+    if previous and previous != files:
+        history.insert(0, manifest_paths(previous))
+    history = history[:keep_generations]
+
+    publish_dir.mkdir(parents=True, exist_ok=True)
+    write_json(manifest_path, {"files": files})
+    write_json(history_path, history)
+    write_headers_file(base_path)
+
+    keep = set(manifest_paths(files)).union(*history)
+    removed = prune_assets(keep)
+
+    print(
+        f"Published {len(files)} files ({written} new or changed, "
+        f"{removed} old assets removed)"
+    )
+    return manifest_path
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Write content-hashed, precompressed copies of the outputs"
+    )
+    parser.add_argument(
+        "--keep",
+        type=int,
+        default=1,
+        help="number of previous manifests whose files are kept (default: 1)",
+    )
+    parser.add_argument(
+        "--base-path",
+        default="/data",
+        help="URL path where processed/publish/ is deployed, for _headers",
+    )
+    parser.add_argument(
+        "--no-brotli",
+        action="store_true",
+        help="publish only the .gz variants when brotli is not installed",
+    )
+    args = parser.parse_args()
+
+    try:
+        compressors(not args.no_brotli)
+    except RuntimeError as e:
+        parser.error(str(e))
+    publish(args.keep, args.base_path, include_brotli=not args.no_brotli)
+
+
+if __name__ == "__main__":
+    main()
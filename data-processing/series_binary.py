@@ -0,0 +1,329 @@
+import argparse
+import json
+import os
+import struct
+import sys
+from array import array
+from pathlib import Path
+
+# 日別・月別の系列を固定長の整数（値 * scale）で保存するバイナリ形式
+#
+# ファイル構成（リトルエンディアン）:
+#   ヘッダー（40バイト）: マジック"JCDB", バージョン, 値のバイト数, scale,
+#                        1観測所あたりの値の数, 観測所数, データセット名（24バイト）
+#   観測所レコード: 観測所番号（ASCII 8バイト、右側をNULで埋める）+ 値の配列
+# 欠測値はその型の最小値で表す。レコードは固定長で観測所番号順に並ぶため、
+# 1観測所だけを二分探索で読み出せる。
+
+processed_dir = Path(
+    os.environ.get("JCD_DATA_DIR", Path(__file__).parents[1].joinpath("data"))
+).joinpath("processed")
+
+MAGIC = b"JCDB"
+VERSION = 1
+HEADER = struct.Struct("<4sBBHII24s")
+STATION_NUMBER_SIZE = 8
+
+# 値のバイト数 -> (arrayの型コード, 欠測値)
+value_types = {
+    2: ("h", -(2**15)),
+    4: ("i", -(2**31)),
+}
+
+NORMAL_ELEMENTS = ["temperature", "precipitation", "sunshine_duration"]
+
+# 4月1日から10月31日まで
+WBGT_MONTHS = range(4, 11)
+WBGT_DAYS = [
+    f"{month}/{day}"
+    for month in WBGT_MONTHS
+    for day in range(1, 32 if month in (5, 7, 8, 10) else 31)
+]
+WBGT_STATS = ["min", "max", "avg"]
+
+
+def all_none(values):
+    return all(x is None for x in values)
+
+
+def flatten_daily_normal(payload):
+    values = []
+    for element in NORMAL_ELEMENTS:
+        months = payload[element] or {}
+        for month in range(1, 13):
+            days = months.get(str(month)) or months.get(month) or [None] * 31
+            values.extend(days)
+    return values
+
+
+def unflatten_daily_normal(values):
+    payload = {}
+    for i, element in enumerate(NORMAL_ELEMENTS):
+        months = {}
+        for month in range(1, 13):
+            start = (i * 12 + month - 1) * 31
+            days = values[start : start + 31]
+            months[month] = None if all_none(days) else days
+        payload[element] = None if all_none(months.values()) else months
+    return payload
+
+
+def flatten_monthly_yearly_normal(payload):
+    values = []
+    for element in NORMAL_ELEMENTS:
+        values.extend(payload["monthly"][element] or [None] * 12)
+        values.append(payload["yearly"][element])
+    return values
+
+
+def unflatten_monthly_yearly_normal(values):
+    payload = {"monthly": {}, "yearly": {}}
+    for i, element in enumerate(NORMAL_ELEMENTS):
+        monthly = values[i * 13 : i * 13 + 12]
+        payload["monthly"][element] = None if all_none(monthly) else monthly
+        payload["yearly"][element] = values[i * 13 + 12]
+    return payload
+
+
+def flatten_daily_wbgt(payload):
+    values = []
+    for day in WBGT_DAYS:
+        stats = payload.get(day) or {}
+        values.extend(stats.get(x) for x in WBGT_STATS)
+    return values
+
+
+def unflatten_daily_wbgt(values):
+    payload = {}
+    for i, day in enumerate(WBGT_DAYS):
+        stats = values[i * 3 : i * 3 + 3]
+        # 値がない日はキーごと省く
+        if not all_none(stats):
+            payload[day] = dict(zip(WBGT_STATS, stats))
+    return payload
+
+
+def flatten_monthly_yearly_wbgt(payload):
+    monthly = payload["monthly"]
+    values = [monthly.get(str(x), monthly.get(x)) for x in WBGT_MONTHS]
+    values.append(payload["yearly"])
+    return values
+
+
+def unflatten_monthly_yearly_wbgt(values):
+    return {
+        "yearly": values[-1],
+        "monthly": {
+            month: value
+            for month, value in zip(WBGT_MONTHS, values)
+            if value is not None
+        },
+    }
+
+
+# データセット名 -> (1観測所あたりの値の数, 値のバイト数, 平坦化, 復元)
+# 年間降水量は int16 の範囲を超えるので、月別・年間の平年値は4バイトにする
+layouts = {
+    "daily_normal": (
+        len(NORMAL_ELEMENTS) * 12 * 31,
+        2,
+        flatten_daily_normal,
+        unflatten_daily_normal,
+    ),
+    "monthly_yearly_normal": (
+        len(NORMAL_ELEMENTS) * 13,
+        4,
+        flatten_monthly_yearly_normal,
+        unflatten_monthly_yearly_normal,
+    ),
+    "daily_wbgt": (
+        len(WBGT_DAYS) * len(WBGT_STATS),
+        2,
+        flatten_daily_wbgt,
+        unflatten_daily_wbgt,
+    ),
+    "monthly_yearly_wbgt": (
+        len(WBGT_MONTHS) + 1,
+        2,
+        flatten_monthly_yearly_wbgt,
+        unflatten_monthly_yearly_wbgt,
+    ),
+}
+
+
+def encode_values(values, value_size, scale):
+    typecode, missing = value_types[value_size]
+    limit = -missing - 1
+
+    encoded = array(typecode)
+    for value in values:
+        if value is None:
+            encoded.append(missing)
+            continue
+
+        scaled = round(value * scale)
+        if not -limit <= scaled <= limit:
+            raise ValueError(f"Value {value} does not fit in {value_size} bytes")
+        encoded.append(scaled)
+
+    if sys.byteorder == "big":
+        encoded.byteswap()
+    return encoded.tobytes()
+
+
+def decode_values(data, value_size, scale):
+    typecode, missing = value_types[value_size]
+
+    decoded = array(typecode)
+    decoded.frombytes(data)
+    if sys.byteorder == "big":
+        decoded.byteswap()
+
+    return [None if x == missing else x / scale for x in decoded]
+
+
+def write_series(path, name, items, scale=10):
+    values_per_station, value_size, flatten, _ = layouts[name]
+
+    items = sorted(items, key=lambda x: x[0])
+    with open(path, "wb") as f:
+        f.write(
+            HEADER.pack(
+                MAGIC,
+                VERSION,
+                value_size,
+                scale,
+                values_per_station,
+                len(items),
+                name.encode("ascii"),
+            )
+        )
+
+        for station_number, payload in items:
+            values = flatten(payload)
+            if len(values) != values_per_station:
+                raise ValueError(f"Unexpected series length for {station_number}")
+
+            f.write(station_number.encode("ascii").ljust(STATION_NUMBER_SIZE, b"\0"))
+            f.write(encode_values(values, value_size, scale))
+
+
+def read_header(f):
+    magic, version, value_size, scale, values_per_station, station_count, name = (
+        HEADER.unpack(f.read(HEADER.size))
+    )
+    if magic != MAGIC or version != VERSION:
+        raise ValueError("Not a series file or unsupported version")
+
+    return {
+        "name": name.rstrip(b"\0").decode("ascii"),
+        "value_size": value_size,
+        "scale": scale,
+        "values_per_station": values_per_station,
+        "station_count": station_count,
+        "record_size": STATION_NUMBER_SIZE + value_size * values_per_station,
+    }
+
+
+def read_record(f, header):
+    record = f.read(header["record_size"])
+    station_number = record[:STATION_NUMBER_SIZE].rstrip(b"\0").decode("ascii")
+    values = decode_values(
+        record[STATION_NUMBER_SIZE:], header["value_size"], header["scale"]
+    )
+    return station_number, layouts[header["name"]][3](values)
+
+
+def iter_series(path):
+    with open(path, "rb") as f:
+        header = read_header(f)
+        for _ in range(header["station_count"]):
+            yield read_record(f, header)
+
+
+def read_series(path):
+    return dict(iter_series(path))
+
+
+# 固定長レコードを二分探索し、1観測所分だけを読み込む
+def read_station(path, station_number):
+    key = station_number.encode("ascii").ljust(STATION_NUMBER_SIZE, b"\0")
+
+    with open(path, "rb") as f:
+        header = read_header(f)
+        low, high = 0, header["station_count"]
+        while low < high:
+            middle = (low + high) // 2
+            f.seek(HEADER.size + middle * header["record_size"])
+            current = f.read(STATION_NUMBER_SIZE)
+            if current < key:
+                low = middle + 1
+            elif current > key:
+                high = middle
+            else:
+                f.seek(-STATION_NUMBER_SIZE, 1)
+                return read_record(f, header)[1]
+
+    return None
+
+
+def write_series_files(names=None):
+    for name in names or layouts:
+        with open(processed_dir.joinpath(f"{name}.json"), encoding="utf-8") as f:
+            data = json.load(f)
+        write_series(processed_dir.joinpath(f"{name}.bin"), name, data.items())
+
+
+# JSONとして読み直した値と比べられるよう、キーと数値の型を揃える
+def normalize(value):
+    if isinstance(value, dict):
+        return {str(k): normalize(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [normalize(x) for x in value]
+    return value
+
+
+def verify_series_files(names=None):
+    ok = True
+    for name in names or layouts:
+        with open(processed_dir.joinpath(f"{name}.json"), encoding="utf-8") as f:
+            expected = json.load(f)
+        actual = normalize(read_series(processed_dir.joinpath(f"{name}.bin")))
+
+        mismatches = [k for k in expected if expected[k] != actual.get(k)]
+        mismatches += [k for k in actual if k not in expected]
+        print(f"{name}: {len(expected)} stations, {len(mismatches)} mismatches")
+        ok = ok and not mismatches
+
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Write or verify binary series files next to the JSON outputs"
+    )
+    parser.add_argument(
+        "names",
+        nargs="*",
+        metavar="NAME",
+        help=f"datasets to process (default: all of {', '.join(layouts)})",
+    )
+    parser.add_argument(
+        "--verify",
+        action="store_true",
+        help="compare existing .bin files with the JSON outputs",
+    )
+    args = parser.parse_args()
+
+    unknown = [x for x in args.names if x not in layouts]
+    if unknown:
+        parser.error(f"unknown dataset: {', '.join(unknown)}")
+
+    if args.verify:
+        sys.exit(0 if verify_series_files(args.names) else 1)
+
+    write_series_files(args.names)
+
+
+if __name__ == "__main__":
+    main()
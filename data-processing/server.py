@@ -0,0 +1,463 @@
+import argparse
+import asyncio
+import collections
+import concurrent.futures
+import gzip
+import hashlib
+import json
+import logging
+import re
+from urllib.parse import parse_qs, urlsplit
+
+import store
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# climate.duckdbの内容をHTTPで返すasyncioのサーバー
+# 応答はJSONを一度だけ作って圧縮し、サイズの上限つきのLRUキャッシュに保持する。
+# ETagは本文（と圧縮形式）ごとのハッシュで、If-None-Matchが一致すれば304を返す。
+
+DEFAULT_CACHE_BYTES = 64 * 2**20
+# これより小さい本文は圧縮しない
+MIN_COMPRESS_BYTES = 256
+GZIP_LEVEL = 9
+BROTLI_QUALITY = 9
+# リクエスト行・ヘッダー行の長さの上限（asyncio.StreamReaderの既定値と同じ）
+MAX_LINE_BYTES = 2**16
+
+logger = logging.getLogger(__name__)
+
+STATUS_REASONS = {
+    200: "OK",
+    304: "Not Modified",
+    400: "Bad Request",
+    404: "Not Found",
+    405: "Method Not Allowed",
+    431: "Request Header Fields Too Large",
+    500: "Internal Server Error",
+}
+
+
+class HttpError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+class Response:
+    # 圧縮形式ごとの本文とETag
+    def __init__(self, payload):
+        body = json.dumps(payload, ensure_ascii=False, separators=(",", ":")).encode(
+            "utf-8"
+        )
+        digest = hashlib.sha256(body).hexdigest()[:32]
+
+        self.bodies = {"identity": body}
+        if len(body) >= MIN_COMPRESS_BYTES:
+            self.bodies["gzip"] = gzip.compress(body, GZIP_LEVEL, mtime=0)
+            if brotli is not None:
+                self.bodies["br"] = brotli.compress(body, quality=BROTLI_QUALITY)
+
+        # 強いETagは表現ごとに異なる必要があるので、圧縮形式を付け加える
+        self.etags = {
+            x: f'"{digest}"' if x == "identity" else f'"{digest}-{x}"'
+            for x in self.bodies
+        }
+        self.size = sum(len(x) for x in self.bodies.values())
+
+
+class ResponseCache:
+    # 合計バイト数が上限を超えたら、最も長く使われていない応答から捨てる
+    def __init__(self, max_bytes=DEFAULT_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.entries = collections.OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        response = self.entries.get(key)
+        if response is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return response
+
+    def put(self, key, response):
+        if response.size > self.max_bytes:
+            return
+
+        if key in self.entries:
+            self.size -= self.entries.pop(key).size
+        self.entries[key] = response
+        self.size += response.size
+
+        while self.size > self.max_bytes:
+            _, evicted = self.entries.popitem(last=False)
+            self.size -= evicted.size
+            self.evictions += 1
+
+    def stats(self):
+        return {
+            "entries": len(self.entries),
+            "bytes": self.size,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+
+def choose_encoding(accept_encoding, available):
+    # q=0で明示的に拒否されたものを除き、br、gzipの順に選ぶ
+    accepted = {}
+    for item in accept_encoding.split(","):
+        name, _, params = item.strip().partition(";")
+        quality = 1.0
+        match = re.search(r"q=([0-9.]+)", params)
+        if match:
+            try:
+                quality = float(match.group(1))
+            except ValueError:
+                quality = 0.0
+        accepted[name.strip().lower()] = quality
+
+    for encoding in ("br", "gzip"):
+        if encoding in available and accepted.get(encoding, 0) > 0:
+            return encoding
+    return "identity"
+
+
+def etag_matches(if_none_match, etag):
+    if if_none_match.strip() == "*":
+        return True
+    # 弱い比較（W/）も一致として扱う
+    tags = [x.strip().removeprefix("W/") for x in if_none_match.split(",")]
+    return etag in tags
+
+
+# 上限を超える行はStreamReader.readline()がValueErrorにするので、statusのエラーにする
+async def read_line(reader, status, message):
+    try:
+        return await reader.readline()
+    except ValueError:
+        raise HttpError(status, message)
+
+
+def query_int(params, name, default):
+    try:
+        return int(params.get(name, [default])[0])
+    except ValueError:
+        raise HttpError(400, f"{name} must be an integer")
+
+
+def query_float(params, name):
+    try:
+        return float(params[name][0])
+    except (KeyError, ValueError):
+        raise HttpError(400, f"{name} must be a number")
+
+
+# 経路 -> 応答を作る関数（ClimateStoreと正規表現の一致、クエリ文字列を受け取る）
+def station_index(db, match, params):
+    return db.get_station_index()
+
+
+def require_station(db, station_number):
+    result = db.get_station(station_number)
+    if result is None:
+        raise HttpError(404, "station not found")
+    return result
+
+
+def station(db, match, params):
+    return require_station(db, match["station_number"])
+
+
+def daily_series(db, match, params):
+    element = match["element"]
+    if element not in store.DAILY_ELEMENTS:
+        raise HttpError(404, f"unknown daily element: {element}")
+    require_station(db, match["station_number"])
+    return [
+        {"month": month, "day": day, "value": value}
+        for month, day, value in db.get_daily_series(match["station_number"], element)
+    ]
+
+
+def monthly_series(db, match, params):
+    element = match["element"]
+    if element not in store.MONTHLY_ELEMENTS:
+        raise HttpError(404, f"unknown monthly element: {element}")
+    require_station(db, match["station_number"])
+    series = db.get_monthly_series(match["station_number"], element)
+    return {
+        "yearly": next((value for month, value in series if month == 0), None),
+        "monthly": {str(month): value for month, value in series if month != 0},
+    }
+
+
+def bbox(db, match, params):
+    south, west, north, east = (
+        query_float(params, x) for x in ("south", "west", "north", "east")
+    )
+    return [
+        {
+            "station_number": station_number,
+            "station_name": station_name,
+            "latitude": latitude,
+            "longitude": longitude,
+        }
+        for station_number, station_name, latitude, longitude in db.stations_in_bbox(
+            south, west, north, east
+        )
+    ]
+
+
+def ranking(db, match, params):
+    element = match["element"]
+    if element not in store.MONTHLY_ELEMENTS:
+        raise HttpError(404, f"unknown element: {element}")
+    month = query_int(params, "month", 0)
+    n = query_int(params, "n", 10)
+    if not 0 <= month <= 12 or not 1 <= n <= 10000:
+        raise HttpError(400, "month must be 0-12 and n 1-10000")
+    order = params.get("order", ["desc"])[0]
+    if order not in ("asc", "desc"):
+        raise HttpError(400, "order must be asc or desc")
+
+    return [
+        {"rank": i, "station_number": x, "station_name": name, "value": value}
+        for i, (x, name, value) in enumerate(
+            db.top_n(element, month, n, ascending=order == "asc"), 1
+        )
+    ]
+
+
+routes = [
+    (re.compile(r"^/stations$"), station_index),
+    (re.compile(r"^/stations/(?P<station_number>\d+)$"), station),
+    (
+        re.compile(r"^/stations/(?P<station_number>\d+)/daily/(?P<element>\w+)$"),
+        daily_series,
+    ),
+    (
+        re.compile(r"^/stations/(?P<station_number>\d+)/monthly/(?P<element>\w+)$"),
+        monthly_series,
+    ),
+    (re.compile(r"^/bbox$"), bbox),
+    (re.compile(r"^/ranking/(?P<element>\w+)$"), ranking),
+]
+
+
+class ClimateServer:
+    def __init__(self, path=None, cache_bytes=DEFAULT_CACHE_BYTES):
+        self.path = path
+        self.cache = ResponseCache(cache_bytes)
+        # 同じキーの応答を作っている途中なら、その結果を待つ
+        self.pending = {}
+        # DuckDBの接続はスレッド間で共有できないので、1つのスレッドだけで使う
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=1, initializer=self._open_store
+        )
+        self.requests = 0
+        self.not_modified = 0
+
+    def _open_store(self):
+        self.db = store.ClimateStore(self.path)
+
+    def _build(self, handler, match, params):
+        return Response(handler(self.db, match, params))
+
+    async def get_response(self, target):
+        url = urlsplit(target)
+        for pattern, handler in routes:
+            match = pattern.match(url.path)
+            if match:
+                break
+        else:
+            raise HttpError(404, "not found")
+
+        params = parse_qs(url.query)
+        # クエリ文字列の順序が違っても同じキャッシュを使う
+        key = (url.path, tuple(sorted((k, tuple(v)) for k, v in params.items())))
+
+        response = self.cache.get(key)
+        if response is not None:
+            return response
+
+        if key in self.pending:
+            return await asyncio.shield(self.pending[key])
+
+        loop = asyncio.get_running_loop()
+        future = loop.run_in_executor(
+            self.executor, self._build, handler, match.groupdict(), params
+        )
+        self.pending[key] = future
+        try:
+            response = await future
+        finally:
+            del self.pending[key]
+
+        self.cache.put(key, response)
+        return response
+
+    def stats(self):
+        return {
+            "requests": self.requests,
+            "not_modified": self.not_modified,
+            "cache": self.cache.stats(),
+        }
+
+    async def handle(self, reader, writer):
+        try:
+            while await self.handle_request(reader, writer):
+                pass
+        except (
+            ConnectionError,
+            asyncio.IncompleteReadError,
+            asyncio.LimitOverrunError,
+        ):
+            pass
+        finally:
+            writer.close()
+
+    async def handle_request(self, reader, writer):
+        # 1リクエストを処理し、接続を続けるかどうかを返す
+        try:
+            request_line = await read_line(reader, 400, "request line too long")
+            if not request_line:
+                return False
+
+            try:
+                method, target, version = request_line.decode("latin-1").split()
+            except ValueError:
+                raise HttpError(400, "bad request line")
+
+            headers = {}
+            while True:
+                line = await read_line(reader, 431, "header line too long")
+                if line in (b"\r\n", b"\n", b""):
+                    break
+                name, _, value = line.decode("latin-1").partition(":")
+                headers[name.strip().lower()] = value.strip()
+        except HttpError as e:
+            # 読み残しがあるので接続は続けない
+            await self.send(writer, e.status, {"error": str(e)}, close=True)
+            return False
+
+        connection = headers.get("connection", "").lower()
+        keep_alive = (
+            connection != "close"
+            if version == "HTTP/1.1"
+            else connection == "keep-alive"
+        )
+
+        self.requests += 1
+        if method not in ("GET", "HEAD"):
+            await self.send(writer, 405, {"error": "method not allowed"}, close=True)
+            return False
+
+        if target == "/stats":
+            await self.send(writer, 200, self.stats(), head=method == "HEAD")
+            return keep_alive
+
+        try:
+            response = await self.get_response(target)
+        except HttpError as e:
+            await self.send(writer, e.status, {"error": str(e)}, head=method == "HEAD")
+            return keep_alive
+        except Exception:
+            # 内部の情報は応答に含めず、サーバーのログに残す
+            logger.exception("failed to build the response for %s", target)
+            await self.send(writer, 500, {"error": "internal server error"}, close=True)
+            return False
+
+        encoding = choose_encoding(headers.get("accept-encoding", ""), response.bodies)
+        etag = response.etags[encoding]
+        common = {"ETag": etag, "Vary": "Accept-Encoding", "Cache-Control": "no-cache"}
+
+        if etag_matches(headers.get("if-none-match", ""), etag):
+            self.not_modified += 1
+            self.write_head(writer, 304, common)
+        else:
+            body = response.bodies[encoding]
+            self.write_head(
+                writer,
+                200,
+                common
+                | {
+                    "Content-Type": "application/json; charset=utf-8",
+                    "Content-Length": str(len(body)),
+                }
+                | ({} if encoding == "identity" else {"Content-Encoding": encoding}),
+            )
+            if method != "HEAD":
+                writer.write(body)
+
+        await writer.drain()
+        return keep_alive
+
+    def write_head(self, writer, status, headers):
+        lines = [f"HTTP/1.1 {status} {STATUS_REASONS[status]}"]
+        lines += [f"{k}: {v}" for k, v in headers.items()]
+        writer.write(("\r\n".join(lines) + "\r\n\r\n").encode("latin-1"))
+
+    async def send(self, writer, status, payload, head=False, close=False):
+        # キャッシュしない応答（エラーと統計）
+        body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        headers = {
+            "Content-Type": "application/json; charset=utf-8",
+            "Content-Length": str(len(body)),
+            "Cache-Control": "no-store",
+        }
+        if close:
+            headers["Connection"] = "close"
+
+        self.write_head(writer, status, headers)
+        if not head:
+            writer.write(body)
+        await writer.drain()
+
+    async def serve(self, host, port):
+        server = await asyncio.start_server(
+            self.handle, host, port, limit=MAX_LINE_BYTES
+        )
+        print(f"Serving on http://{host}:{port}", flush=True)
+        async with server:
+            await server.serve_forever()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Serve processed/climate.duckdb over HTTP with caching"
+    )
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--path", help="default: processed/climate.duckdb")
+    parser.add_argument(
+        "--cache-mb",
+        type=float,
+        default=DEFAULT_CACHE_BYTES / 2**20,
+        help="maximum size of the response cache, compressed variants included",
+    )
+    args = parser.parse_args()
+
+    server = ClimateServer(args.path, int(args.cache_mb * 2**20))
+    try:
+        asyncio.run(server.serve(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.executor.shutdown()
+        print(json.dumps(server.stats()))
+
+
+if __name__ == "__main__":
+    main()
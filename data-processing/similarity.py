@@ -0,0 +1,294 @@
+import argparse
+import json
+import math
+import os
+import random
+import time
+from pathlib import Path
+
+import numpy as np
+
+# 月別の平年値とWBGTから、気候が似ている観測所を探すための索引
+# 指標・月ごとの値を全観測所で標準化した特徴量の行列を作り、欠測はマスクで除く。
+# 距離は2つの観測所の両方にある特徴量だけで求めた、標準化した値の差の二乗平均平方根。
+# 指標ごとの重みの合計を1にして、月の数が違う指標（WBGTは7か月）も同じ重みで比べる。
+
+processed_dir = Path(
+    os.environ.get("JCD_DATA_DIR", Path(__file__).parents[1].joinpath("data"))
+).joinpath("processed")
+
+# 指標 -> (元の出力, 月)
+similarity_features = {
+    "temperature": ("monthly_yearly_normal", range(1, 13)),
+    "precipitation": ("monthly_yearly_normal", range(1, 13)),
+    "sunshine_duration": ("monthly_yearly_normal", range(1, 13)),
+    "wbgt": ("monthly_yearly_wbgt", range(4, 11)),
+}
+
+# climate_similarity.jsonに書き出す似ている観測所の数
+SIMILAR_COUNT = 10
+# 両方にある特徴量の重みの合計がこれ未満の組は比べない（1 = 1指標分）
+MIN_SHARED_WEIGHT = 1.0
+# 一度に距離を求める観測所の数。距離の行列は BATCH_SIZE x 観測所数 になる
+BATCH_SIZE = 512
+
+
+def load_profiles():
+    outputs = {}
+    for name, _ in similarity_features.values():
+        with open(processed_dir.joinpath(f"{name}.json"), encoding="utf-8") as f:
+            outputs[name] = json.load(f)
+
+    profiles = {}
+    for metric, (name, months) in similarity_features.items():
+        for station_number, payload in outputs[name].items():
+            if metric == "wbgt":
+                monthly = [payload["monthly"].get(str(x)) for x in months]
+            else:
+                monthly = payload["monthly"][metric] or [None] * len(months)
+            profiles.setdefault(station_number, {})[metric] = monthly
+
+    # 観測所ごとに指標の順で並べ、ない指標はNoneで埋める
+    return {
+        station_number: [
+            x
+            for metric, (_, months) in similarity_features.items()
+            for x in values.get(metric, [None] * len(months))
+        ]
+        for station_number, values in profiles.items()
+    }
+
+
+def feature_weights():
+    return np.concatenate(
+        [np.full(len(x), 1 / len(x)) for _, x in similarity_features.values()]
+    )
+
+
+class ClimateIndex:
+    def __init__(self, profiles):
+        # profiles: 観測所番号 -> 特徴量の値のリスト（欠測はNone）
+        matrix = np.array(
+            [profiles[x] for x in sorted(profiles)], dtype=np.float64
+        )  # None -> NaN
+        present = ~np.isnan(matrix)
+        # 値が1つもない観測所は含めない
+        keep = present.any(axis=1)
+
+        self.station_numbers = [x for x, k in zip(sorted(profiles), keep) if k]
+        self.positions = {x: i for i, x in enumerate(self.station_numbers)}
+        self.weights = feature_weights()
+        self.mask = present[keep].astype(np.float64)
+
+        # 特徴量ごとに全観測所の平均と標準偏差で標準化し、欠測は0にしておく
+        matrix = matrix[keep]
+        count = np.maximum(self.mask.sum(axis=0), 1)
+        mean = np.nansum(matrix, axis=0) / count
+        std = np.sqrt(np.nansum((matrix - mean) ** 2, axis=0) / count)
+        self.values = np.where(
+            present[keep], (matrix - mean) / np.where(std > 0, std, 1), 0.0
+        )
+
+        # 距離の計算で使う、重みとマスクを掛けた行列
+        self.weighted_mask = self.mask * self.weights
+        self.weighted_values = self.values * self.weights
+        self.weighted_squares = self.values**2 * self.weights
+
+    # rowsの観測所と全観測所の距離の行列（比べられない組はinf）
+    # (a - b)^2 = a^2 + b^2 - 2ab を、両方にある特徴量だけで足し合わせる
+    def distances(self, rows):
+        mask = self.mask[rows]
+        shared = mask @ self.weighted_mask.T
+        squared = (
+            self.weighted_squares[rows] @ self.mask.T
+            + mask @ self.weighted_squares.T
+            - 2 * self.values[rows] @ self.weighted_values.T
+        )
+        with np.errstate(divide="ignore", invalid="ignore"):
+            result = np.sqrt(np.maximum(squared, 0) / shared)
+        result[shared < MIN_SHARED_WEIGHT - 1e-9] = np.inf
+        return result
+
+    # 距離の行列の各行から、自分を除いて近いk個を距離・観測所番号の順に選ぶ
+    def _top_k(self, rows, distances, k):
+        distances[np.arange(len(rows)), rows] = np.inf
+        k = min(k, len(self.station_numbers) - 1)
+        if k <= 0:
+            return [[] for _ in rows]
+
+        candidates = np.argpartition(distances, k - 1, axis=1)[:, :k]
+        candidate_distances = np.take_along_axis(distances, candidates, axis=1)
+        # 観測所番号は位置の順なので、位置を第2キーにすると番号順になる
+        order = np.lexsort((candidates, candidate_distances), axis=1)
+        candidates = np.take_along_axis(candidates, order, axis=1)
+        candidate_distances = np.take_along_axis(candidate_distances, order, axis=1)
+
+        return [
+            [
+                (self.station_numbers[i], d)
+                for i, d in zip(indexes, values)
+                if math.isfinite(d)
+            ]
+            for indexes, values in zip(
+                candidates.tolist(), candidate_distances.tolist()
+            )
+        ]
+
+    def nearest(self, station_number, k=SIMILAR_COUNT):
+        row = self.positions[station_number]
+        return self._top_k([row], self.distances([row]), k)[0]
+
+    # 全観測所の似ている観測所をBATCH_SIZEずつまとめて求める
+    def nearest_all(self, k=SIMILAR_COUNT, batch_size=BATCH_SIZE):
+        for start in range(0, len(self.station_numbers), batch_size):
+            rows = np.arange(start, min(start + batch_size, len(self.station_numbers)))
+            yield from zip(
+                self.station_numbers[start : start + batch_size],
+                self._top_k(rows, self.distances(rows), k),
+            )
+
+    # 比較用の1組ずつの計算
+    def brute_force_nearest(self, station_number, k=SIMILAR_COUNT):
+        row = self.positions[station_number]
+        a_values = self.values[row].tolist()
+        a_mask = self.mask[row].tolist()
+        weights = self.weights.tolist()
+
+        items = []
+        for i, x in enumerate(self.station_numbers):
+            if i == row:
+                continue
+
+            shared = 0.0
+            squared = 0.0
+            for a, a_present, b, b_present, w in zip(
+                a_values,
+                a_mask,
+                self.values[i].tolist(),
+                self.mask[i].tolist(),
+                weights,
+            ):
+                if a_present and b_present:
+                    shared += w
+                    squared += w * (a - b) ** 2
+            if shared >= MIN_SHARED_WEIGHT - 1e-9:
+                items.append((x, math.sqrt(squared / shared)))
+
+        return sorted(items, key=lambda x: (x[1], x[0]))[:k]
+
+
+def load_climate_index():
+    return ClimateIndex(load_profiles())
+
+
+def create_climate_similarity_object(index=None, k=SIMILAR_COUNT):
+    index = index or load_climate_index()
+    return {
+        station_number: [
+            {"station_number": x, "distance": round(distance, 3)}
+            for x, distance in similar
+        ]
+        for station_number, similar in index.nearest_all(k)
+    }
+
+
+def write_climate_similarity(k=SIMILAR_COUNT):
+    similarity = create_climate_similarity_object(k=k)
+
+    path = processed_dir.joinpath("climate_similarity.json")
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(similarity, f, indent=2)
+    return path
+
+
+def run_benchmark(index, query_count=100, k=SIMILAR_COUNT, seed=0):
+    start = time.perf_counter()
+    batched = dict(index.nearest_all(k))
+    batched_seconds = time.perf_counter() - start
+
+    rng = random.Random(seed)
+    queries = rng.sample(
+        index.station_numbers, min(query_count, len(index.station_numbers))
+    )
+
+    start = time.perf_counter()
+    single = [index.nearest(x, k) for x in queries]
+    single_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    brute_force = [index.brute_force_nearest(x, k) for x in queries]
+    brute_force_seconds = time.perf_counter() - start
+
+    # 計算の順序による誤差は無視し、観測所と丸めた距離で比べる
+    def rounded(items):
+        return [(x, round(d, 6)) for x, d in items]
+
+    mismatches = sum(
+        rounded(batched[x]) != rounded(b) or rounded(s) != rounded(b)
+        for x, s, b in zip(queries, single, brute_force)
+    )
+    station_count = len(index.station_numbers)
+    brute_force_per_query = brute_force_seconds / len(queries)
+    print(
+        f"all stations batched: {batched_seconds:.2f}s "
+        f"({batched_seconds / station_count * 1e3:.3f} ms per station)"
+    )
+    print(
+        f"nearest({k}): {single_seconds / len(queries) * 1e3:.3f} ms, "
+        f"brute force {brute_force_per_query * 1e3:.3f} ms per query "
+        f"(all stations ~{brute_force_per_query * station_count:.0f}s), "
+        f"{mismatches} mismatches in {len(queries)} queries"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Write climate_similarity.json or benchmark the similarity search"
+    )
+    parser.add_argument("-k", type=int, default=SIMILAR_COUNT)
+    parser.add_argument(
+        "--station", help="print the stations most similar to this station"
+    )
+    parser.add_argument(
+        "--benchmark",
+        action="store_true",
+        help="compare batched matrix queries with pairwise Python loops",
+    )
+    parser.add_argument(
+        "--scale",
+        type=int,
+        default=1,
+        help="benchmark with this many jittered copies of each station",
+    )
+    args = parser.parse_args()
+
+    if args.station:
+        index = load_climate_index()
+        for x, distance in index.nearest(args.station, args.k):
+            print(f"{x}\t{distance:.3f}")
+        return
+
+    if not args.benchmark:
+        write_climate_similarity(args.k)
+        return
+
+    profiles = load_profiles()
+    if args.scale > 1:
+        # 観測所が増えた場合を想定し、値を少しずらした観測所を加える
+        rng = random.Random(0)
+        profiles = {
+            f"{x}-{i}": [
+                None if v is None else v * (1 + rng.uniform(-0.05, 0.05))
+                for v in values
+            ]
+            for x, values in profiles.items()
+            for i in range(args.scale)
+        }
+
+    index = ClimateIndex(profiles)
+    print(f"{len(index.station_numbers)} stations")
+    run_benchmark(index, k=args.k)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,270 @@
+import argparse
+import heapq
+import json
+import math
+import os
+import random
+import time
+from pathlib import Path
+
+# 観測所の位置から近傍の観測所を探すための空間インデックス
+# 緯度経度を単位球面上の3次元座標に変換してKD木を作る。
+# 球面上の距離（大円距離）は3次元の直線距離（弦の長さ）に対して単調なので、
+# KD木の枝刈りは直線距離で行い、結果の距離はハーバサイン公式で求める。
+
+processed_dir = Path(
+    os.environ.get("JCD_DATA_DIR", Path(__file__).parents[1].joinpath("data"))
+).joinpath("processed")
+
+EARTH_RADIUS_KM = 6371.0088
+
+# station_neighbors.jsonに書き出す近傍の観測所数
+NEIGHBOR_COUNT = 10
+
+
+def haversine(latitude1, longitude1, latitude2, longitude2):
+    phi1 = math.radians(latitude1)
+    phi2 = math.radians(latitude2)
+    d_phi = phi2 - phi1
+    d_lambda = math.radians(longitude2 - longitude1)
+
+    a = (
+        math.sin(d_phi / 2) ** 2
+        + math.cos(phi1) * math.cos(phi2) * math.sin(d_lambda / 2) ** 2
+    )
+    return 2 * EARTH_RADIUS_KM * math.asin(min(1.0, math.sqrt(a)))
+
+
+def to_unit_vector(latitude, longitude):
+    phi = math.radians(latitude)
+    lam = math.radians(longitude)
+    return (
+        math.cos(phi) * math.cos(lam),
+        math.cos(phi) * math.sin(lam),
+        math.sin(phi),
+    )
+
+
+def chord_for_distance(distance_km):
+    # 大円距離に対応する弦の長さの2乗
+    angle = min(math.pi, distance_km / EARTH_RADIUS_KM)
+    return (2 * math.sin(angle / 2)) ** 2
+
+
+def squared_distance(a, b):
+    return (a[0] - b[0]) ** 2 + (a[1] - b[1]) ** 2 + (a[2] - b[2]) ** 2
+
+
+class SpatialIndex:
+    def __init__(self, stations):
+        # stations: 観測所番号 -> (緯度, 経度)
+        self.station_numbers = sorted(stations)
+        self.coordinates = [stations[x] for x in self.station_numbers]
+        self.points = [to_unit_vector(*x) for x in self.coordinates]
+        self.positions = {x: i for i, x in enumerate(self.station_numbers)}
+        self.root = self._build(list(range(len(self.points))), 0)
+
+    # ノードは (点の番号, 分割軸, 左の子, 右の子) のタプル
+    def _build(self, indexes, depth):
+        if not indexes:
+            return None
+
+        axis = depth % 3
+        indexes.sort(key=lambda i: self.points[i][axis])
+        middle = len(indexes) // 2
+        return (
+            indexes[middle],
+            axis,
+            self._build(indexes[:middle], depth + 1),
+            self._build(indexes[middle + 1 :], depth + 1),
+        )
+
+    def _result(self, latitude, longitude, indexes):
+        items = [
+            (
+                self.station_numbers[i],
+                haversine(latitude, longitude, *self.coordinates[i]),
+            )
+            for i in indexes
+        ]
+        # 同じ距離の場合は観測所番号順にして結果を決定的にする
+        return sorted(items, key=lambda x: (x[1], x[0]))
+
+    def nearest(self, latitude, longitude, k=1, exclude=None):
+        target = to_unit_vector(latitude, longitude)
+        excluded = self.positions.get(exclude)
+
+        # 最大ヒープ（符号を反転）でk個の候補を保持する
+        best = []
+
+        def search(node):
+            if node is None:
+                return
+
+            index, axis, left, right = node
+            if index != excluded:
+                distance = squared_distance(self.points[index], target)
+                if len(best) < k:
+                    heapq.heappush(best, (-distance, -index))
+                elif (-distance, -index) > best[0]:
+                    heapq.heapreplace(best, (-distance, -index))
+
+            diff = target[axis] - self.points[index][axis]
+            near, far = (left, right) if diff < 0 else (right, left)
+            search(near)
+            if len(best) < k or diff * diff <= -best[0][0]:
+                search(far)
+
+        search(self.root)
+        return self._result(latitude, longitude, [-i for _, i in best])
+
+    def within(self, latitude, longitude, radius_km, exclude=None):
+        target = to_unit_vector(latitude, longitude)
+        limit = chord_for_distance(radius_km)
+        excluded = self.positions.get(exclude)
+
+        found = []
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            if node is None:
+                continue
+
+            index, axis, left, right = node
+            if (
+                index != excluded
+                and squared_distance(self.points[index], target) <= limit
+            ):
+                found.append(index)
+
+            diff = target[axis] - self.points[index][axis]
+            if diff <= 0 or diff * diff <= limit:
+                stack.append(left)
+            if diff >= 0 or diff * diff <= limit:
+                stack.append(right)
+
+        return self._result(latitude, longitude, found)
+
+    # 比較用の全件走査
+    def brute_force_nearest(self, latitude, longitude, k=1, exclude=None):
+        items = [
+            (x, haversine(latitude, longitude, *self.coordinates[i]))
+            for i, x in enumerate(self.station_numbers)
+            if x != exclude
+        ]
+        return sorted(items, key=lambda x: (x[1], x[0]))[:k]
+
+    def brute_force_within(self, latitude, longitude, radius_km, exclude=None):
+        items = [
+            (x, haversine(latitude, longitude, *self.coordinates[i]))
+            for i, x in enumerate(self.station_numbers)
+            if x != exclude
+        ]
+        return sorted(
+            [x for x in items if x[1] <= radius_km], key=lambda x: (x[1], x[0])
+        )
+
+
+def load_station_index():
+    with open(processed_dir.joinpath("station_index.json"), encoding="utf-8") as f:
+        station_index = json.load(f)
+
+    return SpatialIndex(
+        {
+            k: (v["latitude"], v["longitude"])
+            for k, v in station_index.items()
+            if v["latitude"] is not None and v["longitude"] is not None
+        }
+    )
+
+
+def create_station_neighbors_object(index=None, k=NEIGHBOR_COUNT):
+    index = index or load_station_index()
+    return {
+        station_number: [
+            {"station_number": x, "distance_km": round(distance, 2)}
+            for x, distance in index.nearest(
+                latitude, longitude, k, exclude=station_number
+            )
+        ]
+        for station_number, (latitude, longitude) in zip(
+            index.station_numbers, index.coordinates
+        )
+    }
+
+
+def write_station_neighbors(k=NEIGHBOR_COUNT):
+    neighbors = create_station_neighbors_object(k=k)
+
+    path = processed_dir.joinpath("station_neighbors.json")
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(neighbors, f, indent=2)
+    return path
+
+
+def run_benchmark(index, query_count=1000, k=NEIGHBOR_COUNT, radius_km=30, seed=0):
+    rng = random.Random(seed)
+    queries = [
+        (rng.uniform(24.0, 45.5), rng.uniform(123.0, 146.0)) for _ in range(query_count)
+    ]
+
+    for name, indexed, brute_force, argument in (
+        ("nearest", index.nearest, index.brute_force_nearest, k),
+        ("within", index.within, index.brute_force_within, radius_km),
+    ):
+        start = time.perf_counter()
+        indexed_results = [indexed(*x, argument) for x in queries]
+        indexed_seconds = time.perf_counter() - start
+
+        start = time.perf_counter()
+        brute_force_results = [brute_force(*x, argument) for x in queries]
+        brute_force_seconds = time.perf_counter() - start
+
+        mismatches = sum(a != b for a, b in zip(indexed_results, brute_force_results))
+        print(
+            f"{name}({argument}): KD-tree {indexed_seconds / query_count * 1e3:.3f} ms, "
+            f"brute force {brute_force_seconds / query_count * 1e3:.3f} ms per query, "
+            f"{mismatches} mismatches"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Write station_neighbors.json or benchmark the spatial index"
+    )
+    parser.add_argument("-k", type=int, default=NEIGHBOR_COUNT)
+    parser.add_argument(
+        "--benchmark",
+        action="store_true",
+        help="compare KD-tree queries with brute force instead of writing",
+    )
+    parser.add_argument(
+        "--scale",
+        type=int,
+        default=1,
+        help="benchmark with this many jittered copies of each station",
+    )
+    args = parser.parse_args()
+
+    if not args.benchmark:
+        write_station_neighbors(args.k)
+        return
+
+    index = load_station_index()
+    if args.scale > 1:
+        # 観測所が増えた場合を想定し、周辺にずらした点を加える
+        rng = random.Random(0)
+        index = SpatialIndex(
+            {
+                f"{x}-{i}": (lat + rng.uniform(-0.2, 0.2), lon + rng.uniform(-0.2, 0.2))
+                for x, (lat, lon) in zip(index.station_numbers, index.coordinates)
+                for i in range(args.scale)
+            }
+        )
+
+    print(f"{len(index.station_numbers)} stations")
+    run_benchmark(index, k=args.k)
+
+
+if __name__ == "__main__":
+    main()
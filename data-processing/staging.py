@@ -0,0 +1,379 @@
+import hashlib
+import json
+import os
+import shutil
+from pathlib import Path
+
+import duckdb
+from duckdb import ColumnExpression, SQLExpression, StarExpression
+
+import wbgt_layout
+
+# 生のCSVを一度だけParquetに変換して再利用するためのステージング層
+# 変換結果は元ファイルのハッシュをキーにして管理し、元ファイルが変わった単位だけ作り直す
+
+data_dir = Path(
+    os.environ.get("JCD_DATA_DIR", Path(__file__).parents[1].joinpath("data"))
+)
+raw_dir = data_dir.joinpath("raw")
+moe_wbgt_dir = raw_dir.joinpath("moe-wbgt")
+jma_normal_dir = raw_dir.joinpath("jma-normal")
+jma_station_dir = raw_dir.joinpath("jma-station")
+staging_dir = data_dir.joinpath("staging")
+staging_manifest_path = staging_dir.joinpath("manifest.json")
+
+# load()のたびに元ファイルの変更を確認するか
+# 並列実行のワーカーでは、メインプロセスで更新済みなのでFalseにする
+refresh_on_load = True
+
+
+def daily_normal_column_names():
+    column_names = [
+        "period_type",
+        "station_number",
+        "element_number",
+        "data_years",
+        "start_year",
+        "end_year",
+        "month",
+    ]
+
+    for day in range(1, 32):
+        column_names.append(f"day{day}_value")
+        column_names.append(f"day{day}_remark")
+
+    return column_names
+
+
+def monthly_normal_column_names():
+    column_names = [
+        "period_type",
+        "station_number",
+        "element_number",
+        "data_years",
+        "start_year",
+        "end_year",
+    ]
+
+    for month in range(1, 13):
+        column_names.append(f"month{month}_value")
+        column_names.append(f"month{month}_remark")
+
+    column_names.append("year_value")
+    column_names.append("year_remark")
+
+    return column_names
+
+
+# amdmaster.index4.csvの2行目が列の単位を示す行になっており、
+# DuckDBで読み込むときに邪魔になるので削除する。
+def ensure_cleaned_amdmaster_index():
+    src = jma_station_dir.joinpath("amdmaster.index4.csv")
+    dst = jma_station_dir.joinpath("amdmaster.index4.cleaned.csv")
+
+    if dst.exists():
+        return dst
+
+    with open(src, encoding="utf-8") as old, open(dst, "w", encoding="utf-8") as new:
+        for i, line in enumerate(old):
+            if i == 1:
+                continue
+            new.write(line)
+
+    return dst
+
+
+def get_latest_ame_master_index():
+    dir = jma_station_dir
+    files = list(dir.glob("ame_master_*.csv"))
+    files.sort()
+    return files[-1]
+
+
+def list_daily_normal_sources():
+    files = sorted(jma_normal_dir.joinpath("daily").glob("nml_amd_d_*.csv"))
+    return {x.stem.split("_")[-1]: [x] for x in files}
+
+
+def list_monthly_normal_sources():
+    files = sorted(jma_normal_dir.joinpath("monthly").glob("nml_amd_m_*.csv"))
+    return {x.stem.split("_")[-1]: [x] for x in files}
+
+
+# 地点・年ごとにまとめ、新しい年のファイルを追加しても既存の年は変換し直さない
+def list_wbgt_sources():
+    moved = wbgt_layout.convert_flat_layout(moe_wbgt_dir)
+    if moved:
+        print(f"Moved {moved} WBGT files into the point=/year=/month= layout")
+
+    sources = {}
+    for path in wbgt_layout.list_files(moe_wbgt_dir):
+        point = path.parents[2].name.removeprefix("point=")
+        year = path.parents[1].name.removeprefix("year=")
+        sources.setdefault(f"{point}/{year}", []).append(path)
+    return sources
+
+
+def list_station_history_sources():
+    return {"all": [ensure_cleaned_amdmaster_index()]}
+
+
+def list_station_latest_sources():
+    return {"all": [get_latest_ame_master_index()]}
+
+
+def read_normal_csv(files, column_names, pattern):
+    # 値と品質情報は整数で固定し、ファイルごとの型推定の揺れを防ぐ
+    dtype = {
+        x: "INTEGER"
+        for x in column_names
+        if x.endswith(("_value", "_remark")) or x in ("element_number", "month")
+    }
+
+    # 観測所番号はファイル名から取り出す
+    return duckdb.read_csv(
+        [str(x) for x in files], names=column_names, dtype=dtype, filename=True
+    ).select(
+        SQLExpression(f"regexp_extract(filename, '{pattern}', 1)").alias(
+            "station_number"
+        ),
+        StarExpression(exclude=["station_number", "filename"]),
+    )
+
+
+def read_daily_normal_csv(files):
+    return read_normal_csv(files, daily_normal_column_names(), r"nml_amd_d_(\w+)\.csv$")
+
+
+def read_monthly_normal_csv(files):
+    return read_normal_csv(
+        files, monthly_normal_column_names(), r"nml_amd_m_(\w+)\.csv$"
+    )
+
+
+def read_wbgt_csv(files):
+    # 地点番号と年はディレクトリ名（point=/year=）から取り出す
+    return duckdb.read_csv(
+        [str(x) for x in files],
+        filename=True,
+        hive_partitioning=True,
+        hive_types={"point": "VARCHAR", "year": "INTEGER", "month": "INTEGER"},
+    ).select(
+        ColumnExpression("point").alias("station_number"),
+        "year",
+        "Date",
+        "WBGT",
+        SQLExpression(r"regexp_extract(filename, '[^/\\]+$')").alias("filename"),
+    )
+
+
+def read_station_history_csv(files):
+    return duckdb.read_csv(str(files[0]), normalize_names=True)
+
+
+def read_station_latest_csv(files):
+    return duckdb.read_csv(str(files[0]))
+
+
+# データセット名 -> (元ファイルの一覧, CSVの読み込み, 分けるときの列)
+# 元ファイルの一覧は単位ごとにまとめ、列を指定した場合は単位ごとのParquetに
+# hive partitioningで保存する。単位は列の値を"/"でつないだ文字列（例: "11001/2024"）
+staged_datasets = {
+    "daily_normal": (
+        list_daily_normal_sources,
+        read_daily_normal_csv,
+        ["station_number"],
+    ),
+    "monthly_normal": (
+        list_monthly_normal_sources,
+        read_monthly_normal_csv,
+        ["station_number"],
+    ),
+    "wbgt": (list_wbgt_sources, read_wbgt_csv, ["station_number", "year"]),
+    "station_history": (list_station_history_sources, read_station_history_csv, []),
+    "station_latest": (list_station_latest_sources, read_station_latest_csv, []),
+}
+
+# 分けるときの列の型（hive partitioningで読むときに指定する）
+partition_types = {"station_number": "VARCHAR", "year": "INTEGER"}
+
+
+def read_staging_manifest():
+    if not staging_manifest_path.is_file():
+        return {"files": {}, "datasets": {}}
+
+    with staging_manifest_path.open(encoding="utf-8") as f:
+        return json.load(f)
+
+
+def write_staging_manifest(manifest):
+    staging_dir.mkdir(parents=True, exist_ok=True)
+    tmp = staging_manifest_path.with_name(
+        f"{staging_manifest_path.name}.{os.getpid()}.tmp"
+    )
+    with tmp.open("w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(tmp, staging_manifest_path)
+
+
+def hash_file(path, file_hashes):
+    # サイズと更新時刻が同じなら前回のハッシュを使い回す
+    stat = path.stat()
+    key = path.relative_to(raw_dir).as_posix()
+    cached = file_hashes.get(key)
+    if (
+        cached is not None
+        and cached["size"] == stat.st_size
+        and cached["mtime_ns"] == stat.st_mtime_ns
+    ):
+        return cached["sha256"]
+
+    sha256 = hashlib.sha256()
+    with path.open("rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            sha256.update(chunk)
+
+    file_hashes[key] = {
+        "size": stat.st_size,
+        "mtime_ns": stat.st_mtime_ns,
+        "sha256": sha256.hexdigest(),
+    }
+    return file_hashes[key]["sha256"]
+
+
+def hash_sources(files, file_hashes):
+    sha256 = hashlib.sha256()
+    for path in files:
+        sha256.update(path.name.encode("utf-8"))
+        sha256.update(hash_file(path, file_hashes).encode("ascii"))
+    return sha256.hexdigest()
+
+
+def staged_path(name, unit):
+    partition_by = staged_datasets[name][2]
+    if not partition_by:
+        return staging_dir.joinpath(f"{name}.parquet")
+    return staging_dir.joinpath(
+        name, *(f"{k}={v}" for k, v in zip(partition_by, unit.split("/")))
+    )
+
+
+# ステージング済みのParquetを最新の状態にし、単位ごとの元ファイルのキーを返す
+def refresh(name):
+    list_sources, read_sources, partition_by = staged_datasets[name]
+    sources = list_sources()
+
+    manifest = read_staging_manifest()
+    file_hashes = manifest["files"]
+    staged = manifest["datasets"].setdefault(name, {})
+
+    keys = {unit: hash_sources(files, file_hashes) for unit, files in sources.items()}
+
+    stale = [
+        unit
+        for unit in sources
+        if staged.get(unit) != keys[unit] or not staged_path(name, unit).exists()
+    ]
+    removed = [unit for unit in staged if unit not in sources]
+
+    for unit in removed:
+        shutil.rmtree(staged_path(name, unit), ignore_errors=True)
+        del staged[unit]
+
+    if stale:
+        staging_dir.mkdir(parents=True, exist_ok=True)
+        relation = read_sources([x for unit in stale for x in sources[unit]])
+
+        if not partition_by:
+            relation.to_parquet(str(staged_path(name, None)))
+        else:
+            for unit in stale:
+                shutil.rmtree(staged_path(name, unit), ignore_errors=True)
+            # 変換が必要な単位をまとめて1回のスキャンで書き出す
+            relation.to_parquet(
+                str(staging_dir.joinpath(name)),
+                partition_by=partition_by,
+                write_partition_columns=True,
+                append=True,
+            )
+
+        for unit in stale:
+            staged[unit] = keys[unit]
+
+    # 別プロセスで同時に他のデータセットを更新していても、その記録を消さないよう
+    # 書き込む直前に読み直し、このデータセットの分だけ反映する
+    latest = read_staging_manifest()
+    latest["datasets"][name] = staged
+    latest["files"].update(file_hashes)
+    write_staging_manifest(latest)
+
+    return keys
+
+
+# stationsを指定した場合は、その観測所のParquetだけを読み込む
+# 分けるときの列はhive partitioningで列として読めるので、年などで絞り込むと
+# 範囲外のParquetは開かれない
+def load(name, stations=None):
+    if refresh_on_load:
+        refresh(name)
+
+    partition_by = staged_datasets[name][2]
+    if not partition_by:
+        return duckdb.read_parquet(str(staged_path(name, None)))
+
+    # 観測所の下の階層（年など）はワイルドカードで読む
+    pattern = ["*"] * (len(partition_by) - 1) + ["*.parquet"]
+    all_paths = [str(staging_dir.joinpath(name, "*", *pattern))]
+    if stations is None:
+        paths = all_paths
+    else:
+        staged = {x.split("/")[0] for x in read_staging_manifest()["datasets"][name]}
+        paths = [
+            str(staging_dir.joinpath(name, f"station_number={x}", *pattern))
+            for x in stations
+            if x in staged
+        ]
+
+    # ディレクトリ名の値は型を推定させると観測所番号が整数になるので、元の列と同じ型に
+    # 固定する。hive_typesはPythonのread_parquet()では指定できないのでSQLで読む
+    hive_types = ", ".join(f"'{x}': '{partition_types[x]}'" for x in partition_by)
+    relation = duckdb.sql(
+        "SELECT * FROM read_parquet("
+        f"$paths, hive_partitioning = true, hive_types = {{{hive_types}}})",
+        params={"paths": paths or all_paths},
+    )
+    # 指定した観測所の元ファイルがすべて消えている場合、read_parquet()は空のリストを
+    # 受け付けないので、全観測所から列だけを読んだ空のリレーションを返す
+    return relation if paths else relation.limit(0)
+
+
+def in_years(unit, years):
+    # 単位の2番目の値（年）が範囲内か。年で分けていない単位は常に含める
+    _, *rest = unit.split("/")
+    return years is None or not rest or years[0] <= int(rest[0]) <= years[1]
+
+
+# 元ファイルの一覧（段階の入力の更新時刻の確認用）
+def source_files(name, years=None):
+    sources = staged_datasets[name][0]()
+    return [
+        x for unit, files in sources.items() if in_years(unit, years) for x in files
+    ]
+
+
+# 観測所・年などの単位ごとのキーを観測所ごとのキーにまとめる
+# yearsを指定した場合は、その範囲（両端を含む）の年の単位だけを含める
+# optionsは集計の設定で、変わると全観測所のキーが変わる
+def station_keys(keys, years=None, options=None):
+    units = {}
+    for unit, key in sorted(keys.items()):
+        if in_years(unit, years):
+            units.setdefault(unit.split("/")[0], []).append((unit, key))
+
+    salt = json.dumps(options, sort_keys=True)
+    return {
+        station_number: hashlib.sha256(
+            json.dumps([salt, x]).encode("utf-8")
+        ).hexdigest()
+        for station_number, x in units.items()
+    }
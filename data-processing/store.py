@@ -0,0 +1,373 @@
+import argparse
+import functools
+import os
+import random
+import time
+from pathlib import Path
+
+import duckdb
+
+from aggregates import json_entries
+
+# 処理済みのJSONを型付きのテーブルにして1つの.duckdbファイルに保存し、
+# 観測所・系列・順位・範囲の検索をPythonから呼び出せるようにする
+# テーブルは観測所番号・月・日の順に並べて書き込むので、
+# 観測所番号での絞り込みでは各行グループの最小値・最大値（ゾーンマップ）で読み飛ばせる
+
+processed_dir = Path(
+    os.environ.get("JCD_DATA_DIR", Path(__file__).parents[1].joinpath("data"))
+).joinpath("processed")
+store_path = processed_dir.joinpath("climate.duckdb")
+
+NORMAL_ELEMENTS = ["temperature", "precipitation", "sunshine_duration"]
+WBGT_STATS = ["min", "max", "avg"]
+
+# 日別の要素 -> (テーブル, 列)
+DAILY_ELEMENTS = {
+    **{x: ("daily_normal", x) for x in NORMAL_ELEMENTS},
+    **{f"wbgt_{x}": ("daily_wbgt", x) for x in WBGT_STATS},
+}
+# 月別・年間の要素 -> (テーブル, 列)
+MONTHLY_ELEMENTS = {
+    **{x: ("monthly_yearly_normal", x) for x in NORMAL_ELEMENTS},
+    "wbgt": ("monthly_yearly_wbgt", "wbgt"),
+}
+
+STATION_COLUMNS = [
+    "station_number",
+    "station_name",
+    "latitude",
+    "longitude",
+    "altitude",
+    "prefecture_subprefecture",
+    "long_name",
+    "address",
+]
+
+
+def table_queries():
+    normal_values = ", ".join(
+        f"first(value) FILTER (element = '{x}') AS {x}" for x in NORMAL_ELEMENTS
+    )
+    wbgt_daily = ", ".join(f"(w.value->>'{x}')::DOUBLE AS {x}" for x in WBGT_STATS)
+
+    # month = 0 は年間の値（aggregates.pyと同じ）
+    return {
+        "station_index": f"""
+            SELECT
+                j.key AS station_number,
+                j.value->>'station_name' AS station_name,
+                (j.value->>'latitude')::DOUBLE AS latitude,
+                (j.value->>'longitude')::DOUBLE AS longitude,
+                (j.value->>'altitude')::INTEGER AS altitude,
+                j.value->>'prefecture_subprefecture' AS prefecture_subprefecture,
+                j.value->>'long_name' AS long_name,
+                j.value->>'address' AS address
+            FROM {json_entries("station_index")}
+            ORDER BY station_number
+        """,
+        # 要素・月ごとの配列を展開してから、日ごとに要素を列に並べる
+        "daily_normal": f"""
+            WITH days AS (
+                SELECT
+                    j.key AS station_number,
+                    e.key AS element,
+                    m.key::TINYINT AS month,
+                    m.value::DOUBLE[] AS "values"
+                FROM {json_entries("daily_normal")},
+                    json_each(j.value) AS e,
+                    json_each(e.value) AS m
+            ),
+            v AS (
+                SELECT
+                    station_number,
+                    element,
+                    month,
+                    unnest(range(1, len("values") + 1))::TINYINT AS day,
+                    unnest("values") AS value
+                FROM days
+            )
+            SELECT station_number, month, day, {normal_values}
+            FROM v
+            WHERE day <= day(last_day(make_date(2000, month, 1)))
+            GROUP BY station_number, month, day
+            HAVING coalesce({", ".join(NORMAL_ELEMENTS)}) IS NOT NULL
+            ORDER BY station_number, month, day
+        """,
+        "monthly_yearly_normal": f"""
+            WITH months AS (
+                SELECT j.key AS station_number, e.key AS element, e.value::DOUBLE[] AS "values"
+                FROM {json_entries("monthly_yearly_normal")}, json_each(j.value->'monthly') AS e
+            ),
+            v AS (
+                SELECT j.key AS station_number, e.key AS element, 0::TINYINT AS month,
+                    e.value::DOUBLE AS value
+                FROM {json_entries("monthly_yearly_normal")}, json_each(j.value->'yearly') AS e
+                UNION ALL
+                SELECT
+                    station_number,
+                    element,
+                    unnest(range(1, len("values") + 1))::TINYINT,
+                    unnest("values")
+                FROM months
+            )
+            SELECT station_number, month, {normal_values}
+            FROM v
+            GROUP BY station_number, month
+            HAVING coalesce({", ".join(NORMAL_ELEMENTS)}) IS NOT NULL
+            ORDER BY station_number, month
+        """,
+        "daily_wbgt": f"""
+            SELECT
+                j.key AS station_number,
+                split_part(w.key, '/', 1)::TINYINT AS month,
+                split_part(w.key, '/', 2)::TINYINT AS day,
+                {wbgt_daily}
+            FROM {json_entries("daily_wbgt")}, json_each(j.value) AS w
+            ORDER BY station_number, month, day
+        """,
+        "monthly_yearly_wbgt": f"""
+            SELECT j.key AS station_number, 0::TINYINT AS month,
+                (j.value->>'yearly')::DOUBLE AS wbgt
+            FROM {json_entries("monthly_yearly_wbgt")}
+            UNION ALL
+            SELECT j.key, w.key::TINYINT, w.value::DOUBLE
+            FROM {json_entries("monthly_yearly_wbgt")}, json_each(j.value->'monthly') AS w
+            ORDER BY station_number, month
+        """,
+    }
+
+
+# 1観測所・1か月の値を引く検索が多いので、そのキーに一意のインデックスを張る
+table_keys = {
+    "station_index": "station_number",
+    "monthly_yearly_normal": "station_number, month",
+    "monthly_yearly_wbgt": "station_number, month",
+}
+
+
+def build_store(path=None):
+    path = Path(path or store_path)
+    temporary_path = path.with_name(f"{path.name}.tmp")
+    temporary_path.unlink(missing_ok=True)
+
+    # 書き込み中のファイルを読まれないよう、一時ファイルに作ってから置き換える
+    with duckdb.connect(temporary_path) as con:
+        for name, query in table_queries().items():
+            con.execute(f"CREATE TABLE {name} AS {query}")
+            if name in table_keys:
+                con.execute(
+                    f"CREATE UNIQUE INDEX {name}_key ON {name} ({table_keys[name]})"
+                )
+        con.execute("CHECKPOINT")
+
+    os.replace(temporary_path, path)
+    return path
+
+
+class ClimateStore:
+    # 同じ引数の検索結果はLRUキャッシュから返す
+    # 接続はスレッド間で共有できないので、スレッドごとにClimateStoreを作る
+    def __init__(self, path=None, cache_size=4096):
+        self.connection = duckdb.connect(path or store_path, read_only=True)
+        self.statements = self._statements()
+
+        cached = functools.lru_cache(maxsize=cache_size)
+        self._fetch_station = cached(self._fetch_station)
+        self._fetch_station_index = cached(self._fetch_station_index)
+        self._fetch_daily_series = cached(self._fetch_daily_series)
+        self._fetch_monthly_series = cached(self._fetch_monthly_series)
+        self._fetch_top_n = cached(self._fetch_top_n)
+        self._fetch_stations_in_bbox = cached(self._fetch_stations_in_bbox)
+        self._cached = [
+            self._fetch_station,
+            self._fetch_station_index,
+            self._fetch_daily_series,
+            self._fetch_monthly_series,
+            self._fetch_top_n,
+            self._fetch_stations_in_bbox,
+        ]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.connection.close()
+
+    def _statements(self):
+        # 列名はパラメーターにできないので、要素ごとに文を用意する
+        statements = {
+            "station": f"""
+                SELECT {", ".join(STATION_COLUMNS)} FROM station_index
+                WHERE station_number = $1
+            """,
+            "station_index": f"""
+                SELECT {", ".join(STATION_COLUMNS)} FROM station_index
+                ORDER BY station_number
+            """,
+            "bbox": """
+                SELECT station_number, station_name, latitude, longitude
+                FROM station_index
+                WHERE latitude BETWEEN $1 AND $3 AND longitude BETWEEN $2 AND $4
+                ORDER BY station_number
+            """,
+        }
+        for element, (table, column) in DAILY_ELEMENTS.items():
+            statements[f"daily_{element}"] = f"""
+                SELECT month, day, "{column}" FROM {table}
+                WHERE station_number = $1
+                ORDER BY month, day
+            """
+        for element, (table, column) in MONTHLY_ELEMENTS.items():
+            statements[f"monthly_{element}"] = f"""
+                SELECT month, "{column}" FROM {table}
+                WHERE station_number = $1
+                ORDER BY month
+            """
+            for order in ("DESC", "ASC"):
+                statements[f"top_{element}_{order.lower()}"] = f"""
+                    SELECT t.station_number, s.station_name, t."{column}"
+                    FROM {table} AS t
+                    LEFT JOIN station_index AS s USING (station_number)
+                    WHERE t.month = $1 AND t."{column}" IS NOT NULL
+                    ORDER BY t."{column}" {order}, t.station_number
+                    LIMIT $2
+                """
+
+        return statements
+
+    def _execute(self, name, *args):
+        # 値はSQLに埋め込まず、パラメーターとして渡す
+        # （DuckDBのEXECUTEはパラメーターを受け付けないので、文を直接実行する）
+        return self.connection.execute(self.statements[name], args).fetchall()
+
+    def _fetch_station(self, station_number):
+        rows = self._execute("station", station_number)
+        return rows[0] if rows else None
+
+    def _fetch_station_index(self):
+        return tuple(self._execute("station_index"))
+
+    def _fetch_daily_series(self, station_number, element):
+        return tuple(self._execute(f"daily_{element}", station_number))
+
+    def _fetch_monthly_series(self, station_number, element):
+        return tuple(self._execute(f"monthly_{element}", station_number))
+
+    def _fetch_top_n(self, element, month, n, ascending):
+        order = "asc" if ascending else "desc"
+        return tuple(self._execute(f"top_{element}_{order}", int(month), int(n)))
+
+    def _fetch_stations_in_bbox(self, south, west, north, east):
+        return tuple(
+            self._execute("bbox", *(float(x) for x in (south, west, north, east)))
+        )
+
+    def get_station(self, station_number):
+        row = self._fetch_station(station_number)
+        return dict(zip(STATION_COLUMNS, row)) if row else None
+
+    def get_station_index(self):
+        # create_station_index_object()と同じく、観測所番号 -> 観測所の情報
+        return {
+            row[0]: dict(zip(STATION_COLUMNS[1:], row[1:]))
+            for row in self._fetch_station_index()
+        }
+
+    def get_daily_series(self, station_number, element):
+        # [(月, 日, 値), ...]。WBGTはwbgt_min / wbgt_max / wbgt_avg
+        if element not in DAILY_ELEMENTS:
+            raise ValueError(f"Unknown daily element: {element}")
+        return list(self._fetch_daily_series(station_number, element))
+
+    def get_monthly_series(self, station_number, element):
+        # [(月, 値), ...]。month = 0 は年間の値
+        if element not in MONTHLY_ELEMENTS:
+            raise ValueError(f"Unknown monthly element: {element}")
+        return list(self._fetch_monthly_series(station_number, element))
+
+    def top_n(self, element, month=0, n=10, ascending=False):
+        # [(観測所番号, 観測所名, 値), ...]。month = 0 は年間の値
+        if element not in MONTHLY_ELEMENTS:
+            raise ValueError(f"Unknown monthly element: {element}")
+        return list(self._fetch_top_n(element, month, n, ascending))
+
+    def stations_in_bbox(self, south, west, north, east):
+        # [(観測所番号, 観測所名, 緯度, 経度), ...]
+        return list(self._fetch_stations_in_bbox(south, west, north, east))
+
+    def cache_info(self):
+        return {x.__name__: x.cache_info() for x in self._cached}
+
+    def clear_cache(self):
+        for x in self._cached:
+            x.cache_clear()
+
+
+def run_benchmark(path=None, query_count=10000, seed=0):
+    rng = random.Random(seed)
+    with ClimateStore(path) as store:
+        station_numbers = [
+            x
+            for (x,) in store.connection.execute(
+                "SELECT station_number FROM station_index"
+            ).fetchall()
+        ]
+
+    # 観測所は偏りを持たせて選び、一部の観測所への検索が繰り返される状況を再現する
+    hot = station_numbers[: max(1, len(station_numbers) // 10)]
+    queries = []
+    for _ in range(query_count):
+        station_number = rng.choice(hot if rng.random() < 0.8 else station_numbers)
+        kind = rng.choice(["station", "daily", "top_n", "bbox"])
+        if kind == "station":
+            queries.append(("get_station", (station_number,)))
+        elif kind == "daily":
+            element = rng.choice(list(DAILY_ELEMENTS))
+            queries.append(("get_daily_series", (station_number, element)))
+        elif kind == "top_n":
+            element = rng.choice(list(MONTHLY_ELEMENTS))
+            queries.append(("top_n", (element, rng.randint(0, 12), 10)))
+        else:
+            south = round(rng.uniform(24, 44), 0)
+            west = round(rng.uniform(123, 144), 0)
+            queries.append(("stations_in_bbox", (south, west, south + 1, west + 1)))
+
+    for cache_size in (0, 4096):
+        with ClimateStore(path, cache_size=cache_size) as store:
+            start = time.perf_counter()
+            for method, args in queries:
+                getattr(store, method)(*args)
+            elapsed = time.perf_counter() - start
+
+            hits = sum(x.hits for x in store.cache_info().values())
+            print(
+                f"cache_size={cache_size}: {elapsed / query_count * 1e6:.0f} us "
+                f"per query, {hits / query_count:.0%} cache hits"
+            )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Build processed/climate.duckdb or benchmark its query API"
+    )
+    parser.add_argument("--path", type=Path, help="default: processed/climate.duckdb")
+    parser.add_argument(
+        "--benchmark",
+        action="store_true",
+        help="run random lookups with and without the result cache",
+    )
+    parser.add_argument("--queries", type=int, default=10000)
+    args = parser.parse_args()
+
+    if args.benchmark:
+        run_benchmark(args.path, args.queries)
+    else:
+        build_store(args.path)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,406 @@
+import argparse
+import functools
+import json
+import math
+import multiprocessing
+import os
+import shutil
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import numpy as np
+
+import spatial
+
+# 観測所の値から逆距離加重（IDW）で格子状の気候分布図を作る
+# 格子は日本周辺の緯度経度の範囲を一定間隔で区切ったもので、タイルごとに
+# 近傍の観測所だけを候補にしてNumPyでまとめて計算する。
+
+processed_dir = Path(
+    os.environ.get("JCD_DATA_DIR", Path(__file__).parents[1].joinpath("data"))
+).joinpath("processed")
+surface_dir = processed_dir.joinpath("surface")
+
+# 格子の範囲（緯度・経度）
+BOUNDS = (24.0, 46.0, 122.0, 146.0)
+# 経度方向の間隔を決めるときの基準の緯度
+REFERENCE_LATITUDE = 36.0
+KM_PER_DEGREE = math.pi * spatial.EARTH_RADIUS_KM / 180
+
+TILE_SIZE = 256
+# 近傍の候補を求める区画の大きさ（格子点数）
+BLOCK_SIZE = 16
+NODATA = -(2**15)
+
+# 指標 -> (元の出力, 月, 保存時の倍率)
+# 年間降水量は10倍するとint16の範囲を超えるので1mm単位にする
+surface_metrics = {
+    "temperature": ("monthly_yearly_normal", range(1, 13), 10),
+    "precipitation": ("monthly_yearly_normal", range(1, 13), 1),
+    "sunshine_duration": ("monthly_yearly_normal", range(1, 13), 10),
+    "wbgt": ("monthly_yearly_wbgt", range(4, 11), 10),
+}
+
+# 気温減率（℃/km）で標高補正する指標
+LAPSE_RATE_METRICS = ["temperature", "wbgt"]
+
+
+def grid_shape(resolution_km):
+    south, north, west, east = BOUNDS
+    lat_step = resolution_km / KM_PER_DEGREE
+    lon_step = lat_step / math.cos(math.radians(REFERENCE_LATITUDE))
+    rows = math.ceil((north - south) / lat_step)
+    columns = math.ceil((east - west) / lon_step)
+    return lat_step, lon_step, rows, columns
+
+
+def layer_names(metric):
+    return ["yearly"] + [str(x) for x in surface_metrics[metric][1]]
+
+
+def load_station_values(metric):
+    name, months, _ = surface_metrics[metric]
+    with open(processed_dir.joinpath(f"{name}.json"), encoding="utf-8") as f:
+        data = json.load(f)
+
+    values = {}
+    for station_number, payload in data.items():
+        if metric == "wbgt":
+            yearly = payload["yearly"]
+            monthly = [payload["monthly"].get(str(x)) for x in months]
+        else:
+            yearly = payload["yearly"][metric]
+            monthly = payload["monthly"][metric] or [None] * 12
+
+        # 年間の値がない観測所は使わない。月の欠測はNaNにして重みから外す
+        if yearly is not None:
+            values[station_number] = [yearly] + monthly
+
+    return values
+
+
+# 指標ごとの観測所の配列と空間インデックス
+def build_inputs(metric, station_index, lapse_rate=None):
+    values = load_station_values(metric)
+    stations = {
+        k: (v["latitude"], v["longitude"])
+        for k, v in station_index.items()
+        if k in values and v["latitude"] is not None and v["longitude"] is not None
+    }
+
+    index = spatial.SpatialIndex(stations)
+    matrix = np.array(
+        [values[x] for x in index.station_numbers], dtype=np.float64
+    )  # None -> NaN
+    altitude = np.array(
+        [station_index[x]["altitude"] or 0 for x in index.station_numbers],
+        dtype=np.float64,
+    )
+
+    # 海面の値に換算してから補間する
+    if lapse_rate and metric in LAPSE_RATE_METRICS:
+        matrix = matrix + lapse_rate * altitude[:, None] / 1000
+
+    return {
+        "index": index,
+        "points": np.array(index.points, dtype=np.float64),
+        "values": matrix,
+    }
+
+
+def chord_to_km(chord):
+    return 2 * spatial.EARTH_RADIUS_KM * np.arcsin(np.minimum(chord / 2, 1.0))
+
+
+def unit_vectors(latitudes, longitudes):
+    phi = np.radians(latitudes)
+    lam = np.radians(longitudes)
+    return np.stack(
+        [np.cos(phi) * np.cos(lam), np.cos(phi) * np.sin(lam), np.sin(phi)], axis=-1
+    )
+
+
+def interpolate_block(
+    inputs,
+    latitudes,
+    longitudes,
+    k=8,
+    power=2.0,
+    max_distance_km=50.0,
+):
+    # latitudes, longitudes: 区画内の格子点（1次元）
+    index = inputs["index"]
+    cells = unit_vectors(latitudes, longitudes)
+    layer_count = inputs["values"].shape[1]
+    result = np.full((len(cells), layer_count), np.nan)
+
+    # 区画の中心からk番目に近い観測所までの距離 + 区画の半径の2倍以内に、
+    # 区画内のどの格子点にとってもk個の近傍が含まれる
+    center_lat = float(np.mean(latitudes))
+    center_lon = float(np.mean(longitudes))
+    radius = max(
+        spatial.haversine(center_lat, center_lon, lat, lon)
+        for lat, lon in (
+            (latitudes.min(), longitudes.min()),
+            (latitudes.min(), longitudes.max()),
+            (latitudes.max(), longitudes.min()),
+            (latitudes.max(), longitudes.max()),
+        )
+    )
+    nearest = index.nearest(center_lat, center_lon, k)
+    if not nearest or nearest[0][1] > max_distance_km + radius:
+        return result
+
+    candidates = [
+        index.positions[x]
+        for x, _ in index.within(center_lat, center_lon, nearest[-1][1] + 2 * radius)
+    ]
+    points = inputs["points"][candidates]
+    values = inputs["values"][candidates]
+
+    chord = np.sqrt(((cells[:, None, :] - points[None, :, :]) ** 2).sum(axis=-1))
+    distance = chord_to_km(chord)
+
+    if len(candidates) > k:
+        neighbors = np.argpartition(distance, k - 1, axis=1)[:, :k]
+        distance = np.take_along_axis(distance, neighbors, axis=1)
+    else:
+        neighbors = np.broadcast_to(np.arange(len(candidates)), distance.shape)
+
+    # 観測所と同じ位置の格子点はその値になるよう、距離の下限を設ける
+    weights = 1.0 / np.maximum(distance, 1e-3) ** power
+    neighbor_values = values[neighbors]  # (格子点, k, 層)
+    mask = ~np.isnan(neighbor_values)
+    weights = weights[:, :, None] * mask
+
+    total = weights.sum(axis=1)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        interpolated = (weights * np.nan_to_num(neighbor_values)).sum(axis=1) / total
+
+    # 最寄りの観測所が遠い格子点（海上など）は値なし
+    covered = distance.min(axis=1) <= max_distance_km
+    result[covered] = interpolated[covered]
+    return result
+
+
+def encode_tile(values, scale):
+    encoded = np.clip(np.round(values * scale), NODATA + 1, 2**15 - 1)
+    return np.where(np.isnan(encoded), NODATA, encoded).astype("<i2")
+
+
+# ワーカープロセスで使う入力（initializerで1回だけ受け取る）
+worker_inputs = None
+
+
+def init_worker(inputs):
+    global worker_inputs
+    worker_inputs = inputs
+
+
+def compute_tile(tile, resolution_km, options):
+    row, column = tile
+    lat_step, lon_step, rows, columns = grid_shape(resolution_km)
+    south, _, west, _ = BOUNDS
+
+    # 行は北から南の順にする（画像と同じ向き）
+    row_indexes = np.arange(row * TILE_SIZE, min((row + 1) * TILE_SIZE, rows))
+    column_indexes = np.arange(
+        column * TILE_SIZE, min((column + 1) * TILE_SIZE, columns)
+    )
+    latitudes = south + (rows - row_indexes - 0.5) * lat_step
+    longitudes = west + (column_indexes + 0.5) * lon_step
+    grid_lat, grid_lon = np.meshgrid(latitudes, longitudes, indexing="ij")
+
+    elevation = options.get("elevation")
+    tiles = {}
+    for metric, inputs in worker_inputs.items():
+        # 近傍の候補を絞り込めるよう、タイルをさらに小さな区画に分けて補間する
+        values = np.empty((grid_lat.size, inputs["values"].shape[1]))
+        cell_numbers = np.arange(grid_lat.size).reshape(grid_lat.shape)
+        for i in range(0, grid_lat.shape[0], BLOCK_SIZE):
+            for j in range(0, grid_lat.shape[1], BLOCK_SIZE):
+                block = cell_numbers[i : i + BLOCK_SIZE, j : j + BLOCK_SIZE].ravel()
+                values[block] = interpolate_block(
+                    inputs,
+                    grid_lat.ravel()[block],
+                    grid_lon.ravel()[block],
+                    k=options["k"],
+                    power=options["power"],
+                    max_distance_km=options["max_distance_km"],
+                )
+
+        if np.isnan(values).all():
+            continue
+
+        # 格子の標高が与えられた場合は、海面の値からその標高の値に戻す
+        if (
+            options["lapse_rate"]
+            and metric in LAPSE_RATE_METRICS
+            and elevation is not None
+        ):
+            cell_elevation = elevation[
+                row_indexes[0] : row_indexes[-1] + 1,
+                column_indexes[0] : column_indexes[-1] + 1,
+            ].ravel()
+            values = values - options["lapse_rate"] * cell_elevation[:, None] / 1000
+
+        shape = (len(row_indexes), len(column_indexes), values.shape[1])
+        tiles[metric] = encode_tile(
+            values.reshape(shape).transpose(2, 0, 1),
+            surface_metrics[metric][2],
+        )
+
+    return tile, tiles
+
+
+def write_surfaces(
+    resolution_km=5.0,
+    k=8,
+    power=2.0,
+    max_distance_km=50.0,
+    lapse_rate=None,
+    elevation_path=None,
+    workers=1,
+):
+    with open(processed_dir.joinpath("station_index.json"), encoding="utf-8") as f:
+        station_index = json.load(f)
+
+    inputs = {
+        metric: build_inputs(metric, station_index, lapse_rate)
+        for metric in surface_metrics
+    }
+
+    lat_step, lon_step, rows, columns = grid_shape(resolution_km)
+    elevation = None
+    if elevation_path is not None:
+        elevation = np.load(elevation_path)
+        if elevation.shape != (rows, columns):
+            raise ValueError(
+                f"Elevation grid must be {rows}x{columns}, got {elevation.shape}"
+            )
+
+    options = {
+        "k": k,
+        "power": power,
+        "max_distance_km": max_distance_km,
+        "lapse_rate": lapse_rate,
+        "elevation": elevation,
+    }
+    tiles = [
+        (row, column)
+        for row in range(math.ceil(rows / TILE_SIZE))
+        for column in range(math.ceil(columns / TILE_SIZE))
+    ]
+
+    shutil.rmtree(surface_dir, ignore_errors=True)
+    for metric in surface_metrics:
+        surface_dir.joinpath(metric).mkdir(parents=True)
+
+    compute = functools.partial(
+        compute_tile, resolution_km=resolution_km, options=options
+    )
+    if workers <= 1:
+        init_worker(inputs)
+        results = map(compute, tiles)
+    else:
+        executor = ProcessPoolExecutor(
+            max_workers=workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=init_worker,
+            initargs=(inputs,),
+        )
+        results = executor.map(compute, tiles)
+
+    written = {metric: [] for metric in surface_metrics}
+    try:
+        for (row, column), metric_tiles in results:
+            for metric, data in metric_tiles.items():
+                np.savez_compressed(
+                    surface_dir.joinpath(metric, f"{row}_{column}.npz"), values=data
+                )
+                written[metric].append([row, column])
+    finally:
+        if workers > 1:
+            executor.shutdown()
+
+    south, north, west, east = BOUNDS
+    index = {
+        "bounds": {"south": south, "north": north, "west": west, "east": east},
+        "resolution_km": resolution_km,
+        "lat_step": lat_step,
+        "lon_step": lon_step,
+        "rows": rows,
+        "columns": columns,
+        "tile_size": TILE_SIZE,
+        "nodata": NODATA,
+        "lapse_rate": lapse_rate,
+        "sea_level": bool(lapse_rate) and elevation is None,
+        "metrics": {
+            metric: {
+                "layers": layer_names(metric),
+                "scale": surface_metrics[metric][2],
+                "tiles": written[metric],
+            }
+            for metric in surface_metrics
+        },
+    }
+    with open(surface_dir.joinpath("index.json"), "w", encoding="utf-8") as f:
+        json.dump(index, f, indent=2)
+
+    return surface_dir
+
+
+def read_surface_tile(metric, row, column):
+    with open(surface_dir.joinpath("index.json"), encoding="utf-8") as f:
+        index = json.load(f)
+
+    path = surface_dir.joinpath(metric, f"{row}_{column}.npz")
+    if not path.is_file():
+        return None
+
+    data = np.load(path)["values"]
+    values = np.where(
+        data == index["nodata"], np.nan, data / index["metrics"][metric]["scale"]
+    )
+    return dict(zip(index["metrics"][metric]["layers"], values))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Write IDW-interpolated climate surfaces as raster tiles"
+    )
+    parser.add_argument("--resolution-km", type=float, default=5.0)
+    parser.add_argument("-k", type=int, default=8, help="neighbours per cell")
+    parser.add_argument("--power", type=float, default=2.0)
+    parser.add_argument(
+        "--max-distance-km",
+        type=float,
+        default=50.0,
+        help="cells farther than this from any station are left empty",
+    )
+    parser.add_argument(
+        "--lapse-rate",
+        type=float,
+        help="reduce temperature and WBGT to sea level with this rate (°C/km)",
+    )
+    parser.add_argument(
+        "--elevation",
+        type=Path,
+        help="rows x columns .npy grid of cell altitudes (m) to re-apply the lapse rate",
+    )
+    parser.add_argument("--workers", type=int, default=1)
+    args = parser.parse_args()
+
+    write_surfaces(
+        resolution_km=args.resolution_km,
+        k=args.k,
+        power=args.power,
+        max_distance_km=args.max_distance_km,
+        lapse_rate=args.lapse_rate,
+        elevation_path=args.elevation,
+        workers=args.workers,
+    )
+
+
+if __name__ == "__main__":
+    main()
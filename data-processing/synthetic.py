@@ -0,0 +1,267 @@
+import argparse
+import calendar
+import math
+import random
+from pathlib import Path
+
+import wbgt_layout
+
+# 気象庁・環境省の元データと同じ形式の合成データを作る
+# 実データなしで処理時間を計測するためのもので、値そのものに意味はない
+
+# 平年値CSVに含まれる要素番号（main.pyが使う3要素とそれ以外）
+NORMAL_ELEMENT_NUMBERS = ["0500", "0600", "0700", "4000", "3500"]
+
+PREFECTURES = [
+    "宗谷",
+    "石狩",
+    "青森",
+    "宮城",
+    "東京",
+    "愛知",
+    "大阪",
+    "広島",
+    "福岡",
+    "沖縄",
+]
+
+AMDMASTER_COLUMNS = [
+    "Station_Number",
+    "Station_Name",
+    "Station_Name_of_Snow",
+    "Latitude_Precipitation",
+    "Longitude_Precipitation",
+    "Altitude_Precipitation",
+    "Latitude_Snow",
+    "Longitude_Snow",
+    "Altitude_Snow",
+    "Start_Date",
+    "End_Date",
+]
+
+
+def build_station_list(station_count):
+    # 観測所番号は5桁で、実データと同じく先頭2桁が地域を表す
+    return [str(11001 + i * 7 % 89999) for i in range(station_count)]
+
+
+def build_station_climate(rng):
+    latitude = rng.uniform(24.0, 45.5)
+    return {
+        "latitude": latitude,
+        "longitude": rng.uniform(123.0, 146.0),
+        "altitude": rng.randint(0, 1500),
+        # 年平均気温（℃）は緯度と標高でおおよそ決まる
+        "mean_temperature": 30.0 - 0.55 * latitude - rng.uniform(0.0, 4.0),
+        "annual_precipitation": rng.uniform(800.0, 4500.0),
+        "annual_sunshine": rng.uniform(1300.0, 2300.0),
+    }
+
+
+def seasonal(month, amplitude):
+    # 8月上旬が最も高くなる季節変化
+    return -amplitude * math.cos((month - 1.2) / 12 * 2 * math.pi)
+
+
+def normal_value(element_number, climate, month, days_in_month):
+    if element_number == "0500":
+        return climate["mean_temperature"] + seasonal(month, 10.0)
+    if element_number == "0600":
+        return climate["mean_temperature"] + seasonal(month, 10.0) + 4.0
+    if element_number == "0700":
+        return climate["mean_temperature"] + seasonal(month, 10.0) - 4.0
+    if element_number == "4000":
+        return climate["annual_precipitation"] / 365 * (1 + seasonal(month, -0.4))
+    return climate["annual_sunshine"] / 365 * (1 + seasonal(month, 0.2))
+
+
+def format_pair(value, remark=8):
+    # 値は10倍した整数、品質情報が0の場合は欠測
+    if value is None:
+        return "0,0"
+    return f"{round(value * 10)},{remark}"
+
+
+def write_daily_normal(path, station_number, climate, has_sunshine):
+    lines = []
+    for element_number in NORMAL_ELEMENT_NUMBERS:
+        missing = element_number == "3500" and not has_sunshine
+        for month in range(1, 13):
+            days_in_month = calendar.monthrange(2021, month)[1]
+            pairs = []
+            for day in range(1, 32):
+                if missing or day > days_in_month:
+                    pairs.append(format_pair(None))
+                    continue
+                value = normal_value(element_number, climate, month + day / 31, 1)
+                pairs.append(format_pair(value))
+            lines.append(
+                f"3,{station_number},{element_number},30,1991,2020,{month},"
+                + ",".join(pairs)
+            )
+
+    path.write_text("\n".join(lines) + "\n", encoding="utf-8")
+
+
+def write_monthly_normal(path, station_number, climate, has_sunshine):
+    lines = []
+    for element_number in NORMAL_ELEMENT_NUMBERS:
+        missing = element_number == "3500" and not has_sunshine
+        values = []
+        for month in range(1, 13):
+            days_in_month = calendar.monthrange(2021, month)[1]
+            value = normal_value(element_number, climate, month, days_in_month)
+            # 降水量と日照時間は月の合計
+            if element_number in ("4000", "3500"):
+                value *= days_in_month
+            values.append(None if missing else value)
+
+        if missing:
+            yearly = None
+        elif element_number in ("4000", "3500"):
+            yearly = sum(values)
+        else:
+            yearly = sum(values) / 12
+
+        pairs = [format_pair(x) for x in values] + [format_pair(yearly)]
+        lines.append(
+            f"3,{station_number},{element_number},30,1991,2020," + ",".join(pairs)
+        )
+
+    path.write_text("\n".join(lines) + "\n", encoding="utf-8")
+
+
+def build_wbgt_csv(point, year, month, base=None):
+    rng = random.Random(f"{point}-{year}-{month}")
+    if base is None:
+        base = rng.uniform(15.0, 22.0)
+
+    lines = ["Date,Time,WBGT"]
+    for day in range(1, calendar.monthrange(year, month)[1] + 1):
+        daily = base + seasonal(month + day / 31, 7.0) + rng.uniform(-2.0, 2.0)
+        for hour in range(1, 25):
+            # 14時頃に最も高くなる日変化
+            value = daily + 4.0 * math.cos((hour - 14) / 24 * 2 * math.pi)
+            lines.append(f"{year}/{month}/{day},{hour}:00,{value:.1f}")
+
+    return "\n".join(lines) + "\n"
+
+
+def write_station_indexes(station_dir, stations):
+    # 2行目は列の単位
+    history = [",".join(AMDMASTER_COLUMNS), ",,,deg,deg,m,deg,deg,m,,"]
+    latest = [
+        "都府県振興局,観測所番号,種類,観測所名,ｶﾀｶﾅ名,所在地,気象情報等に表記する名称"
+    ]
+
+    for i, (station_number, climate) in enumerate(stations):
+        latitude = f"{climate['latitude']:9.4f}"
+        longitude = f"{climate['longitude']:9.4f}"
+        altitude = f"{climate['altitude']:5d}"
+        blank = "         "
+        # 移設前の履歴行と現在の行。現在の行の一部は積雪計の列にだけ値が入る
+        history.append(
+            f"{station_number}, 旧{station_number} ,{blank},{latitude},{longitude},"
+            f"{altitude},{blank},{blank},{blank},1976-01-01,2000-12-31"
+        )
+        if i % 10 == 0:
+            history.append(
+                f"{station_number},{blank},雪{station_number},{blank},{blank},{blank},"
+                f"{latitude},{longitude},{altitude},2001-01-01,9999-12-31"
+            )
+        else:
+            history.append(
+                f"{station_number}, 観測所{station_number} ,{blank},{latitude},"
+                f"{longitude},{altitude},{blank},{blank},{blank},2001-01-01,9999-12-31"
+            )
+
+        prefecture = PREFECTURES[i % len(PREFECTURES)]
+        latest.append(
+            f"{prefecture},{station_number},四,観測所{station_number},ｶﾝｿｸｼﾖ,"
+            f"{prefecture}市{station_number},{prefecture}市観測所{station_number}"
+        )
+
+    station_dir.joinpath("amdmaster.index4.csv").write_text(
+        "\n".join(history) + "\n", encoding="utf-8"
+    )
+    station_dir.joinpath("ame_master_20250101.csv").write_text(
+        "\n".join(latest) + "\n", encoding="utf-8"
+    )
+
+
+def generate(
+    data_dir,
+    station_count,
+    wbgt_ratio=0.65,
+    start_year=2020,
+    end_year=2024,
+    seed=0,
+):
+    rng = random.Random(seed)
+    raw_dir = Path(data_dir).joinpath("raw")
+
+    daily_dir = raw_dir.joinpath("jma-normal", "daily")
+    monthly_dir = raw_dir.joinpath("jma-normal", "monthly")
+    station_dir = raw_dir.joinpath("jma-station")
+    wbgt_dir = raw_dir.joinpath("moe-wbgt")
+    for dir in (daily_dir, monthly_dir, station_dir, wbgt_dir):
+        dir.mkdir(parents=True, exist_ok=True)
+    Path(data_dir).joinpath("processed").mkdir(parents=True, exist_ok=True)
+
+    stations = [
+        (x, build_station_climate(rng)) for x in build_station_list(station_count)
+    ]
+
+    for i, (station_number, climate) in enumerate(stations):
+        # 日照時間を観測していない観測所も含める
+        has_sunshine = i % 3 != 0
+        write_daily_normal(
+            daily_dir.joinpath(f"nml_amd_d_{station_number}.csv"),
+            station_number,
+            climate,
+            has_sunshine,
+        )
+        write_monthly_normal(
+            monthly_dir.joinpath(f"nml_amd_m_{station_number}.csv"),
+            station_number,
+            climate,
+            has_sunshine,
+        )
+
+    write_station_indexes(station_dir, stations)
+
+    # WBGTの地点は観測所の一部（実データでは約840 / 1,300）
+    wbgt_count = round(station_count * wbgt_ratio)
+    for station_number, climate in stations[:wbgt_count]:
+        base = climate["mean_temperature"] + 2.0
+        for year in range(start_year, end_year + 1):
+            for month in range(4, 11):
+                path = wbgt_layout.raw_path(wbgt_dir, station_number, year, month)
+                path.parent.mkdir(parents=True, exist_ok=True)
+                path.write_text(build_wbgt_csv(station_number, year, month, base))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Write synthetic JMA/MOE raw data in the original formats"
+    )
+    parser.add_argument("data_dir", type=Path)
+    parser.add_argument("--stations", type=int, default=100)
+    parser.add_argument("--wbgt-ratio", type=float, default=0.65)
+    parser.add_argument("--start-year", type=int, default=2020)
+    parser.add_argument("--end-year", type=int, default=2024)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    generate(
+        args.data_dir,
+        args.stations,
+        wbgt_ratio=args.wbgt_ratio,
+        start_year=args.start_year,
+        end_year=args.end_year,
+        seed=args.seed,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+import argparse
+import contextlib
+import os
+import re
+from pathlib import Path
+
+# 環境省WBGTの元ファイルを point=/year=/month= のディレクトリに分けて置く
+# DuckDBのhive partitioningで地点・年・月を列として読め、
+# 年の範囲を指定したときに範囲外のファイルを開かずに済む
+
+moe_wbgt_dir = Path(
+    os.environ.get("JCD_DATA_DIR", Path(__file__).parents[1].joinpath("data"))
+).joinpath("raw", "moe-wbgt")
+
+FILE_PATTERN = re.compile(r"^final_wbgt_(\w+)_(\d{4})(\d{2})\.csv$")
+
+
+def file_name(point, year, month):
+    return f"final_wbgt_{point}_{year}{month:02d}.csv"
+
+
+def raw_path(wbgt_dir, point, year, month):
+    return Path(wbgt_dir).joinpath(
+        f"point={point}",
+        f"year={year}",
+        f"month={month}",
+        file_name(point, year, month),
+    )
+
+
+def list_files(wbgt_dir=moe_wbgt_dir):
+    return sorted(Path(wbgt_dir).glob("point=*/year=*/month=*/final_wbgt_*.csv"))
+
+
+# 以前の <地点>/final_wbgt_<地点>_<年月>.csv の配置を移動して変換する
+# 移動するだけなので中身は変わらず、変換済みのファイルはそのまま残る
+def convert_flat_layout(wbgt_dir=moe_wbgt_dir):
+    moved = 0
+    for path in sorted(Path(wbgt_dir).glob("*/final_wbgt_*.csv")):
+        match = FILE_PATTERN.match(path.name)
+        if match is None or path.parent.name.startswith("point="):
+            continue
+
+        point, year, month = match.group(1), int(match.group(2)), int(match.group(3))
+        destination = raw_path(wbgt_dir, point, year, month)
+        destination.parent.mkdir(parents=True, exist_ok=True)
+        os.replace(path, destination)
+        moved += 1
+
+    # 空になった地点のディレクトリを消す
+    for path in Path(wbgt_dir).glob("*"):
+        if path.is_dir() and not path.name.startswith("point="):
+            with contextlib.suppress(OSError):
+                path.rmdir()
+
+    return moved
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Move MOE WBGT files into the point=/year=/month= layout"
+    )
+    parser.add_argument("--dir", type=Path, default=moe_wbgt_dir)
+    args = parser.parse_args()
+
+    moved = convert_flat_layout(args.dir)
+    print(f"Moved {moved} files into {args.dir}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,17 +1,8 @@
-import _monthlyYearlyNormal from "../../../data/processed/monthly_yearly_normal.json";
-import _monthlyYearlyWbgt from "../../../data/processed/monthly_yearly_wbgt.json";
+import _aggregates from "../../../data/processed/aggregates.json";
 import _stationIndex from "../../../data/processed/station_index.json";
-import type {
-  MonthlyYearlyNormal,
-  MonthlyYearlyWbgt,
-  PageContext,
-  StationIndex,
-  Station,
-} from "./types";
+import type { Aggregates, PageContext, StationIndex, Station } from "./types";
 
-const monthlyYearlyNormal =
-  _monthlyYearlyNormal as unknown as MonthlyYearlyNormal;
-const monthlyYearlyWbgt = _monthlyYearlyWbgt as unknown as MonthlyYearlyWbgt;
+const aggregates = _aggregates as unknown as Aggregates;
 const stationIndex = _stationIndex as unknown as StationIndex;
 
 // 47都道府県庁所在地の観測所ID
@@ -276,91 +267,48 @@ const PREFECTURE_STATIONS = {
   ],
 };
 
-function calculateAverage(values: number[]) {
-  const sum = values.reduce((acc, val) => acc + val, 0);
-  return sum / values.length;
-}
+type Metric = keyof Aggregates["national"];
 
-function findMaxStation(stations: Station[]) {
-  return stations.reduce((max, station) =>
-    station.value > max.value ? station : max,
-  );
+// 全国平均と極値はデータ処理側で計算済みなので、値を引くだけにする
+function findMaxStation(metric: Metric): Station {
+  const summary = aggregates.national[metric];
+  if (!summary) throw new Error(`No aggregates for ${metric}`);
+  return {
+    id: summary.max_station,
+    name: stationIndex[summary.max_station].station_name,
+    value: summary.max,
+  };
 }
 
-function findMinStation(stations: Station[]) {
-  return stations.reduce((min, station) =>
-    station.value < min.value ? station : min,
-  );
+function findMinStation(metric: Metric): Station {
+  const summary = aggregates.national[metric];
+  if (!summary) throw new Error(`No aggregates for ${metric}`);
+  return {
+    id: summary.min_station,
+    name: stationIndex[summary.min_station].station_name,
+    value: summary.min,
+  };
 }
 
 export async function data(): Promise<PageContext["data"]> {
-  const stations = Object.keys(monthlyYearlyNormal);
-
-  const temperatureStations: Station[] = [];
-  const precipitationStations: Station[] = [];
-  const sunshineDurationStations: Station[] = [];
-  const wbgtStations: Station[] = [];
-
-  for (const id of stations) {
-    const normal = monthlyYearlyNormal[id];
-    const wbgt = monthlyYearlyWbgt[id];
-    const station = stationIndex[id];
-
-    if (normal.yearly.temperature !== null) {
-      temperatureStations.push({
-        id,
-        name: station.station_name,
-        value: normal.yearly.temperature,
-      });
-    }
-
-    if (normal.yearly.precipitation !== null) {
-      precipitationStations.push({
-        id,
-        name: station.station_name,
-        value: normal.yearly.precipitation,
-      });
-    }
-
-    if (normal.yearly.sunshine_duration !== null) {
-      sunshineDurationStations.push({
-        id,
-        name: station.station_name,
-        value: normal.yearly.sunshine_duration,
-      });
-    }
-
-    if (wbgt?.yearly !== null && wbgt?.yearly !== undefined) {
-      wbgtStations.push({
-        id,
-        name: station.station_name,
-        value: wbgt.yearly,
-      });
-    }
-  }
-
   return {
     averages: {
-      temperature: calculateAverage(temperatureStations.map((s) => s.value)),
-      precipitation: calculateAverage(
-        precipitationStations.map((s) => s.value),
-      ),
-      sunshine_duration: calculateAverage(
-        sunshineDurationStations.map((s) => s.value),
-      ),
-      wbgt: calculateAverage(wbgtStations.map((s) => s.value)),
+      temperature: aggregates.national.temperature?.mean ?? 0,
+      precipitation: aggregates.national.precipitation?.mean ?? 0,
+      sunshine_duration: aggregates.national.sunshine_duration?.mean ?? 0,
+      wbgt: aggregates.national.wbgt?.mean ?? 0,
     },
     max_station: {
-      temperature: findMaxStation(temperatureStations),
-      precipitation: findMaxStation(precipitationStations),
-      sunshine_duration: findMaxStation(sunshineDurationStations),
-      wbgt: findMaxStation(wbgtStations),
+      temperature: findMaxStation("temperature"),
+      precipitation: findMaxStation("precipitation"),
+      sunshine_duration: findMaxStation("sunshine_duration"),
+      wbgt: findMaxStation("wbgt"),
     },
     min_station: {
-      temperature: findMinStation(temperatureStations),
-      precipitation: findMinStation(precipitationStations),
-      sunshine_duration: findMinStation(sunshineDurationStations),
-      wbgt: findMinStation(wbgtStations),
+      temperature: findMinStation("temperature"),
+      precipitation: findMinStation("precipitation"),
+      sunshine_duration: findMinStation("sunshine_duration"),
+      wbgt: findMinStation("wbgt"),
     },
     prefectural_capital_stations: PREFECTURE_STATIONS,
   };
@@ -1,19 +1,3 @@
-export type MonthlyYearlyNormal = Record<
-  string,
-  {
-    yearly: {
-      temperature: number | null;
-      precipitation: number | null;
-      sunshine_duration: number | null;
-    };
-  }
->;
-
-export type MonthlyYearlyWbgt = Record<
-  string,
-  { yearly: number; monthly: Record<string, number> }
->;
-
 export type StationIndex = Record<
   string,
   {
@@ -65,3 +49,35 @@ export type PageContext = {
     };
   };
 };
+
+type AggregateSummary = {
+  count: number;
+  mean: number;
+  min: number;
+  max: number;
+  min_station: string;
+  max_station: string;
+  percentiles: Record<string, number>;
+  monthly: Record<string, number>;
+};
+
+type StationRank = {
+  value: number;
+  rank: number;
+  count: number;
+  region_rank: number;
+  region_count: number;
+  prefecture_rank: number;
+  prefecture_count: number;
+  percentile: number;
+  difference: number;
+};
+
+type Metric = "temperature" | "precipitation" | "sunshine_duration" | "wbgt";
+
+export type Aggregates = {
+  national: Partial<Record<Metric, AggregateSummary>>;
+  regions: Record<string, Partial<Record<Metric, AggregateSummary>>>;
+  prefectures: Record<string, Partial<Record<Metric, AggregateSummary>>>;
+  stations: Record<string, Partial<Record<Metric, StationRank>>>;
+};
@@ -1,7 +1,9 @@
+import _aggregates from "../../../data/processed/aggregates.json";
 import _monthlyYearlyNormal from "../../../data/processed/monthly_yearly_normal.json";
 import _monthlyYearlyWbgt from "../../../data/processed/monthly_yearly_wbgt.json";
 import _stationIndex from "../../../data/processed/station_index.json";
 import type {
+  Aggregates,
   MonthlyYearlyNormal,
   MonthlyYearlyWbgt,
   StationIndex,
@@ -11,6 +13,7 @@ const monthlyYearlyNormal =
   _monthlyYearlyNormal as unknown as MonthlyYearlyNormal;
 const monthlyYearlyWbgt = _monthlyYearlyWbgt as unknown as MonthlyYearlyWbgt;
 const stationIndex = _stationIndex as unknown as StationIndex;
+const aggregates = _aggregates as unknown as Aggregates;
 
 // 都道府県から地域へのマッピング
 const REGION_MAP: Record<string, string> = {
@@ -76,11 +79,7 @@ const REGION_MAP: Record<string, string> = {
   沖縄: "九州",
 };
 
-function calculateAverage(values: number[]): number {
-  if (values.length === 0) return 0;
-  const sum = values.reduce((acc, val) => acc + val, 0);
-  return sum / values.length;
-}
+type Metric = "temperature" | "precipitation" | "sunshine_duration" | "wbgt";
 
 export type Data = Awaited<ReturnType<typeof data>>;
 
@@ -115,71 +114,26 @@ export async function data() {
     };
   });
 
-  // 各指標の有効な値を持つ観測所のみで平均と極値を計算
-  const validTemp = stations.filter((s) => s.yearly.temperature !== null);
-  const validPrec = stations.filter((s) => s.yearly.precipitation !== null);
-  const validSun = stations.filter((s) => s.yearly.sunshine_duration !== null);
-  const validWbgt = stations.filter((s) => s.yearly.wbgt !== null);
-
-  // 全国平均
-  const averages = {
-    temperature: calculateAverage(
-      validTemp.map((s) => s.yearly.temperature as number),
-    ),
-    precipitation: calculateAverage(
-      validPrec.map((s) => s.yearly.precipitation as number),
-    ),
-    sunshine_duration: calculateAverage(
-      validSun.map((s) => s.yearly.sunshine_duration as number),
-    ),
-    wbgt: calculateAverage(validWbgt.map((s) => s.yearly.wbgt as number)),
-  };
-
-  // 最後に各指標のランキングデータとしてまとめる
-  const temperatureStations = validTemp
-    .map((s) => ({
-      station_number: s.station_number,
-      station_name: s.station_name,
-      prefecture: s.prefecture,
-      region: s.region,
-      value: s.yearly.temperature as number,
-      difference: (s.yearly.temperature as number) - averages.temperature,
-    }))
-    .sort((a, b) => b.value - a.value);
-
-  const precipitationStations = validPrec
-    .map((s) => ({
-      station_number: s.station_number,
-      station_name: s.station_name,
-      prefecture: s.prefecture,
-      region: s.region,
-      value: s.yearly.precipitation as number,
-      difference: (s.yearly.precipitation as number) - averages.precipitation,
-    }))
-    .sort((a, b) => b.value - a.value);
-
-  const sunshineDurationStations = validSun
-    .map((s) => ({
-      station_number: s.station_number,
-      station_name: s.station_name,
-      prefecture: s.prefecture,
-      region: s.region,
-      value: s.yearly.sunshine_duration as number,
-      difference:
-        (s.yearly.sunshine_duration as number) - averages.sunshine_duration,
-    }))
-    .sort((a, b) => b.value - a.value);
-
-  const wbgtStations = validWbgt
-    .map((s) => ({
-      station_number: s.station_number,
-      station_name: s.station_name,
-      prefecture: s.prefecture,
-      region: s.region,
-      value: s.yearly.wbgt as number,
-      difference: (s.yearly.wbgt as number) - averages.wbgt,
-    }))
-    .sort((a, b) => b.value - a.value);
+  // 全国平均との差はデータ処理側で計算済みなので、値を引くだけにする
+  function rankStations(metric: Metric) {
+    return stations
+      .filter((s) => s.yearly[metric] !== null)
+      .map((s) => ({
+        station_number: s.station_number,
+        station_name: s.station_name,
+        prefecture: s.prefecture,
+        region: s.region,
+        value: s.yearly[metric] as number,
+        difference:
+          aggregates.stations[s.station_number]?.[metric]?.difference ?? 0,
+      }))
+      .sort((a, b) => b.value - a.value);
+  }
+
+  const temperatureStations = rankStations("temperature");
+  const precipitationStations = rankStations("precipitation");
+  const sunshineDurationStations = rankStations("sunshine_duration");
+  const wbgtStations = rankStations("wbgt");
 
   // テーブルのフィルタ機能の選択候補で使う都道府県と地域のリスト
   const prefectures = [...Object.keys(REGION_MAP), "不明"];
@@ -31,3 +31,35 @@ export type StationIndex = Record<
     address: string;
   }
 >;
+
+type AggregateSummary = {
+  count: number;
+  mean: number;
+  min: number;
+  max: number;
+  min_station: string;
+  max_station: string;
+  percentiles: Record<string, number>;
+  monthly: Record<string, number>;
+};
+
+type StationRank = {
+  value: number;
+  rank: number;
+  count: number;
+  region_rank: number;
+  region_count: number;
+  prefecture_rank: number;
+  prefecture_count: number;
+  percentile: number;
+  difference: number;
+};
+
+type Metric = "temperature" | "precipitation" | "sunshine_duration" | "wbgt";
+
+export type Aggregates = {
+  national: Partial<Record<Metric, AggregateSummary>>;
+  regions: Record<string, Partial<Record<Metric, AggregateSummary>>>;
+  prefectures: Record<string, Partial<Record<Metric, AggregateSummary>>>;
+  stations: Record<string, Partial<Record<Metric, StationRank>>>;
+};
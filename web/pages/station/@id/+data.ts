@@ -1,10 +1,12 @@
 import type { PageContext } from "vike/types";
+import _aggregates from "../../../../data/processed/aggregates.json";
 import _dailyNormal from "../../../../data/processed/daily_normal.json";
 import _dailyWbgt from "../../../../data/processed/daily_wbgt.json";
 import _monthlyYearlyNormal from "../../../../data/processed/monthly_yearly_normal.json";
 import _monthlyYearlyWbgt from "../../../../data/processed/monthly_yearly_wbgt.json";
 import _stationIndex from "../../../../data/processed/station_index.json";
 import type {
+  Aggregates,
   DailyNormal,
   DailyWbgt,
   MonthlyYearlyNormal,
@@ -19,49 +21,7 @@ const monthlyYearlyNormal =
 const dailyWbgt = _dailyWbgt as DailyWbgt;
 const monthlyYearlyWbgt = _monthlyYearlyWbgt as MonthlyYearlyWbgt;
 const stationIndex = _stationIndex as unknown as StationIndex;
-
-// 全国平均を計算する関数
-function calculateNationalAverages() {
-  const stations = Object.keys(monthlyYearlyNormal);
-
-  let tempSum = 0;
-  let tempCount = 0;
-  let precipSum = 0;
-  let precipCount = 0;
-  let sunshineSum = 0;
-  let sunshineCount = 0;
-  let wbgtSum = 0;
-  let wbgtCount = 0;
-
-  for (const stationId of stations) {
-    const normal = monthlyYearlyNormal[stationId];
-    const wbgt = monthlyYearlyWbgt[stationId];
-
-    if (normal.yearly.temperature !== null) {
-      tempSum += normal.yearly.temperature;
-      tempCount++;
-    }
-    if (normal.yearly.precipitation !== null) {
-      precipSum += normal.yearly.precipitation;
-      precipCount++;
-    }
-    if (normal.yearly.sunshine_duration !== null) {
-      sunshineSum += normal.yearly.sunshine_duration;
-      sunshineCount++;
-    }
-    if (wbgt?.yearly !== null && wbgt?.yearly !== undefined) {
-      wbgtSum += wbgt.yearly;
-      wbgtCount++;
-    }
-  }
-
-  return {
-    temperature: tempCount > 0 ? tempSum / tempCount : 0,
-    precipitation: precipCount > 0 ? precipSum / precipCount : 0,
-    sunshine_duration: sunshineCount > 0 ? sunshineSum / sunshineCount : 0,
-    wbgt: wbgtCount > 0 ? wbgtSum / wbgtCount : 0,
-  };
-}
+const aggregates = _aggregates as unknown as Aggregates;
 
 export type Data = Awaited<ReturnType<typeof data>>;
 
@@ -71,7 +31,13 @@ export async function data(pageContext: PageContext) {
   const stationId = pageContext.routeParams.id;
   const wbgtStations = Object.keys(monthlyYearlyWbgt);
   const station = stationIndex[stationId];
-  const nationalAverages = calculateNationalAverages();
+  // 全国平均はデータ処理側で計算済み
+  const nationalAverages = {
+    temperature: aggregates.national.temperature?.mean ?? 0,
+    precipitation: aggregates.national.precipitation?.mean ?? 0,
+    sunshine_duration: aggregates.national.sunshine_duration?.mean ?? 0,
+    wbgt: aggregates.national.wbgt?.mean ?? 0,
+  };
 
   config({
     title: `${station.prefecture_subprefecture} ${station.station_name}のデータ | 日本気候データベース`,